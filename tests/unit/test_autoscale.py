@@ -0,0 +1,111 @@
+import unittest
+
+from mock import Mock, patch
+
+from velvet.autoscale import CapacityException, CapacityGuard, RollingRecycler, get_batch_size
+from velvet.ec2 import InstanceRecord
+
+def group_instance(instance_id, lifecycle_state='InService', health_status='Healthy'):
+	return Mock(instance_id=instance_id, lifecycle_state=lifecycle_state, health_status=health_status)
+
+def group(instance_ids, desired_capacity=2):
+	g = Mock(desired_capacity=desired_capacity, instances=[group_instance(i) for i in instance_ids])
+	g.name = 'web'
+	return g
+
+def running(instance_ids, region=None):
+	return [InstanceRecord(i, state='running') for i in instance_ids]
+
+class TestBatchSize(unittest.TestCase):
+
+	def test_batch_size(self):
+		self.assertEquals(get_batch_size(2, 10), 2)
+		self.assertEquals(get_batch_size('25%', 10), 3)
+		self.assertEquals(get_batch_size('10%', 2), 1)
+		self.assertEquals(get_batch_size(0, 2), 1)
+
+@patch('velvet.autoscale.boto.ec2.autoscale.connect_to_region')
+@patch('velvet.ec2.get_instance_records')
+@patch('velvet.ec2.get_autoscaling_group')
+class TestRollingRecycler(unittest.TestCase):
+
+	def test_recycles_in_batches(self, get_autoscaling_group, get_instance_records, connect_to_region):
+		get_instance_records.side_effect = running
+		get_autoscaling_group.side_effect = [
+			group(['i-1', 'i-2']),
+			# first batch: replacement not yet in service
+			group(['i-2']),
+			group(['i-2', 'i-3']),
+			group(['i-3', 'i-4']),
+		]
+
+		recycler = RollingRecycler('web', region='eu-west-1', batch_size=1, sleep=Mock())
+		result = recycler.recycle()
+
+		self.assertTrue(result)
+		self.assertEquals(result.recycled, ['i-1', 'i-2'])
+		connect_to_region.return_value.terminate_instance.assert_called_with('i-2', decrement_capacity=False)
+		self.assertEquals(recycler.sleep.call_count, 1)
+
+	def test_pending_instances_not_retired(self, get_autoscaling_group, get_instance_records, connect_to_region):
+		get_instance_records.side_effect = [
+			[InstanceRecord('i-1', state='pending'), InstanceRecord('i-2', state='running')],
+			# the pending instance has started by the time the replacement is in service
+			running(['i-1', 'i-3']),
+		]
+		get_autoscaling_group.side_effect = [
+			group(['i-1', 'i-2']),
+			group(['i-1', 'i-3']),
+		]
+
+		recycler = RollingRecycler('web', region='eu-west-1', batch_size='100%', sleep=Mock())
+		result = recycler.recycle()
+
+		self.assertTrue(result)
+		self.assertEquals(recycler.sleep.call_count, 0)
+
+		self.assertEquals(result.recycled, ['i-2'])
+		connect_to_region.return_value.terminate_instance.assert_called_once_with('i-2', decrement_capacity=False)
+
+	def test_times_out(self, get_autoscaling_group, get_instance_records, connect_to_region):
+		get_instance_records.side_effect = running
+		get_autoscaling_group.return_value = group(['i-1', 'i-2'])
+		clock = Mock(side_effect=[0, 10, 20])
+
+		recycler = RollingRecycler('web', region='eu-west-1', batch_size='50%', timeout=15, clock=clock,
+								   sleep=Mock())
+		result = recycler.recycle()
+
+		self.assertTrue(result.failed)
+		self.assertEquals(result.recycled, ['i-1'])
+
+@patch('velvet.ec2.get_instance_records')
+@patch('velvet.ec2.get_autoscaling_group')
+class TestCapacityGuard(unittest.TestCase):
+
+	def test_restores_capacity_on_failure(self, get_autoscaling_group, get_instance_records):
+		get_instance_records.side_effect = running
+		g = group(['i-1', 'i-2', 'i-3'], desired_capacity=2)
+		g.max_size = 2
+		get_autoscaling_group.return_value = g
+		updates = []
+		g.update.side_effect = lambda: updates.append((g.desired_capacity, g.max_size))
+
+		def deploy():
+			with CapacityGuard('web', region='eu-west-1', surge='50%', sleep=Mock()):
+				self.assertEquals(updates, [(3, 3)])
+				raise RuntimeError('deploy failed')
+
+		self.assertRaises(RuntimeError, deploy)
+		self.assertEquals(updates, [(3, 3), (2, 2)])
+
+	def test_restores_capacity_on_timeout(self, get_autoscaling_group, get_instance_records):
+		get_instance_records.side_effect = running
+		g = group(['i-1'], desired_capacity=1)
+		g.max_size = 4
+		get_autoscaling_group.return_value = g
+
+		guard = CapacityGuard('web', region='eu-west-1', surge=1, timeout=5, clock=Mock(side_effect=[0, 10]),
+							  sleep=Mock())
+		self.assertRaises(CapacityException, guard.__enter__)
+		self.assertEquals((g.desired_capacity, g.max_size), (1, 4))
@@ -0,0 +1,26 @@
+import unittest
+
+from fabric.api import env
+
+from velvet.aws.config import get_region, get_regions, region_from_arn, in_regions
+
+class TestAwsRegions(unittest.TestCase):
+
+	def tearDown(self):
+		env.pop('regions', None)
+
+	def test_region_from_arn(self):
+		arn = 'arn:aws:cloudformation:us-east-1:123456789012:stack/dev/abc'
+		self.assertEquals(region_from_arn(arn), 'us-east-1')
+		self.assertEquals(region_from_arn('dev'), None)
+
+	def test_regions(self):
+		self.assertEquals(get_regions(), [get_region()])
+		env.regions = ['eu-west-1', 'us-east-1']
+		self.assertEquals(get_regions(), ['eu-west-1', 'us-east-1'])
+		self.assertEquals(get_region('us-east-1'), 'us-east-1')
+
+	def test_in_regions(self):
+		env.regions = ['eu-west-1', 'us-east-1']
+		results = in_regions(lambda region: region.upper())
+		self.assertEquals(results.items(), [('eu-west-1', 'EU-WEST-1'), ('us-east-1', 'US-EAST-1')])
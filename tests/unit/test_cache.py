@@ -0,0 +1,31 @@
+import unittest
+
+from velvet.cache import TTLCache
+
+class TestTTLCache(unittest.TestCase):
+
+	def setUp(self):
+		self.now = 1000
+		self.cache = TTLCache(30, clock=lambda: self.now)
+
+	def test_get_by_any_key(self):
+		self.cache.set(['name', 'id'], 'stack')
+		self.assertEquals(self.cache.get('name'), 'stack')
+		self.assertEquals(self.cache.get('id'), 'stack')
+		self.assertEquals(self.cache.get('other'), None)
+
+	def test_expired(self):
+		self.cache.set(['name', 'id'], 'stack')
+		self.now += 30
+		self.assertEquals(self.cache.get('name'), None)
+		self.assertEquals(self.cache.get('id'), None)
+
+	def test_invalidate_removes_aliases(self):
+		self.cache.set(['name', 'id'], 'stack')
+		self.cache.invalidate('name')
+		self.assertEquals(self.cache.get('id'), None)
+
+	def test_disabled(self):
+		cache = TTLCache(0)
+		cache.set(['name'], 'stack')
+		self.assertEquals(cache.get('name'), None)
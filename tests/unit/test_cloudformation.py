@@ -1,10 +1,23 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
 import unittest
 
-from mock import Mock
+from StringIO import StringIO
+
+from mock import Mock, patch
 
 from boto.cloudformation.stack import Stack
 
-from velvet.cloudformation.stack import StackNotReadyException, validate_stack
+from datetime import datetime, timedelta
+
+import velvet.cloudformation.stack as cf_stack
+
+from velvet.cloudformation.stack import StackNotReadyException, validate_stack, StackEventStream
+from velvet.cloudformation.upload import TemplateUploader
 
 class TestCloudFormationValidateStack(unittest.TestCase):
 
@@ -68,4 +81,227 @@ class TestCloudFormationValidateStack(unittest.TestCase):
 			stack.stack_status = status
 
 			self.assertEquals(stack.stack_status, status)
-			self.assertRaises(Exception, validate_stack, stack)		
\ No newline at end of file
+			self.assertRaises(Exception, validate_stack, stack)
+
+
+class EventPage(list):
+
+	def __init__(self, events, next_token=None):
+		list.__init__(self, events)
+		self.next_token = next_token
+
+
+def _event(event_id, minutes=0):
+	return Mock(event_id=event_id, timestamp=datetime(2014, 9, 20) + timedelta(minutes=minutes))
+
+
+class TestCloudFormationStackEventStream(unittest.TestCase):
+
+	def test_stops_at_seen_event(self):
+		connection = Mock()
+		stack = Mock(stack_id='stack-id')
+		stream = StackEventStream(stack, connection)
+
+		connection.describe_stack_events.return_value = EventPage([_event('b', 1), _event('a')], 'token')
+		self.assertEquals([e.event_id for e in stream.new_events()], ['b', 'a'])
+
+		connection.describe_stack_events.return_value = EventPage([_event('d', 3), _event('c', 2), _event('b', 1)], 'token')
+		self.assertEquals([e.event_id for e in stream.new_events()], ['d', 'c'])
+		self.assertEquals(connection.describe_stack_events.call_count, 2)
+
+	def test_pages_until_since(self):
+		connection = Mock()
+		stack = Mock(stack_id='stack-id')
+		stream = StackEventStream(stack, connection, since=datetime(2014, 9, 20, 0, 1))
+
+		connection.describe_stack_events.side_effect = [
+			EventPage([_event('c', 3), _event('b', 2)], 'token'),
+			EventPage([_event('a', 0)], 'token'),
+		]
+		self.assertEquals([e.event_id for e in stream.new_events()], ['c', 'b'])
+		self.assertEquals(connection.describe_stack_events.call_count, 2)
+
+	def test_window_is_bounded(self):
+		connection = Mock()
+		stack = Mock(stack_id='stack-id')
+		stream = StackEventStream(stack, connection, window=2)
+
+		connection.describe_stack_events.return_value = EventPage([_event('c', 2), _event('b', 1), _event('a')])
+		stream.new_events()
+		self.assertEquals(stream._seen_ids, set(['b', 'c']))
+
+
+class TestCloudFormationStackView(unittest.TestCase):
+
+	def test_indexes(self):
+		from velvet.cloudformation.view import StackView
+
+		stack = Mock(stack_id='stack-id', stack_name='dev')
+		stack.outputs = [Mock(key='WebHost1', value='a'), Mock(key='WebHost2', value='b'), Mock(key='DbHost', value='c')]
+		stack.connection.list_stack_resources.return_value = EventPage([
+			Mock(logical_resource_id='WebGroup', physical_resource_id='dev-WebGroup-1', resource_type='AWS::AutoScaling::AutoScalingGroup', resource_status='CREATE_COMPLETE'),
+			Mock(logical_resource_id='Database', physical_resource_id='dev-db', resource_type='AWS::RDS::DBInstance', resource_status='CREATE_COMPLETE'),
+		])
+
+		view = StackView(stack)
+		self.assertEquals(view.get_output('DbHost'), 'c')
+		self.assertEquals(view.match_outputs('^WebHost'), ['a', 'b'])
+		self.assertEquals(view.get_physical_id('WebGroup'), 'dev-WebGroup-1')
+		self.assertEquals(view.get_resource('Database')['ResourceType'], 'AWS::RDS::DBInstance')
+		self.assertEquals(view.get_resource('Missing'), None)
+		self.assertEquals(stack.connection.list_stack_resources.call_count, 1)
+
+
+class TestCloudFormationTemplateUploader(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.uploader = TemplateUploader('templates', path='/cloudformation/')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def write(self, name, template):
+		path = os.path.join(self.tmp_dir, name)
+		with open(path, 'w') as f:
+			f.write(json.dumps(template))
+		return path
+
+	def test_key_name(self):
+		body = '{"Resources": {}}'
+		key_name = self.uploader.key_name(body)
+		self.assertEquals(key_name, 'cloudformation/' + hashlib.sha256(body).hexdigest() + '.json')
+		self.assertEquals(self.uploader.key_name(body), key_name)
+		self.assertNotEqual(self.uploader.key_name(body + ' '), key_name)
+		self.assertEquals(TemplateUploader('templates', path='').key_name(body),
+						  hashlib.sha256(body).hexdigest() + '.json')
+
+	def test_render_rewrites_nested_templates(self):
+		self.write('network.json', {'Resources': {'Vpc': {'Type': 'AWS::EC2::VPC'}}})
+		path = self.write('main.json', {'Resources': {
+			'Network': {'Type': 'AWS::CloudFormation::Stack', 'Properties': {'TemplateURL': 'network.json'}},
+			'Remote': {'Type': 'AWS::CloudFormation::Stack',
+					   'Properties': {'TemplateURL': 'https://example.s3.amazonaws.com/remote.json'}},
+		}})
+
+		body, uploads = self.uploader.render(path)
+
+		self.assertEquals(len(uploads), 2)
+		self.assertEquals(uploads[-1], body)
+		resources = json.loads(body)['Resources']
+		self.assertEquals(resources['Network']['Properties']['TemplateURL'],
+						  self.uploader.url(self.uploader.key_name(uploads[0])))
+		self.assertEquals(resources['Remote']['Properties']['TemplateURL'],
+						  'https://example.s3.amazonaws.com/remote.json')
+
+	def test_render_without_nested_templates(self):
+		path = self.write('main.json', {'Resources': {}})
+		with open(path) as f:
+			original = f.read()
+		self.assertEquals(self.uploader.render(path), (original, [original]))
+
+	@patch('velvet.cloudformation.upload.Key')
+	@patch('velvet.cloudformation.upload.S3Connection')
+	def test_upload_skips_existing_keys(self, S3Connection, Key):
+		bucket = S3Connection.return_value.get_bucket.return_value
+		existing = self.uploader.key_name('existing')
+		bucket.get_key.side_effect = lambda key_name: Mock() if key_name == existing else None
+
+		urls = self.uploader.upload_all(['existing', 'new'])
+
+		self.assertEquals(urls, [self.uploader.url(existing), self.uploader.url(self.uploader.key_name('new'))])
+		self.assertEquals(Key.return_value.set_contents_from_string.call_count, 1)
+		Key.return_value.set_contents_from_string.assert_called_with(
+			'new', headers={'Content-Type': 'application/json'})
+
+
+STACK_ID = 'arn:aws:cloudformation:eu-west-1:123456789012:stack/dev/abc'
+
+def boto_stack(status='CREATE_COMPLETE'):
+	stack = Stack()
+	stack.stack_id = STACK_ID
+	stack.stack_name = 'dev'
+	stack.stack_status = status
+	return stack
+
+@patch('velvet.cloudformation.stack.get_region', Mock(side_effect=lambda region=None: region or 'eu-west-1'))
+@patch('velvet.cloudformation.stack.boto.cloudformation.connect_to_region')
+class TestCloudFormationStackCache(unittest.TestCase):
+
+	def setUp(self):
+		cf_stack._stack_cache.clear()
+		cf_stack._view_cache.clear()
+		self.tmp_dir = tempfile.mkdtemp()
+		self.template_file = os.path.join(self.tmp_dir, 'dev.json')
+		with open(self.template_file, 'w') as f:
+			f.write('{"Resources": {}}')
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+		shutil.rmtree(self.tmp_dir)
+		cf_stack._stack_cache.clear()
+		cf_stack._view_cache.clear()
+
+	def test_cached_by_name_and_id(self, connect_to_region):
+		connection = connect_to_region.return_value
+		connection.describe_stacks.return_value = [boto_stack()]
+
+		stack = cf_stack.get_stack('dev', region='eu-west-1')
+		self.assertEquals(stack.stack_id, STACK_ID)
+		connection.describe_stacks.assert_called_once_with('dev')
+
+		self.assertTrue(cf_stack.get_stack('dev', region='eu-west-1') is stack)
+		self.assertTrue(cf_stack.get_stack(STACK_ID) is stack)
+		self.assertEquals(connection.describe_stacks.call_count, 1)
+
+		cf_stack.get_stack('dev', region='eu-west-1', cached=False)
+		self.assertEquals(connection.describe_stacks.call_count, 2)
+
+	def test_deleted_stack_not_cached(self, connect_to_region):
+		connect_to_region.return_value.describe_stacks.return_value = [boto_stack('DELETE_COMPLETE')]
+		self.assertEquals(cf_stack.get_stack(STACK_ID), None)
+		self.assertFalse((('eu-west-1', 'dev')) in cf_stack._stack_cache)
+
+	def test_invalidate_by_id(self, connect_to_region):
+		connect_to_region.return_value.describe_stacks.return_value = [boto_stack()]
+		cf_stack.get_stack('dev', region='eu-west-1')
+		cf_stack.invalidate_stack(STACK_ID)
+		self.assertFalse(('eu-west-1', 'dev') in cf_stack._stack_cache)
+		self.assertFalse(('eu-west-1', STACK_ID) in cf_stack._stack_cache)
+
+	@patch('velvet.cloudformation.stack.StackManifest', Mock())
+	def test_invalidated_after_delete(self, connect_to_region):
+		connection = connect_to_region.return_value
+		connection.describe_stacks.return_value = [boto_stack()]
+		cf_stack.get_stack('dev', region='eu-west-1')
+
+		cf_stack.start_delete_stack('dev', region='eu-west-1')
+		connection.delete_stack.assert_called_once_with('dev')
+		self.assertFalse(('eu-west-1', 'dev') in cf_stack._stack_cache)
+
+	@patch('velvet.cloudformation.stack.validate_template', Mock(return_value=Mock(description='')))
+	@patch('velvet.cloudformation.stack.StackManifest', Mock())
+	def test_invalidated_after_create(self, connect_to_region):
+		connection = connect_to_region.return_value
+		connection.describe_stacks.return_value = []
+		connection.create_stack.return_value = None
+		cf_stack._stack_cache.set([('eu-west-1', 'dev'), ('eu-west-1', STACK_ID)], boto_stack('DELETE_FAILED'))
+
+		result = cf_stack.provision_stack_with_template('dev', self.template_file, force=True, region='eu-west-1')
+		self.assertTrue(result.failed)
+		self.assertTrue(connection.create_stack.called)
+		self.assertFalse(('eu-west-1', STACK_ID) in cf_stack._stack_cache)
+
+	@patch('velvet.cloudformation.stack.validate_template', Mock(return_value=Mock(description='')))
+	@patch('velvet.cloudformation.stack.StackManifest', Mock())
+	def test_invalidated_after_update(self, connect_to_region):
+		connection = connect_to_region.return_value
+		connection.describe_stacks.return_value = [boto_stack()]
+		connection.update_stack.return_value = None
+		cf_stack.get_stack('dev', region='eu-west-1')
+
+		cf_stack.provision_stack_with_template('dev', self.template_file, force=True, region='eu-west-1')
+		self.assertTrue(connection.update_stack.called)
+		self.assertFalse(('eu-west-1', 'dev') in cf_stack._stack_cache)
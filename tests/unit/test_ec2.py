@@ -0,0 +1,61 @@
+import unittest
+
+from mock import Mock, patch
+
+import velvet.ec2
+
+class GroupPage(list):
+
+	def __init__(self, groups, next_token=None):
+		list.__init__(self, groups)
+		self.next_token = next_token
+
+def group(name):
+	g = Mock()
+	g.name = name
+	return g
+
+class TestAutoscalingGroups(unittest.TestCase):
+
+	def setUp(self):
+		velvet.ec2._group_cache.clear()
+
+	@patch('boto.ec2.autoscale.connect_to_region')
+	def test_pages_and_caches(self, connect_to_region):
+		autoscale = connect_to_region.return_value
+		autoscale.get_all_groups.side_effect = [
+			GroupPage([group('web')], 'page-2'),
+			GroupPage([group('worker')]),
+		]
+
+		groups = velvet.ec2.get_autoscaling_groups(['web', 'worker', 'missing'], region='eu-west-1')
+		self.assertEquals(sorted(groups.keys()), ['web', 'worker'])
+		autoscale.get_all_groups.assert_called_with(names=['web', 'worker', 'missing'], next_token='page-2')
+
+		self.assertEquals(velvet.ec2.get_autoscaling_group('web', region='eu-west-1').name, 'web')
+		self.assertEquals(autoscale.get_all_groups.call_count, 2)
+
+	@patch('boto.ec2.autoscale.connect_to_region')
+	def test_batches_names(self, connect_to_region):
+		autoscale = connect_to_region.return_value
+		autoscale.get_all_groups.return_value = GroupPage([])
+
+		names = ['group-%d' % i for i in range(velvet.ec2.AUTOSCALING_GROUP_BATCH + 1)]
+		velvet.ec2.get_autoscaling_groups(names, region='eu-west-1')
+		self.assertEquals(autoscale.get_all_groups.call_count, 2)
+
+class TestInstances(unittest.TestCase):
+
+	@patch('boto.ec2.connect_to_region')
+	def test_fetches_batches(self, connect_to_region):
+		def get_only_instances(instance_ids):
+			return [Mock(id=instance_id, tags={'Name': 'web'}) for instance_id in instance_ids]
+		connect_to_region.return_value.get_only_instances.side_effect = get_only_instances
+
+		instance_ids = ['i-%d' % i for i in range(velvet.ec2.INSTANCE_BATCH * 2 + 1)]
+		records = velvet.ec2.get_instance_records(instance_ids, region='eu-west-1')
+
+		self.assertEquals(connect_to_region.return_value.get_only_instances.call_count, 3)
+		self.assertEquals([r.id for r in records], instance_ids)
+		self.assertEquals(records[0].name, 'web')
+		self.assertFalse(hasattr(records[0], '__dict__'))
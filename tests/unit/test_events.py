@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+from mock import Mock, patch
+
+from velvet.cloudformation.events import StackEventRecorder, StackRunAnalysis, read_event_log, \
+	template_dependencies, compare_runs, list_event_logs, event_log_operation
+
+STACK_ID = 'arn:aws:cloudformation:eu-west-1:123456789012:stack/dev/abc'
+START = datetime(2014, 9, 20, 10, 0, 0)
+
+def event(logical_id, status, minutes, resource_type='AWS::RDS::DBInstance'):
+	physical_id = STACK_ID if logical_id == 'dev' else logical_id + '-id'
+	return {
+		'stack_id': STACK_ID,
+		'logical_resource_id': logical_id,
+		'physical_resource_id': physical_id,
+		'resource_type': resource_type,
+		'resource_status': status,
+		'timestamp': START + timedelta(minutes=minutes),
+	}
+
+EVENTS = [
+	event('dev', 'CREATE_IN_PROGRESS', 0),
+	event('Vpc', 'CREATE_IN_PROGRESS', 0),
+	event('Cache', 'CREATE_IN_PROGRESS', 0),
+	event('Vpc', 'CREATE_COMPLETE', 1),
+	event('Database', 'CREATE_IN_PROGRESS', 1),
+	event('Cache', 'CREATE_COMPLETE', 8),
+	event('Database', 'CREATE_COMPLETE', 15),
+	event('dev', 'CREATE_COMPLETE', 15),
+]
+
+class TestStackRunAnalysis(unittest.TestCase):
+
+	def test_durations(self):
+		analysis = StackRunAnalysis(EVENTS)
+		self.assertEquals(analysis.duration, 15 * 60)
+		self.assertEquals([t.logical_id for t in analysis.finished_resources()], ['Database', 'Cache', 'Vpc'])
+		self.assertEquals(analysis.resources['Database'].duration, 14 * 60)
+
+	def test_critical_path(self):
+		self.assertEquals(StackRunAnalysis(EVENTS).critical_path, ['Vpc', 'Database'])
+
+	def test_critical_path_with_template(self):
+		template = json.dumps({'Resources': {
+			'Vpc': {'Type': 'AWS::EC2::VPC'},
+			'Cache': {'Type': 'AWS::ElastiCache::CacheCluster'},
+			'Database': {'Type': 'AWS::RDS::DBInstance', 'DependsOn': 'Cache'},
+		}})
+		analysis = StackRunAnalysis(EVENTS, template_dependencies(template))
+		self.assertEquals(analysis.critical_path, ['Database'])
+
+	def test_compare_runs(self):
+		previous = StackRunAnalysis(EVENTS[:4])
+		comparison = compare_runs(StackRunAnalysis(EVENTS), [previous])
+		self.assertEquals(comparison[0][0], 'Database')
+		self.assertEquals(comparison[0][3], None)
+		self.assertEquals(comparison[2], ('Vpc', 'AWS::RDS::DBInstance', 60, 60))
+
+class TestStackEventRecorder(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_record(self):
+		path = os.path.join(self.tmp, 'run.jsonl')
+		recorder = StackEventRecorder('dev', 'create', 'eu-west-1', path=path)
+		events = [Mock(event_id=str(i), stack_name='dev', resource_status_reason=None, **e)
+				  for i, e in enumerate(EVENTS)]
+		recorder.record(list(reversed(events[:2])))
+		recorder.record(list(reversed(events[2:])))
+		recorded = read_event_log(path)
+		self.assertEquals([e['event_id'] for e in recorded], [str(i) for i in range(len(EVENTS))])
+		self.assertEquals(recorded[-1]['timestamp'], START + timedelta(minutes=15))
+
+	def test_list_event_logs_by_operation(self):
+		names = ['20140920T100000-create.jsonl', '20140921T100000-delete.jsonl', '20140922T100000-create.jsonl']
+		for name in names:
+			open(os.path.join(self.tmp, name), 'w').close()
+		with patch('velvet.cloudformation.events.event_log_dir', return_value=self.tmp):
+			paths = list_event_logs('dev', 'eu-west-1')
+			self.assertEquals([os.path.basename(path) for path in paths], names)
+			self.assertEquals(event_log_operation(paths[-1]), 'create')
+			paths = list_event_logs('dev', 'eu-west-1', 'create')
+			self.assertEquals([os.path.basename(path) for path in paths], [names[0], names[2]])
+
+	def test_runs_in_the_same_second(self):
+		clock = Mock()
+		clock.utcnow.return_value = START
+		with patch('velvet.cloudformation.events.event_log_dir', return_value=self.tmp):
+			with patch('velvet.cloudformation.events.datetime', clock):
+				first = StackEventRecorder('dev', 'create', 'eu-west-1')
+				second = StackEventRecorder('dev', 'create', 'eu-west-1')
+		self.assertNotEqual(first.path, second.path)
+		self.assertEquals(event_log_operation(first.path), 'create')
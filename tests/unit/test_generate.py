@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from velvet.cloudformation.generate import TemplateGenerator, TemplateJob, list_templates
+
+class TestTemplateGenerator(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		os.mkdir(os.path.join(self.tmp, 'mappings'))
+		self.write('vpc.py', 'cft = None')
+		self.write('mappings/dev.yaml', 'cidr: 10.0.0.0/16')
+		self.job = TemplateJob(self.tmp, 'dev', 'vpc')
+		self.generator = TemplateGenerator(state_file=os.path.join(self.tmp, 'templates.json'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def write(self, name, content):
+		with open(os.path.join(self.tmp, name), 'w') as f:
+			f.write(content)
+
+	def render(self, args):
+		self.write(args[1], '{}')
+		return None
+
+	def test_list_templates(self):
+		self.assertEquals(list_templates(self.tmp), ['vpc'])
+
+	def test_skip_unchanged(self):
+		with patch('velvet.cloudformation.generate.render_template', side_effect=self.render) as render:
+			self.assertEquals(self.generator.generate([self.job]).generated, [self.job])
+			self.assertEquals(self.generator.generate([self.job]).skipped, [self.job])
+
+			self.write('mappings/dev.yaml', 'cidr: 10.1.0.0/16')
+			self.assertEquals(self.generator.generate([self.job]).generated, [self.job])
+			self.assertEquals(render.call_count, 2)
+
+	def test_failed(self):
+		with patch('velvet.cloudformation.generate.render_template', return_value='Syntax error'):
+			result = self.generator.generate([self.job])
+			self.assertFalse(result)
+			self.assertEquals(result.failed, [(self.job, 'Syntax error')])
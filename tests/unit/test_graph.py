@@ -0,0 +1,72 @@
+import threading
+import unittest
+
+from velvet.cloudformation.graph import StackGraph, StackGraphException, execute
+
+STACKS = [
+	{'name': 'network', 'template': 'vpc', 'outputs': ['VpcId', 'SubnetId']},
+	{'name': 'database', 'template': 'rds', 'outputs': ['DatabaseHost']},
+	{'name': 'cache', 'template': 'cache', 'outputs': ['CacheHost']},
+	{'name': 'app', 'template': 'opsworks'},
+	{'name': 'workers', 'template': 'workers', 'depends_on': 'app'},
+]
+
+PARAMETERS = {
+	'network': set(),
+	'database': set(['VpcId', 'SubnetId']),
+	'cache': set(['VpcId']),
+	'app': set(['VpcId', 'DatabaseHost', 'CacheHost']),
+	'workers': set(['SubnetId']),
+}
+
+class TestStackGraph(unittest.TestCase):
+
+	def test_dependencies(self):
+		graph = StackGraph(STACKS, PARAMETERS)
+		self.assertEquals(graph.dependencies['network'], set())
+		self.assertEquals(graph.dependencies['database'], set(['network']))
+		self.assertEquals(graph.dependencies['app'], set(['network', 'database', 'cache']))
+		self.assertEquals(graph.dependencies['workers'], set(['network', 'app']))
+		self.assertEquals(sorted(graph.inputs('app')), ['CacheHost', 'DatabaseHost', 'VpcId'])
+
+	def test_unknown_template_depends_on_previous(self):
+		graph = StackGraph(STACKS[:3], {'network': set()})
+		self.assertEquals(graph.dependencies['cache'], set(['network', 'database']))
+		self.assertEquals(sorted(graph.inputs('cache')), ['DatabaseHost', 'SubnetId', 'VpcId'])
+
+	def test_circular_dependency(self):
+		stacks = [{'name': 'a', 'depends_on': ['b']}, {'name': 'b', 'depends_on': ['a']}]
+		self.assertRaises(StackGraphException, StackGraph, stacks, {'a': set(), 'b': set()})
+
+	def test_reversed(self):
+		graph = StackGraph(STACKS, PARAMETERS).reversed()
+		self.assertEquals(graph.dependencies['network'], set(['database', 'cache', 'app', 'workers']))
+		self.assertEquals(graph.dependencies['workers'], set())
+		self.assertEquals(graph.order()[0], 'workers')
+
+
+class TestExecute(unittest.TestCase):
+
+	def test_dependency_order(self):
+		graph = StackGraph(STACKS, PARAMETERS)
+		lock = threading.Lock()
+		completed = []
+
+		def provision(name):
+			with lock:
+				for dependency in graph.dependencies[name]:
+					self.assertTrue(dependency in completed)
+				completed.append(name)
+			return True
+
+		result = execute(graph, provision, max_workers=3)
+		self.assertTrue(result)
+		self.assertEquals(sorted(result.succeeded), sorted(PARAMETERS.keys()))
+
+	def test_failure_skips_dependents(self):
+		graph = StackGraph(STACKS, PARAMETERS)
+		result = execute(graph, lambda name: name != 'database', max_workers=3)
+		self.assertFalse(result)
+		self.assertEquals(result.failed, ['database'])
+		self.assertEquals(sorted(result.skipped), ['app', 'workers'])
+		self.assertEquals(sorted(result.succeeded), ['cache', 'network'])
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import velvet.cloudformation.stack as cf
+
+from velvet.aws.inventory import Inventory, SecurityGroupRecord, sync, sync_autoscaling, sync_cloudformation
+from velvet.ec2 import InstanceRecord
+
+class Page(list):
+
+	def __init__(self, items, next_token=None):
+		list.__init__(self, items)
+		self.next_token = next_token
+
+def stack(name, status='CREATE_COMPLETE'):
+	return Mock(stack_id='arn:aws:cloudformation:eu-west-1:1:stack/%s/1' % name, stack_name=name,
+				stack_status=status, creation_time='2014-01-01', LastUpdatedTime=None, outputs=[])
+
+def group(name, instance_ids):
+	g = Mock(desired_capacity=len(instance_ids), instances=[Mock(instance_id=i) for i in instance_ids])
+	g.name = name
+	return g
+
+class TestInventory(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.inventory = Inventory(os.path.join(self.tmp_dir, 'inventory.sqlite'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_schema_created_once(self):
+		with patch('velvet.aws.inventory.sqlite3.connect') as connect:
+			Inventory(self.inventory.path)
+		self.assertFalse(connect.called)
+
+	def test_freshness(self):
+		self.assertFalse(self.inventory.is_fresh('eu-west-1', 'ec2', 60))
+		self.inventory.store_security_groups('eu-west-1', [
+			SecurityGroupRecord('sg-1', 'web', 'Web', '1', None, [('tcp', 80, 80, '0.0.0.0/0')])])
+		self.assertTrue(self.inventory.is_fresh('eu-west-1', 'ec2', 60))
+		self.assertFalse(self.inventory.is_fresh('us-east-1', 'ec2', 60))
+
+		sg = self.inventory.get_security_group('eu-west-1', 'web')
+		self.assertEquals(sg.id, 'sg-1')
+		self.assertEquals(sg.rules, [('tcp', 80, 80, '0.0.0.0/0')])
+
+	@patch('boto.cloudformation.connect_to_region')
+	def test_resources_listed_for_changed_stacks(self, connect_to_region):
+		connection = connect_to_region.return_value
+		connection.list_stack_resources.return_value = Page([Mock(
+			logical_resource_id='WebGroup', physical_resource_id='web-group',
+			resource_type='AWS::AutoScaling::AutoScalingGroup', resource_status='CREATE_COMPLETE')])
+
+		connection.describe_stacks.return_value = Page([stack('web'), stack('db')])
+		self.assertEquals(sync_cloudformation(self.inventory, 'eu-west-1'), 2)
+
+		connection.describe_stacks.return_value = Page([stack('web', 'UPDATE_COMPLETE'), stack('db')])
+		self.assertEquals(sync_cloudformation(self.inventory, 'eu-west-1'), 1)
+
+		self.assertEquals(connection.list_stack_resources.call_count, 3)
+		self.assertEquals(self.inventory.get_physical_id('eu-west-1', 'db', 'WebGroup'), 'web-group')
+		self.assertEquals(self.inventory.get_stack('eu-west-1', 'web').stack_status, 'UPDATE_COMPLETE')
+
+	@patch('velvet.ec2.get_instance_records')
+	@patch('boto.ec2.autoscale.connect_to_region')
+	def test_running_instances_refreshed(self, connect_to_region, get_instance_records):
+		get_instance_records.side_effect = lambda ids, region: [InstanceRecord(i, state='running') for i in ids]
+
+		connect_to_region.return_value.get_all_groups.return_value = Page([group('web', ['i-1', 'i-2'])])
+		sync_autoscaling(self.inventory, 'eu-west-1')
+
+		get_instance_records.side_effect = lambda ids, region: [InstanceRecord(i, state='stopped') for i in ids]
+		connect_to_region.return_value.get_all_groups.return_value = Page([group('web', ['i-2', 'i-3'])])
+		self.assertEquals(sync_autoscaling(self.inventory, 'eu-west-1'), 2)
+		get_instance_records.assert_called_with(['i-2', 'i-3'], region='eu-west-1')
+
+		instances = self.inventory.get_autoscaling_group_instances('eu-west-1', 'web')
+		self.assertEquals([(i.id, i.state) for i in instances], [('i-2', 'stopped'), ('i-3', 'stopped')])
+		self.assertEquals(sorted(self.inventory.instance_states('eu-west-1').keys()), ['i-2', 'i-3'])
+
+	def test_sync_skips_fresh_services(self):
+		sync_security_groups = Mock(return_value=0)
+		self.inventory.store_security_groups('eu-west-1', [])
+
+		with patch.dict('velvet.aws.inventory._sync_functions', {'ec2': sync_security_groups}):
+			synced = sync(regions=['eu-west-1', 'us-east-1'], services=['ec2'], max_age=60,
+						  inventory=self.inventory)
+		self.assertEquals(synced, {('eu-west-1', 'ec2'): None, ('us-east-1', 'ec2'): 0})
+		sync_security_groups.assert_called_once_with(self.inventory, 'us-east-1')
+
+	def store_stack(self, status):
+		self.inventory.store_stacks('eu-west-1', [('arn:web', 'web', status, '2014-01-01', {})], {
+			'web': [('WebGroup', 'web-group', 'AWS::AutoScaling::AutoScalingGroup', 'CREATE_COMPLETE')]})
+		self.inventory.store_autoscaling('eu-west-1', [('web-group', 1, ['i-1'])], [InstanceRecord('i-1', state='running')])
+
+	@patch('velvet.cloudformation.stack.get_stack')
+	def test_stack_instances_from_inventory(self, get_stack):
+		self.store_stack('UPDATE_COMPLETE')
+		with patch('velvet.aws.inventory.Inventory', return_value=self.inventory):
+			instances = cf.get_stack_autoscaling_group_instances('web', 'WebGroup', max_age=60, region='eu-west-1')
+		self.assertEquals([i.id for i in instances], ['i-1'])
+		self.assertFalse(get_stack.called)
+
+	@patch('velvet.cloudformation.stack.get_stack')
+	def test_stack_status_from_inventory(self, get_stack):
+		self.store_stack('UPDATE_IN_PROGRESS')
+		with patch('velvet.aws.inventory.Inventory', return_value=self.inventory):
+			with patch.dict('fabric.api.env', {'inventory_max_age': '60'}):
+				self.assertRaises(cf.StackNotReadyException, cf.get_stack_autoscaling_group_instances,
+								  'web', 'WebGroup', region='eu-west-1')
+		self.assertFalse(get_stack.called)
@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from velvet.cloudformation.lint import lint_template, template_digest, TemplateValidationCache
+
+TEMPLATE = {
+	'Parameters': {
+		'KeyName': {'Type': 'AWS::EC2::KeyPair::KeyName'},
+		'Size': {'Type': 'Number', 'Default': '2'},
+	},
+	'Resources': {
+		'Group': {
+			'Type': 'AWS::AutoScaling::AutoScalingGroup',
+			'Properties': {'MaxSize': {'Ref': 'Size'}, 'Region': {'Ref': 'AWS::Region'}},
+		},
+	},
+	'Outputs': {
+		'GroupName': {'Value': {'Ref': 'Group'}},
+	},
+}
+
+class TestLintTemplate(unittest.TestCase):
+
+	def test_valid(self):
+		self.assertEquals(lint_template(json.dumps(TEMPLATE), ['GroupName']), [])
+
+	def test_invalid_json(self):
+		errors = lint_template('{"Resources": ')
+		self.assertEquals(len(errors), 1)
+		self.assertTrue(errors[0].startswith('Invalid JSON'))
+
+	def test_all_errors(self):
+		template = json.loads(json.dumps(TEMPLATE))
+		template['Parameters']['Size']['Type'] = 'Integer'
+		template['Resources']['Group']['DependsOn'] = 'Missing'
+		template['Outputs']['GroupName'] = {'Value': {'Fn::GetAtt': ['Instance', 'PublicIp']}}
+		errors = lint_template(json.dumps(template), ['GroupName', 'LoadBalancer'])
+		self.assertEquals(errors, [
+			'Parameter Size: Unknown type Integer',
+			'Resource Group: DependsOn undefined resource Missing',
+			'Output GroupName: Fn::GetAtt on undefined resource Instance',
+			'Output LoadBalancer required by other stacks is not defined',
+		])
+
+	def test_warnings(self):
+		template = json.loads(json.dumps(TEMPLATE))
+		template['Transform'] = 'AWS::Serverless-2016-10-31'
+		template['Hooks'] = {}
+		template['Resources']['Group']['Properties']['Partition'] = {'Ref': 'AWS::Partition'}
+		template['Outputs']['Future'] = {'Value': {'Ref': 'AWS::Future'}}
+		warnings = []
+		self.assertEquals(lint_template(json.dumps(template), warnings=warnings), [])
+		self.assertEquals(sorted(warnings), [
+			'Output Future: Ref to unknown pseudo parameter AWS::Future',
+			'Unknown template section: Hooks',
+		])
+
+	def test_resource_limit(self):
+		template = json.loads(json.dumps(TEMPLATE))
+		for i in range(300):
+			template['Resources']['Queue%d' % i] = {'Type': 'AWS::SQS::Queue'}
+		self.assertEquals(lint_template(json.dumps(template), template_url=True), [])
+
+	def test_size_limit(self):
+		template = json.loads(json.dumps(TEMPLATE))
+		template['Description'] = 'x' * 60000
+		body = json.dumps(template)
+		self.assertEquals(len(lint_template(body)), 1)
+		self.assertEquals(lint_template(body, template_url=True), [])
+
+class TestTemplateValidationCache(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmp, 'validation.json')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_validation_cache(self):
+		cache = TemplateValidationCache(self.path)
+		digest = template_digest(json.dumps(TEMPLATE))
+		self.assertEquals(cache.get(digest, 'eu-west-1'), None)
+		cache.set(digest, Mock(description='Test stack', template_parameters=[], capabilities=[]), 'eu-west-1')
+		self.assertEquals(cache.get(digest, 'eu-west-1').description, 'Test stack')
+		self.assertEquals(cache.get(digest, 'us-east-1'), None)
+		self.assertEquals(TemplateValidationCache(self.path).get(digest, 'eu-west-1').description, 'Test stack')
+
+	def test_loaded_once(self):
+		cache = TemplateValidationCache(self.path)
+		cache.set('a', Mock(description='A', template_parameters=[], capabilities=[]), 'eu-west-1')
+		os.remove(self.path)
+		self.assertEquals(cache.get('a', 'eu-west-1').description, 'A')
+
+	def test_prunes_oldest(self):
+		cache = TemplateValidationCache(self.path, size=2, clock=Mock(side_effect=[1, 2, 3]))
+		for digest in ['a', 'b', 'c']:
+			cache.set(digest, Mock(description=digest, template_parameters=[], capabilities=[]), 'eu-west-1')
+		cache = TemplateValidationCache(self.path, size=2)
+		self.assertEquals(cache.get('a', 'eu-west-1'), None)
+		self.assertEquals(cache.get('c', 'eu-west-1').description, 'c')
@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+
+from velvet.cloudformation.manifest import StackManifest, stack_digest
+
+class TestStackManifest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.manifest = StackManifest(os.path.join(self.tmp, 'stacks.json'))
+		self.stack = Mock(stack_id='stack-id', last_updated_time='2014-09-20 10:00:00')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_digest(self):
+		digest = stack_digest('{}', [('Key', 'value')], {'Environment': 'dev'})
+		self.assertEquals(digest, stack_digest('{}', [('Key', 'value')], {'Environment': 'dev'}))
+		self.assertNotEquals(digest, stack_digest('{}', [('Key', 'other')], {'Environment': 'dev'}))
+		self.assertNotEquals(digest, stack_digest('{}', [('Key', 'value')], {'Environment': 'prod'}))
+
+	def test_unchanged(self):
+		self.manifest.record('eu-west-1/dev', 'abc', self.stack)
+		self.assertTrue(self.manifest.is_unchanged('eu-west-1/dev', 'abc', self.stack))
+		self.assertFalse(self.manifest.is_unchanged('eu-west-1/dev', 'def', self.stack))
+
+	def test_changed_outside_velvet(self):
+		self.manifest.record('eu-west-1/dev', 'abc', self.stack)
+		self.stack.last_updated_time = '2014-09-21 10:00:00'
+		self.assertFalse(self.manifest.is_unchanged('eu-west-1/dev', 'abc', self.stack))
+
+	def test_remove(self):
+		self.manifest.record('eu-west-1/dev', 'abc', self.stack)
+		self.manifest.remove('eu-west-1/dev')
+		self.assertFalse(self.manifest.has_digest('eu-west-1/dev', 'abc'))
@@ -0,0 +1,220 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from mock import Mock, patch
+
+import velvet.aws.opsworks
+import velvet.tasks.opsworks
+
+from velvet.tasks.opsworks import OpsWorksDeployment
+
+class Rule(object):
+
+	def __init__(self, ip_protocol, from_port, to_port, grants):
+		self.ip_protocol = ip_protocol
+		self.from_port = from_port
+		self.to_port = to_port
+		self.grants = grants
+
+def security_group(group_id, name, rules):
+	sg = Mock(id=group_id, vpc_id='vpc-1', rules=rules)
+	sg.name = name
+	return sg
+
+def grant(group_id=None, cidr_ip=None):
+	return Mock(group_id=group_id, cidr_ip=cidr_ip, owner_id='1')
+
+@patch('velvet.aws.opsworks.get_region', Mock(return_value='eu-west-1'))
+@patch('velvet.aws.opsworks.OpsWorks')
+class TestCleanupDefaultSecurityGroups(unittest.TestCase):
+
+	def setUp(self):
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+
+	def groups(self, OpsWorks):
+		groups = [
+			security_group('sg-1', 'AWS-OpsWorks-Web', [
+				Rule('tcp', '22', '22', [grant(cidr_ip='0.0.0.0/0'), grant(cidr_ip='10.0.0.0/8')]),
+				Rule('tcp', '80', '80', [grant(group_id='sg-2')]),
+			]),
+			security_group('sg-2', 'AWS-OpsWorks-Default', []),
+		]
+		opsworks = OpsWorks.return_value
+		opsworks.get_default_opsworks_security_groups.return_value = groups
+		opsworks.security_groups.get_many.return_value = {'sg-2': groups[1]}
+		return groups
+
+	def test_dry_run_output(self, OpsWorks):
+		self.groups(OpsWorks)
+		result = velvet.aws.opsworks.cleanup_default_security_groups(dry_run=True)
+
+		self.assertTrue(result)
+		lines = [line for line in sys.stdout.getvalue().split('\n') if line.startswith('-->') or
+				 line.startswith('+')]
+		self.assertEquals(lines[1:], [
+			'+ Cleanup security group: AWS-OpsWorks-Web',
+			'--> Revoke: 0.0.0.0/0 -> tcp(22-22) \x1b[33m[dry-run]\x1b[0m',
+			'--> Keep: 10.0.0.0/8 -> tcp(22-22)',
+			'--> Revoke: sg-2 (AWS-OpsWorks-Default) -> tcp(80-80) \x1b[33m[dry-run]\x1b[0m',
+			'+ Skip security group: AWS-OpsWorks-Default',
+		])
+
+	@patch('boto.ec2.connect_to_region')
+	def test_batched_revoke(self, connect_to_region, OpsWorks):
+		groups = self.groups(OpsWorks)
+		connect_to_region.return_value.get_status.return_value = True
+
+		result = velvet.aws.opsworks.cleanup_default_security_groups()
+
+		self.assertTrue(result)
+		self.assertEquals(connect_to_region.return_value.get_status.call_count, 1)
+		self.assertEquals([rule.grants for rule in groups[0].rules][0][0].cidr_ip, '10.0.0.0/8')
+		self.assertEquals(len(groups[0].rules), 1)
+
+class TestOpsWorksIdCache(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir = tempfile.mkdtemp()
+		self.cache = velvet.aws.opsworks.OpsWorksIdCache(os.path.join(self.tmp_dir, 'opsworks.json'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_output_keys_invalidate(self):
+		keys = {'stack': 'StackId', 'layer': 'WebLayerId', 'app': 'WebAppId'}
+		self.cache.set('eu-west-1', 'dev-opsworks', keys, {'stack_id': 'ops-1'})
+		self.assertEquals(self.cache.get('eu-west-1', 'dev-opsworks', keys), {'stack_id': 'ops-1'})
+		self.assertEquals(self.cache.get('eu-west-1', 'dev-opsworks', dict(keys, app='ApiAppId')), None)
+
+		self.cache.invalidate('eu-west-1', 'dev-opsworks')
+		self.assertEquals(self.cache.get('eu-west-1', 'dev-opsworks', keys), None)
+
+class TestResolveOpsWorksDeployment(unittest.TestCase):
+
+	def setUp(self):
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+
+	def connection(self, stack_id):
+		connection = Mock()
+		connection.describe_stacks.return_value = {'Stacks': [{'StackId': stack_id, 'Name': 'dev'}]}
+		connection.describe_layers.return_value = {'Layers': [{'LayerId': 'layer-1', 'Name': 'web'}]}
+		connection.describe_apps.return_value = {'Apps': [{'AppId': 'app-1', 'Name': 'app'}]}
+		connection.describe_instances.return_value = {'Instances': [
+			{'InstanceId': 'i-1', 'Status': 'online', 'Hostname': 'web1', 'InstanceType': 'm1.small',
+			 'PublicIp': '1.2.3.4'},
+			{'InstanceId': 'i-2', 'Status': 'stopped'},
+		]}
+		return connection
+
+	def test_resolve(self):
+		deploy = OpsWorksDeployment(self.connection('ops-1'))
+		resolved = deploy.resolve({'stack_id': 'ops-1', 'layer_id': 'layer-1', 'app_id': 'app-1'})
+		self.assertEquals(resolved['app']['AppId'], 'app-1')
+		deploy.connection.describe_instances.assert_called_once_with(layer_id='layer-1')
+
+	@patch('velvet.tasks.opsworks.get_region', Mock(return_value='eu-west-1'))
+	@patch('velvet.tasks.opsworks.OpsWorksIdCache')
+	@patch('velvet.tasks.opsworks._find_opsworks_stack')
+	@patch('velvet.tasks.opsworks.OpsWorksDeployment')
+	def test_stale_ids(self, OpsWorksDeployment, _find_opsworks_stack, OpsWorksIdCache):
+		stale = {'cloudformation_name': 'dev-opsworks', 'cloudformation_id': 'cf-1', 'stack_id': 'ops-old',
+				 'layer_id': 'layer-1', 'app_id': 'app-1'}
+		fresh = dict(stale, stack_id='ops-1')
+		_find_opsworks_stack.side_effect = [stale, fresh]
+		deploy = Mock()
+		deploy.resolve.side_effect = [None, {'stack': {'Name': 'dev'}, 'layer': {'Name': 'web'},
+											 'app': {'Name': 'app'},
+											 'instances': self.connection('ops-1').describe_instances()}]
+		OpsWorksDeployment.return_value = deploy
+
+		deploy, resolved, instance_ids = velvet.tasks.opsworks._resolve_opsworks_deployment('--> Deploy')
+
+		self.assertEquals(instance_ids, ['i-1'])
+		OpsWorksIdCache.return_value.invalidate.assert_called_once_with('eu-west-1', 'dev-opsworks')
+		_find_opsworks_stack.assert_called_with(cached=False)
+
+	@patch('velvet.tasks.opsworks.get_region', Mock(return_value='eu-west-1'))
+	@patch('velvet.tasks.opsworks.OpsWorksIdCache')
+	@patch('velvet.tasks.opsworks._find_opsworks_stack')
+	@patch('velvet.tasks.opsworks.OpsWorksDeployment')
+	def test_stack_deleted(self, OpsWorksDeployment, _find_opsworks_stack, OpsWorksIdCache):
+		_find_opsworks_stack.side_effect = [{'cloudformation_name': 'dev-opsworks', 'stack_id': 'ops-old'}, None]
+		OpsWorksDeployment.return_value.resolve.return_value = None
+
+		with self.assertRaises(Exception) as raised:
+			velvet.tasks.opsworks._resolve_opsworks_deployment('--> Deploy')
+		self.assertTrue('dev-opsworks' in str(raised.exception))
+		self.assertEquals(OpsWorksDeployment.return_value.resolve.call_count, 1)
+
+class TestRollingDeployment(unittest.TestCase):
+
+	def setUp(self):
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+		self.connection = Mock()
+		self.connection.create_deployment.side_effect = [{'DeploymentId': 'd-%d' % i} for i in range(1, 4)]
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+
+	def statuses(self, *statuses):
+		self.connection.describe_deployments.side_effect = [{'Deployments': [{'Status': status}]}
+															for status in statuses]
+
+	def test_batches(self):
+		self.statuses('running', 'successful', 'successful')
+		deploy = OpsWorksDeployment(self.connection)
+
+		result = deploy.rolling_deploy_app('ops-1', 'app-1', ['i-1', 'i-2', 'i-3'], '50%', sleep=Mock())
+
+		self.assertTrue(result)
+		self.assertEquals([d['DeploymentId'] for d in result.deployments], ['d-1', 'd-2'])
+		self.connection.create_deployment.assert_called_with('ops-1', command={'Name': 'deploy'}, app_id='app-1',
+															 comment=None, instance_ids=['i-3'])
+
+	def test_aborts_on_failure(self):
+		self.statuses('failed')
+		deploy = OpsWorksDeployment(self.connection)
+
+		result = deploy.rolling_deploy_app('ops-1', 'app-1', ['i-1', 'i-2', 'i-3'], 1, sleep=Mock())
+
+		self.assertFalse(result)
+		self.assertEquals(self.connection.create_deployment.call_count, 1)
+
+	def test_deploy_batch_option(self):
+		for batch_size in [None, '', 0, '0', False]:
+			with patch.dict('fabric.api.env', {'deploy_batch': batch_size}):
+				self.assertEquals(velvet.tasks.opsworks.get_deploy_batch(), None)
+		with patch.dict('fabric.api.env', {'deploy_batch': '25%'}):
+			self.assertEquals(velvet.tasks.opsworks.get_deploy_batch(), '25%')
+			self.assertEquals(velvet.tasks.opsworks.get_deploy_batch('0'), None)
+
+	@patch('velvet.tasks.opsworks._resolve_opsworks_deployment')
+	def test_app_deploy_wait_options(self, _resolve_opsworks_deployment):
+		deploy = Mock()
+		deploy.deploy_app.return_value = {'DeploymentId': 'd-1'}
+		resolved = {'stack': {'StackId': 'ops-1'}, 'app': {'AppId': 'app-1'}}
+		_resolve_opsworks_deployment.return_value = (deploy, resolved, ['i-1', 'i-2'])
+
+		with patch.dict('fabric.api.env', {'deploy_batch': 1, 'deploy_wait': {'interval': 5, 'timeout': '600'}}):
+			velvet.tasks.opsworks.app_deploy()
+		deploy.rolling_deploy_app.assert_called_once_with('ops-1', 'app-1', ['i-1', 'i-2'], 1, comment=None,
+														  interval=5.0, timeout=600.0)
+
+		with patch.dict('fabric.api.env', {'deploy_batch': '0'}):
+			velvet.tasks.opsworks.app_deploy()
+		self.assertEquals(deploy.rolling_deploy_app.call_count, 1)
+		self.assertEquals(deploy.deploy_app.call_count, 1)
@@ -0,0 +1,63 @@
+import unittest
+
+from velvet.cloudformation.poller import StackPoller, ExponentialBackoff, FixedInterval, \
+	PollTimeoutException, create_poller
+
+class FakeClock(object):
+
+	def __init__(self):
+		self.now = 0.0
+		self.sleeps = []
+
+	def time(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.sleeps.append(seconds)
+		self.now += seconds
+
+
+class TestExponentialBackoff(unittest.TestCase):
+
+	def test_backoff_and_reset(self):
+		strategy = ExponentialBackoff(min_interval=2, max_interval=10, multiplier=2, jitter=0)
+		self.assertEquals([strategy.next_interval() for i in range(5)], [2, 4, 8, 10, 10])
+		strategy.reset()
+		self.assertEquals(strategy.next_interval(), 2)
+
+	def test_jitter_within_bounds(self):
+		strategy = ExponentialBackoff(min_interval=10, max_interval=10, jitter=0.5)
+		for i in range(20):
+			interval = strategy.next_interval()
+			self.assertTrue(5 <= interval <= 15)
+
+
+class TestStackPoller(unittest.TestCase):
+
+	def test_phases_and_polls(self):
+		clock = FakeClock()
+		poller = StackPoller(FixedInterval(5), clock=clock.time, sleep=clock.sleep)
+		poller.observe('CREATE_IN_PROGRESS')
+		poller.wait()
+		poller.observe('CREATE_IN_PROGRESS')
+		poller.wait()
+		poller.observe('CREATE_COMPLETE')
+		poller.finish()
+		self.assertEquals(poller.polls, 3)
+		self.assertEquals(poller.phases['CREATE_IN_PROGRESS'], 10)
+		self.assertEquals(poller.phases['CREATE_COMPLETE'], 0)
+
+	def test_timeout(self):
+		clock = FakeClock()
+		poller = StackPoller(FixedInterval(5), timeout=7, clock=clock.time, sleep=clock.sleep)
+		poller.observe('CREATE_IN_PROGRESS')
+		poller.wait()
+		poller.wait()
+		self.assertEquals(clock.sleeps, [5, 2])
+		self.assertRaises(PollTimeoutException, poller.wait)
+
+	def test_create_poller(self):
+		poller = create_poller({'strategy': 'fixed', 'interval': 3, 'timeout': 60})
+		self.assertEquals(poller.strategy.interval, 3)
+		self.assertEquals(poller.timeout, 60)
+		self.assertRaises(ValueError, create_poller, {'strategy': 'unknown'})
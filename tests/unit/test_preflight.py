@@ -0,0 +1,83 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from mock import Mock, patch
+
+from velvet.cloudformation.lint import TemplateValidationCache
+from velvet.cloudformation.preflight import preflight_stacks
+
+TEMPLATE = {
+	'Resources': {
+		'Vpc': {'Type': 'AWS::EC2::VPC', 'Properties': {'CidrBlock': '10.0.0.0/16'}},
+	},
+	'Outputs': {
+		'VpcId': {'Value': {'Ref': 'Vpc'}},
+	},
+}
+
+class TestPreflight(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.template_file = os.path.join(self.tmp, 'dev-vpc.json')
+		with open(self.template_file, 'w') as f:
+			json.dump(TEMPLATE, f)
+
+		self.stdout = sys.stdout
+		sys.stdout = StringIO()
+
+	def tearDown(self):
+		sys.stdout = self.stdout
+		shutil.rmtree(self.tmp)
+
+	@patch('velvet.cloudformation.preflight.TemplateValidationCache')
+	@patch('velvet.cloudformation.stack.validate_template')
+	def test_valid(self, validate_template, cache):
+		stacks = [{'name': 'dev-network', 'outputs': ['VpcId']}]
+		result = preflight_stacks(stacks, {'dev-network': self.template_file})
+		self.assertTrue(result)
+		self.assertEquals(validate_template.call_count, 1)
+
+	@patch('velvet.cloudformation.preflight.TemplateValidationCache')
+	@patch('velvet.cloudformation.stack.boto.cloudformation.connect_to_region')
+	def test_missing_output_and_template(self, connect_to_region, cache):
+		stacks = [
+			{'name': 'dev-network', 'outputs': ['VpcId', 'SubnetId']},
+			{'name': 'dev-database'},
+		]
+		result = preflight_stacks(stacks, {
+			'dev-network': self.template_file,
+			'dev-database': os.path.join(self.tmp, 'dev-rds.json'),
+		})
+		self.assertFalse(result)
+		self.assertEquals(result.failed, ['dev-network', 'dev-database'])
+		self.assertEquals(result.errors['dev-network'], ['Output SubnetId required by other stacks is not defined'])
+		self.assertFalse(connect_to_region.return_value.validate_template.called)
+
+	@patch('velvet.cloudformation.preflight.TemplateUploader')
+	@patch('velvet.cloudformation.stack.boto.cloudformation.connect_to_region')
+	def test_large_template_validated_before(self, connect_to_region, TemplateUploader):
+		template = json.loads(json.dumps(TEMPLATE))
+		template['Description'] = 'x' * 60000
+		body = json.dumps(template)
+		TemplateUploader.return_value.render.return_value = (body, [('dev-vpc.json', body)])
+		TemplateUploader.return_value.upload_all.return_value = ['https://s3.amazonaws.com/templates/dev-vpc.json']
+		connect_to_region.return_value.validate_template.return_value = Mock(description='VPC', template_parameters=[],
+																					   capabilities=[])
+
+		cache = TemplateValidationCache(os.path.join(self.tmp, 'validation.json'))
+		with patch('velvet.cloudformation.preflight.TemplateValidationCache', Mock(return_value=cache)):
+			stacks = [{'name': 'dev-network', 'outputs': ['VpcId']}]
+			for i in range(2):
+				result = preflight_stacks(stacks, {'dev-network': self.template_file}, template_bucket='templates')
+				self.assertEquals(result.errors['dev-network'], [])
+
+		# the second run finds the template in the cache and skips the upload and the API call
+		self.assertEquals(TemplateUploader.return_value.upload_all.call_count, 1)
+		self.assertEquals(connect_to_region.return_value.validate_template.call_count, 1)
@@ -0,0 +1,65 @@
+import unittest
+
+from mock import Mock, patch
+
+from velvet.cloudformation.roles import RoleSpec, resolve_roles
+from velvet.ec2 import InstanceRecord
+
+class View(object):
+
+	def __init__(self, physical_ids, outputs):
+		self.physical_ids = physical_ids
+		self.outputs = outputs
+		self.resources = physical_ids
+
+	def get_physical_id(self, logical_id):
+		return self.physical_ids.get(logical_id)
+
+	def match_outputs(self, match):
+		return [value for key, value in sorted(self.outputs.items()) if key.startswith(match)]
+
+def group(name, instance_ids):
+	g = Mock(instances=[Mock(instance_id=i) for i in instance_ids])
+	g.name = name
+	return g
+
+@patch('velvet.cloudformation.stack.validate_stack')
+@patch('velvet.cloudformation.stack.get_stack')
+@patch('velvet.cloudformation.stack.get_stack_view')
+@patch('velvet.ec2.get_autoscaling_groups')
+@patch('velvet.ec2.get_instance_records')
+class TestResolveRoles(unittest.TestCase):
+
+	def test_batches_groups_and_instances(self, get_instance_records, get_autoscaling_groups, get_stack_view,
+										  get_stack, validate_stack):
+		get_stack_view.return_value = View({'WebGroup': 'web-asg', 'WorkerGroup': 'worker-asg'},
+										   {'DatabaseHost': 'db.local'})
+		get_autoscaling_groups.return_value = {'web-asg': group('web-asg', ['i-1', 'i-2']),
+											   'worker-asg': group('worker-asg', ['i-3'])}
+		get_instance_records.return_value = [
+			InstanceRecord('i-1', state='running', private_ip_address='10.0.0.1'),
+			InstanceRecord('i-2', state='terminated', private_ip_address='10.0.0.2'),
+			InstanceRecord('i-3', state='running', private_ip_address='10.0.0.3'),
+		]
+
+		roles = resolve_roles([
+			RoleSpec('web', 'dev-app', resource='WebGroup', region='eu-west-1'),
+			RoleSpec('worker', 'dev-app', resource='WorkerGroup', region='eu-west-1'),
+			RoleSpec('db', 'dev-app', outputs='Database', region='eu-west-1'),
+		], address='private_ip')
+
+		self.assertEquals(roles, {'web': ['10.0.0.1'], 'worker': ['10.0.0.3'], 'db': ['db.local']})
+		self.assertEquals(get_stack.call_count, 1)
+		get_autoscaling_groups.assert_called_once_with(['web-asg', 'worker-asg'], region='eu-west-1')
+		self.assertEquals(get_instance_records.call_count, 1)
+
+	def test_unknown_address(self, get_instance_records, get_autoscaling_groups, get_stack_view, get_stack,
+							 validate_stack):
+		self.assertRaises(ValueError, resolve_roles, [], address='elastic_ip')
+
+class TestRoleSpec(unittest.TestCase):
+
+	def test_resource_or_outputs(self):
+		self.assertRaises(ValueError, RoleSpec.from_config, 'web', {'stack': 'dev-app'})
+		spec = RoleSpec.from_config('web', {'stack': 'dev-app', 'resource': 'WebGroup', 'region': 'us-east-1'})
+		self.assertEquals(spec.region, 'us-east-1')
@@ -0,0 +1,137 @@
+import unittest
+
+from mock import Mock, patch
+
+from velvet.security import IngressGrant, IngressPlan, SecurityGroupIndex, _ingress_params, apply_ingress, \
+	ingress_grants, plan_ingress
+
+def security_group(group_id, name):
+	sg = Mock(id=group_id, rules=[])
+	sg.name = name
+	return sg
+
+class TestSecurityGroupIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.groups = [security_group('sg-1', 'web'), security_group('sg-2', 'database')]
+		self.connection = Mock()
+
+		def get_all_security_groups(filters=None):
+			if filters is None:
+				return self.groups
+			key, values = filters.items()[0]
+			attribute = 'id' if key == 'group-id' else 'name'
+			return [sg for sg in self.groups if getattr(sg, attribute) in values]
+		self.connection.get_all_security_groups.side_effect = get_all_security_groups
+
+		self.index = SecurityGroupIndex('eu-west-1', connection=self.connection)
+
+	def test_filters_by_id_and_name(self):
+		groups = self.index.get_many(['sg-1', 'database', 'missing'])
+		self.assertEquals(groups['sg-1'].name, 'web')
+		self.assertEquals(groups['database'].id, 'sg-2')
+		self.assertEquals(groups['missing'], None)
+		self.connection.get_all_security_groups.assert_any_call(filters={'group-id': ['sg-1']})
+		self.connection.get_all_security_groups.assert_any_call(filters={'group-name': ['database', 'missing']})
+
+		# both groups are indexed by id and name
+		self.assertEquals(self.index.get('web').id, 'sg-1')
+		self.assertEquals(self.index.get('sg-2').name, 'database')
+		self.assertEquals(self.connection.get_all_security_groups.call_count, 2)
+
+	def test_load_answers_misses(self):
+		self.index.load()
+		self.assertEquals(self.index.get('sg-2').name, 'database')
+		self.assertEquals(self.index.get('missing'), None)
+		self.assertEquals(self.connection.get_all_security_groups.call_count, 1)
+
+	def test_invalidate(self):
+		self.index.get('web')
+		self.index.invalidate('web')
+		self.index.get('sg-1')
+		self.assertEquals(self.connection.get_all_security_groups.call_count, 2)
+
+class Rule(object):
+
+	def __init__(self, ip_protocol, from_port, to_port, grants):
+		self.ip_protocol = ip_protocol
+		self.from_port = from_port
+		self.to_port = to_port
+		self.grants = grants
+
+def grant(group_id=None, cidr_ip=None):
+	return Mock(group_id=group_id, cidr_ip=cidr_ip)
+
+@patch('velvet.security.get_security_groups')
+class TestIngress(unittest.TestCase):
+
+	def setUp(self):
+		self.rds = security_group('sg-rds', 'rds')
+		self.rds.vpc_id = 'vpc-1'
+		self.rds.rules = [Rule('tcp', '3306', '3306', [grant('sg-web')])]
+		self.web = security_group('sg-web', 'web')
+		self.worker = security_group('sg-worker', 'worker')
+
+	def test_plan(self, get_security_groups):
+		get_security_groups.return_value = {'rds': self.rds}
+		desired = {'rds': [('tcp', 3306, 3306, self.web), ('tcp', 3306, 3306, self.worker)]}
+
+		plan = plan_ingress(desired)[0]
+		self.assertEquals(plan.authorize, [IngressGrant('tcp', 3306, 3306, 'sg-worker')])
+		self.assertEquals(plan.revoke, [])
+
+		plan = plan_ingress(desired, revoke=True)[0]
+		self.assertEquals(plan.authorize, [])
+		self.assertEquals(plan.revoke, [IngressGrant('tcp', 3306, 3306, 'sg-web')])
+		self.assertEquals(plan.missing, [IngressGrant('tcp', 3306, 3306, 'sg-worker')])
+		self.assertEquals(plan.source_name(plan.missing[0]), 'worker')
+
+	def test_batched_params(self, get_security_groups):
+		grants = [IngressGrant('tcp', 3306, 3306, 'sg-web'), IngressGrant('tcp', 3306, 3306, 'sg-worker'),
+				  IngressGrant('tcp', 80, 80, '10.0.0.0/8')]
+		params = _ingress_params(self.rds, grants, {})
+		self.assertEquals(params, {
+			'GroupId': 'sg-rds',
+			'IpPermissions.1.IpProtocol': 'tcp',
+			'IpPermissions.1.FromPort': '3306',
+			'IpPermissions.1.ToPort': '3306',
+			'IpPermissions.1.Groups.1.GroupId': 'sg-web',
+			'IpPermissions.1.Groups.2.GroupId': 'sg-worker',
+			'IpPermissions.2.IpProtocol': 'tcp',
+			'IpPermissions.2.FromPort': '80',
+			'IpPermissions.2.ToPort': '80',
+			'IpPermissions.2.IpRanges.1.CidrIp': '10.0.0.0/8',
+		})
+
+	def test_all_protocols_without_ports(self, get_security_groups):
+		params = _ingress_params(self.rds, [IngressGrant('-1', None, None, 'sg-web')], {})
+		self.assertEquals(params, {
+			'GroupId': 'sg-rds',
+			'IpPermissions.1.IpProtocol': '-1',
+			'IpPermissions.1.Groups.1.GroupId': 'sg-web',
+		})
+
+	@patch('boto.ec2.connect_to_region')
+	def test_apply_updates_rules(self, connect_to_region, get_security_groups):
+		connect_to_region.return_value.get_status.return_value = True
+		plan = IngressPlan(self.rds, revoke=[IngressGrant('tcp', 3306, 3306, 'sg-web')])
+
+		result = apply_ingress([plan], region='eu-west-1')
+		self.assertTrue(result)
+		self.assertEquals(connect_to_region.return_value.get_status.call_count, 1)
+		self.assertEquals(self.rds.rules, [])
+
+	@patch('boto.ec2.connect_to_region')
+	def test_apply_keeps_rules_without_ports(self, connect_to_region, get_security_groups):
+		connect_to_region.return_value.get_status.return_value = True
+		all_traffic = IngressGrant('-1', None, None, 'sg-worker')
+
+		def add_rule(ip_protocol, from_port, to_port, name, owner_id, cidr_ip, group_id):
+			self.rds.rules.append(Rule(ip_protocol, from_port, to_port, [grant(group_id, cidr_ip)]))
+		self.rds.add_rule = add_rule
+
+		self.assertTrue(apply_ingress([IngressPlan(self.rds, authorize=[all_traffic])], region='eu-west-1'))
+		self.assertTrue(all_traffic in ingress_grants(self.rds))
+
+		get_security_groups.return_value = {'rds': self.rds}
+		self.assertFalse(plan_ingress({'rds': [all_traffic]})[0])
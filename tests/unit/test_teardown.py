@@ -0,0 +1,123 @@
+import unittest
+
+from boto.cloudformation.stack import Stack
+from mock import Mock, patch
+
+from velvet.cloudformation.graph import StackGraph
+from velvet.cloudformation.teardown import StackTeardown, delete_stacks
+from velvet.cloudformation.waiter import StackFuture
+
+STACKS = [
+	{'name': 'network', 'template': 'vpc', 'outputs': ['VpcId', 'SubnetId']},
+	{'name': 'database', 'template': 'rds', 'outputs': ['DatabaseHost']},
+	{'name': 'cache', 'template': 'cache', 'outputs': ['CacheHost']},
+	{'name': 'app', 'template': 'opsworks'},
+	{'name': 'workers', 'template': 'workers', 'depends_on': 'app'},
+]
+
+PARAMETERS = {
+	'network': set(),
+	'database': set(['VpcId', 'SubnetId']),
+	'cache': set(['VpcId']),
+	'app': set(['VpcId', 'DatabaseHost', 'CacheHost']),
+	'workers': set(['SubnetId']),
+}
+
+WAIT = {'strategy': 'fixed', 'interval': 0}
+
+def boto_stack(name, status):
+	s = Stack()
+	s.stack_id = 'arn:aws:cloudformation:eu-west-1:1:stack/%s/1' % name
+	s.stack_name = name
+	s.stack_status = status
+	return s
+
+class FakeWaiter(object):
+	"""
+	Resolves the deletions immediately with the final status of each stack
+	"""
+
+	def __init__(self, final_statuses):
+		self.final_statuses = final_statuses
+		self.watched = []
+
+	def watch(self, stack_id, statuses, stack=None, wait=None):
+		name = stack_id.split('/')[1]
+		self.watched.append(name)
+		future = StackFuture(stack_id, statuses)
+		future._update(boto_stack(name, self.final_statuses.get(name, 'DELETE_COMPLETE')))
+		return future
+
+	def cancel(self, future):
+		pass
+
+@patch('velvet.cloudformation.teardown.StackEventRecorder', Mock())
+@patch('velvet.cloudformation.stack.StackEventStream', Mock(**{'return_value.new_events.return_value': []}))
+@patch('velvet.cloudformation.stack.StackManifest', Mock())
+class TestStackTeardown(unittest.TestCase):
+
+	def setUp(self):
+		self.graph = StackGraph(STACKS, PARAMETERS)
+		self.statuses = dict([(name, 'CREATE_COMPLETE') for name in PARAMETERS])
+		self.deleted = []
+		self.connection = Mock()
+		self.connection.region.name = 'eu-west-1'
+		self.connection.describe_stacks.side_effect = lambda name: [boto_stack(name, self.statuses[name])]
+
+		def delete_stack(name):
+			self.deleted.append(name)
+			return True
+		self.connection.delete_stack.side_effect = delete_stack
+
+	def teardown(self, waiter, **kwargs):
+		with patch('velvet.cloudformation.teardown.get_waiter', Mock(return_value=waiter)):
+			teardown = StackTeardown(self.graph, wait=WAIT, connection=self.connection, region='eu-west-1', **kwargs)
+		return teardown.run()
+
+	def test_reverse_dependency_order(self):
+		waiter = FakeWaiter({})
+		result = self.teardown(waiter, max_concurrent=2)
+
+		self.assertTrue(result)
+		self.assertEquals(sorted(self.deleted), sorted(PARAMETERS))
+		for name in self.deleted:
+			for dependent, dependencies in self.graph.dependencies.iteritems():
+				if name in dependencies:
+					self.assertTrue(self.deleted.index(dependent) < self.deleted.index(name),
+									'%s deleted before %s depending on it' % (name, dependent))
+
+	def test_shared_waiter(self):
+		waiter = FakeWaiter({})
+		self.teardown(waiter)
+		self.assertEquals(sorted(waiter.watched), sorted(PARAMETERS))
+
+	def test_failed_delete_keeps_dependencies(self):
+		result = self.teardown(FakeWaiter({'app': 'DELETE_FAILED'}))
+
+		self.assertFalse(result)
+		self.assertEquals(result.failed, ['app'])
+		self.assertEquals(sorted(result.skipped), ['cache', 'database', 'network'])
+		self.assertEquals(sorted(self.deleted), ['app', 'workers'])
+
+	def test_failed_stacks_kept_by_default(self):
+		self.statuses['workers'] = 'CREATE_FAILED'
+		result = self.teardown(FakeWaiter({}))
+
+		self.assertEquals(result.failed, ['workers'])
+		self.assertEquals(sorted(result.skipped), ['app', 'cache', 'database', 'network'])
+		self.assertEquals(self.deleted, [])
+
+	def test_delete_failed_stacks(self):
+		self.statuses['workers'] = 'CREATE_FAILED'
+		result = self.teardown(FakeWaiter({}), delete_failed_stacks=True)
+
+		self.assertTrue(result)
+		self.assertEquals(self.deleted[0], 'workers')
+
+	@patch('boto.cloudformation.connect_to_region')
+	def test_delete_stacks(self, connect_to_region):
+		connect_to_region.return_value = self.connection
+		with patch('velvet.cloudformation.teardown.get_waiter', Mock(return_value=FakeWaiter({}))) as get_waiter:
+			result = delete_stacks(self.graph, wait=WAIT, region='eu-west-1')
+		self.assertTrue(result)
+		get_waiter.assert_called_once_with('eu-west-1')
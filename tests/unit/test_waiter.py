@@ -0,0 +1,102 @@
+import threading
+import unittest
+
+from mock import Mock
+
+from velvet.cloudformation.waiter import StackWaiter, PROVISION_WAIT_STATUSES, DELETE_WAIT_STATUSES
+
+class StackPage(list):
+
+	def __init__(self, stacks, next_token=None):
+		list.__init__(self, stacks)
+		self.next_token = next_token
+
+def stack(stack_id, status):
+	return Mock(stack_id=stack_id, stack_status=status)
+
+class TestStackWaiter(unittest.TestCase):
+
+	def setUp(self):
+		self.connection = Mock()
+		self.waiter = StackWaiter('eu-west-1', connection=self.connection, autostart=False)
+
+	def test_describes_few_stacks_individually(self):
+		future = self.waiter.watch('a', PROVISION_WAIT_STATUSES)
+		self.connection.describe_stacks.return_value = [stack('a', 'CREATE_IN_PROGRESS')]
+		self.waiter.poll()
+		self.assertFalse(future.done())
+
+		self.connection.describe_stacks.return_value = [stack('a', 'CREATE_COMPLETE')]
+		self.waiter.poll()
+		self.assertEquals(future.result(0).stack_status, 'CREATE_COMPLETE')
+		self.connection.describe_stacks.assert_called_with('a')
+
+	def test_lists_stacks_in_progress(self):
+		callback = Mock()
+		a = self.waiter.watch('a', PROVISION_WAIT_STATUSES)
+		b = self.waiter.watch('b', DELETE_WAIT_STATUSES)
+		c = self.waiter.watch('c', PROVISION_WAIT_STATUSES)
+		b.add_done_callback(callback)
+
+		def list_stacks(statuses, next_token=None):
+			self.assertEquals(statuses, sorted(PROVISION_WAIT_STATUSES + DELETE_WAIT_STATUSES))
+			if next_token is None:
+				return StackPage([stack('a', 'UPDATE_IN_PROGRESS'), stack('x', 'CREATE_IN_PROGRESS')], 'page-2')
+			return StackPage([stack('c', 'CREATE_IN_PROGRESS')])
+
+		self.connection.list_stacks.side_effect = list_stacks
+		self.connection.describe_stacks.return_value = [stack('b', 'DELETE_COMPLETE')]
+		self.waiter.poll()
+
+		# two pages of the stacks in progress and the deleted stack by its id
+		self.assertEquals(self.connection.list_stacks.call_count, 2)
+		self.connection.describe_stacks.assert_called_once_with('b')
+		self.assertFalse(a.done())
+		self.assertTrue(b.done())
+		self.assertFalse(c.done())
+		callback.assert_called_once_with(b)
+
+	def test_cancel(self):
+		future = self.waiter.watch('a', PROVISION_WAIT_STATUSES)
+		self.waiter.cancel(future)
+		self.waiter.poll()
+		self.assertFalse(self.connection.describe_stacks.called)
+
+	def test_describes_each_stack_without_threshold(self):
+		waiter = StackWaiter('eu-west-1', connection=self.connection, list_threshold=None, autostart=False)
+		for stack_id in ['a', 'b', 'c']:
+			waiter.watch(stack_id, PROVISION_WAIT_STATUSES)
+		self.connection.describe_stacks.side_effect = lambda stack_id: [stack(stack_id, 'CREATE_IN_PROGRESS')]
+		waiter.poll()
+		self.assertEquals(sorted([c[0][0] for c in self.connection.describe_stacks.call_args_list]), ['a', 'b', 'c'])
+
+	def test_interval_follows_wait_strategies(self):
+		fixed = {'strategy': 'fixed', 'interval': 20}
+		backoff = {'min_interval': 2, 'max_interval': 8, 'multiplier': 2, 'jitter': 0}
+		self.waiter.watch('a', PROVISION_WAIT_STATUSES, wait=fixed)
+		self.assertEquals(self.waiter.next_interval(), 20)
+
+		future = self.waiter.watch('b', PROVISION_WAIT_STATUSES, stack('b', 'CREATE_IN_PROGRESS'), wait=backoff)
+		self.assertEquals([self.waiter.next_interval() for i in range(4)], [2, 4, 8, 8])
+
+		# a status change follows the stack closely again
+		future._update(stack('b', 'UPDATE_IN_PROGRESS'))
+		self.assertEquals(self.waiter.next_interval(), 2)
+
+	def test_wakes_up_for_stacks_followed_during_poll(self):
+		waiter = StackWaiter('eu-west-1', connection=self.connection, list_threshold=None, autostart=False)
+		waiter.watch('a', PROVISION_WAIT_STATUSES, wait={'strategy': 'fixed', 'interval': 60})
+
+		def describe_stacks(stack_id):
+			if stack_id == 'a':
+				waiter.watch('b', PROVISION_WAIT_STATUSES, wait={'strategy': 'fixed', 'interval': 60})
+				return [stack('a', 'CREATE_COMPLETE')]
+			waiter.cancel(waiter._futures[0])
+			return [stack('b', 'CREATE_COMPLETE')]
+
+		self.connection.describe_stacks.side_effect = describe_stacks
+		thread = threading.Thread(target=waiter._run)
+		thread.daemon = True
+		thread.start()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
@@ -1,53 +1,345 @@
-import velvet.cloudformation as cf
+import velvet.cloudformation.stack as cf
 import velvet.ec2 as ec2
 
-# from cf import validate_stack, get_stack_autoscaling_group
-# from velvet.ec2 import get_autoscaling_group_instance_ids, get_instances
+import boto.ec2.autoscale
+from fabric.api import env
 
-from time import sleep
+from velvet.aws.config import get_region
+from velvet.pool import parallel_map
+
+import math
+import time
 
 import datetime
 import dateutil.parser
 
-def recycle_instance(instance):
-    if instance.state != 'running':
+# Instances recycled at a time when not configured
+RECYCLE_BATCH_SIZE = 1
+
+# Seconds to wait for the group to return to desired capacity after each batch
+RECYCLE_TIMEOUT = 1800
+
+# Seconds between the group capacity checks
+RECYCLE_INTERVAL = 10
+
+# Instances added by the capacity guard when not configured
+CAPACITY_SURGE = 1
+
+
+class RecycleResult(object):
+
+    def __init__(self):
+        self.recycled = []
+        self.error = None
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    def __nonzero__(self):
+        return self.succeeded
+
+
+def terminate_instance(instance_id, region=None):
+    """
+    Terminate an autoscaling instance without decrementing the desired
+    capacity, the group launches a replacement
+    :type instance_id: str
+    :type region: str
+    :rtype: str
+    """
+    # connections are not shared between the threads
+    autoscale = boto.ec2.autoscale.connect_to_region(get_region(region))
+    autoscale.terminate_instance(instance_id, decrement_capacity=False)
+    return instance_id
+
+
+def get_batch_size(batch_size, capacity):
+    """
+    Number of instances in a recycle batch
+    :type batch_size: int or str
+    :param batch_size: Number of instances or a percentage of the capacity, eg. 25%
+    :type capacity: int
+    :rtype: int
+    """
+    if isinstance(batch_size, basestring) and batch_size.strip().endswith('%'):
+        percent = float(batch_size.strip()[:-1])
+        return max(1, int(math.ceil(capacity * percent / 100)))
+    return max(1, int(batch_size))
+
+
+class RollingRecycler(object):
+    """
+    Replaces the instances of an autoscaling group in batches.
+
+    The running instances of a batch are terminated together without
+    decrementing the desired capacity, and the next batch starts only after
+    the group is back to its desired capacity with healthy, running
+    replacements. The instance states of a batch and of the replacements
+    are each checked with a single describe_instances call.
+    """
+
+    def __init__(self, group_name, region=None, batch_size=RECYCLE_BATCH_SIZE, timeout=RECYCLE_TIMEOUT,
+                 interval=RECYCLE_INTERVAL, clock=time.time, sleep=time.sleep):
+        """
+        :type group_name: str
+        :type region: str
+        :type batch_size: int or str
+        :param batch_size: Number of instances or a percentage of the desired capacity, eg. 25%
+        :type timeout: float
+        :param timeout: Seconds to wait for the replacements of each batch
+        :type interval: float
+        """
+        self.group_name = group_name
+        self.region = get_region(region)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+
+    def _group(self):
+        return _get_group(self.group_name, self.region)
+
+    def _terminate(self, instance_id):
+        return terminate_instance(instance_id, region=self.region)
+
+    def recycle(self, instance_ids=None):
+        """
+        :type instance_ids: list
+        :param instance_ids: Instances to recycle, all the instances in the group by default
+        :rtype: RecycleResult
+        """
+        result = RecycleResult()
+        group = self._group()
+        if instance_ids is None:
+            instance_ids = ec2.get_autoscaling_group_instance_ids(group)
+        size = get_batch_size(self.batch_size, group.desired_capacity)
+        retired = set()
+
+        for start in range(0, len(instance_ids), size):
+            batch = instance_ids[start:start + size]
+            running = [i for i in ec2.get_instance_records(batch, region=self.region) if i.state == 'running']
+            for i in running:
+                print "*** Recycle %s | %s | %s" % (i.name, i.id, i.public_dns_name)
+
+            terminated = parallel_map(self._terminate, [i.id for i in running])
+            result.recycled.extend(terminated)
+            # instances not running, eg. pending, were not terminated and count towards the capacity
+            retired.update(terminated)
+
+            if not self.wait_for_capacity(retired):
+                result.error = 'Timed out waiting for %s to return to desired capacity' % self.group_name
+                return result
+            ec2.invalidate_autoscaling_group(self.group_name, region=self.region)
+
+        return result
+
+    def wait_for_capacity(self, retired=()):
+        """
+        Wait until the group has as many healthy, running instances as its desired capacity
+        :type retired: set
+        :param retired: Instances being replaced
+        :rtype: bool
+        :return: False if timed out
+        """
+        return wait_for_capacity(self.group_name, self.region, retired=retired, timeout=self.timeout,
+                                 interval=self.interval, clock=self.clock, sleep=self.sleep)
+
+
+class CapacityException(Exception):
+    pass
+
+
+class CapacityGuard(object):
+    """
+    Context manager adding surge capacity to an autoscaling group for the
+    duration of a deploy or a recycle.
+
+    On enter the desired capacity, and the maximum size if needed, are
+    raised by the surge and the block runs once the new instances are in
+    service. On exit the original desired capacity and maximum size are
+    restored, also when the block fails.
+    """
+
+    def __init__(self, group_name, region=None, surge=CAPACITY_SURGE, timeout=RECYCLE_TIMEOUT,
+                 interval=RECYCLE_INTERVAL, clock=time.time, sleep=time.sleep):
+        """
+        :type group_name: str
+        :type region: str
+        :type surge: int or str
+        :param surge: Number of instances or a percentage of the desired capacity, eg. 50%
+        :type timeout: float
+        :param timeout: Seconds to wait for the surge instances
+        """
+        self.group_name = group_name
+        self.region = get_region(region)
+        self.surge = surge
+        self.timeout = timeout
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.desired_capacity = None
+        self.max_size = None
+
+    def __enter__(self):
+        group = _get_group(self.group_name, self.region)
+        self.desired_capacity = group.desired_capacity
+        self.max_size = group.max_size
+
+        desired_capacity = group.desired_capacity + get_batch_size(self.surge, group.desired_capacity)
+        print "*** %s: raise desired capacity %d -> %d" % (self.group_name, self.desired_capacity,
+                                                          desired_capacity)
+        self._update(desired_capacity, max(group.max_size, desired_capacity))
+
+        try:
+            if not wait_for_capacity(self.group_name, self.region, timeout=self.timeout, interval=self.interval,
+                                     clock=self.clock, sleep=self.sleep):
+                raise CapacityException('Timed out waiting for %s to reach desired capacity %d' % (
+                    self.group_name, desired_capacity))
+        except:
+            self.restore()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.restore()
         return False
-    print instance.tags['Name'] + " | " + instance.id + " | " + instance.public_dns_name
-    instance.stop()
-    instance.update()
-    while instance.state == 'shutting-down':
-        time.sleep(5)
-        instance.update()
-    print "Instance terminated"
-    return True
+
+    def restore(self):
+        """
+        Restore the original desired capacity and maximum size
+        """
+        if self.desired_capacity is None:
+            return
+        print "*** %s: restore desired capacity %d" % (self.group_name, self.desired_capacity)
+        self._update(self.desired_capacity, self.max_size)
+        self.desired_capacity = None
+
+    def _update(self, desired_capacity, max_size):
+        group = _get_group(self.group_name, self.region)
+        group.desired_capacity = desired_capacity
+        group.max_size = max_size
+        group.update()
+        ec2.invalidate_autoscaling_group(self.group_name, region=self.region)
+
+
+def _get_group(group_name, region):
+    group = ec2.get_autoscaling_group(group_name, region=region, cached=False)
+    if group is None:
+        raise ValueError('Autoscaling group not found: ' + group_name)
+    return group
+
+
+def healthy_instance_ids(group, retired=()):
+    """
+    Instances in service and healthy, excluding the retired instances
+    :type group: boto.ec2.autoscale.group.AutoScalingGroup
+    :rtype: list
+    """
+    return [i.instance_id for i in group.instances if i.instance_id not in retired and
+            i.lifecycle_state == 'InService' and i.health_status == 'Healthy']
 
 
-def recycle_autoscale_instances(stack, resource_name):
+def wait_for_capacity(group_name, region, retired=(), timeout=RECYCLE_TIMEOUT, interval=RECYCLE_INTERVAL,
+                      clock=time.time, sleep=time.sleep):
+    """
+    Wait until the group has as many healthy, running instances as its desired capacity
+    :type retired: set
+    :param retired: Instances being replaced, not counted
+    :rtype: bool
+    :return: False if timed out
+    """
+    started = clock()
+    while True:
+        group = _get_group(group_name, region)
+        healthy = healthy_instance_ids(group, retired)
+        if len(healthy) >= group.desired_capacity:
+            records = ec2.get_instance_records(healthy, region=region)
+            if len([i for i in records if i.state == 'running']) >= group.desired_capacity:
+                print "*** %s: %d of %d instances in service" % (group_name, len(healthy), group.desired_capacity)
+                return True
+        if clock() - started >= timeout:
+            return False
+        sleep(interval)
+
+
+def get_capacity_surge():
+    """
+    Surge capacity from the capacity_surge option, None if not configured
+    :rtype: int or str
+    """
+    surge = env.get('capacity_surge')
+    if surge in [None, '', 0, '0', False]:
+        return None
+    return surge
+
+
+def run_with_capacity_guard(stack, resource_name, func, *args, **kwargs):
+    """
+    Call func with surge capacity in the stack autoscaling group, eg. around a deploy or restart
+    :type stack: boto.cloudformation.stack.Stack
+    :type resource_name: str
+    :param kwargs: surge overrides the capacity_surge option, without either func is called as is
+    """
+    surge = kwargs.pop('surge', None) or get_capacity_surge()
+    if surge is None:
+        return func(*args, **kwargs)
+
+    cf.validate_stack(stack)
+    group = cf.get_stack_autoscaling_group(stack, resource_name)
+    if group is None:
+        raise ValueError('Autoscaling group not found: ' + resource_name)
+
+    with CapacityGuard(group.name, region=cf.get_stack_region(stack), surge=surge):
+        return func(*args, **kwargs)
+
+
+def recycle_autoscale_instances(stack, resource_name, batch_size=None):
+    """
+    Replace the instances of the stack autoscaling group in rolling batches
+    :type batch_size: int or str
+    :param batch_size: Number of instances or a percentage of the desired capacity, by default the recycle_batch
+                       option or one instance at a time
+    :rtype: RecycleResult
+
+    With the capacity_surge option the group is scaled up for the duration of the recycle, see CapacityGuard.
+    """
 
 	# make sure stack is active
     cf.validate_stack(stack)
 
     # get autoscaling group from the stack
     webrole_group = cf.get_stack_autoscaling_group(stack, resource_name)
+    if webrole_group is None:
+        result = RecycleResult()
+        result.error = 'Autoscaling group not found: ' + resource_name
+        return result
 
-    # get instance ids for the given autoscaling group
-    instance_ids = ec2.get_autoscaling_group_instance_ids(webrole_group)
-    if instance_ids is not None and len(instance_ids) > 0:
+    if batch_size is None:
+        batch_size = env.get('recycle_batch', RECYCLE_BATCH_SIZE)
 
-        # get all instances and terminate them
-        print "Recycle instances: "
-        instances = ec2.get_instances(instance_ids)
-        for instance in instances:
-            recycle_instance(instance)
+    print "Recycle instances: "
+    region = cf.get_stack_region(stack)
+    recycler = RollingRecycler(webrole_group.name, region=region, batch_size=batch_size)
 
+    # the surge instances are not recycled
+    surge = get_capacity_surge()
+    if surge is None:
+        return recycler.recycle()
+    instance_ids = ec2.get_autoscaling_group_instance_ids(webrole_group)
+    with CapacityGuard(webrole_group.name, region=region, surge=surge):
+        return recycler.recycle(instance_ids)
 
-def list_autoscaling_instances(stack, resource_name, ssh_key=None, ssh_user=None):
 
-	# make sure stack is active
-    cf.validate_stack(stack)
+def list_autoscaling_instances(stack, resource_name, ssh_key=None, ssh_user=None, max_age=None):
 
-	# get ec2 instances for the given autoscaling group
-    instances = cf.get_stack_autoscaling_group_instances(stack, resource_name)
+	# get ec2 instances for the given autoscaling group, the stack must be active
+    instances = cf.get_stack_autoscaling_group_instances(stack, resource_name, max_age=max_age)
     if instances is not None and len(instances) > 0:
 
     	# get the current time
@@ -61,22 +353,22 @@ def list_autoscaling_instances(stack, resource_name, ssh_key=None, ssh_user=None
                 continue
 
             # display relative runtime
-            launch_time = dateutil.parser.parse(i.__dict__['launch_time'])
+            launch_time = dateutil.parser.parse(i.launch_time)
             launch_delta = now - launch_time
 
             # print status line
             print '*** %(state)s | %(name)s | %(instance_id)s | %(instance_type)s | Active for %(launch_delta)s'  % {
                 'state' : i.state,
-                'name' : i.__dict__['tags']['Name'],
-                'instance_id' : i.__dict__['id'],
-                'instance_type' : i.__dict__['instance_type'],
+                'name' : i.name,
+                'instance_id' : i.id,
+                'instance_type' : i.instance_type,
                 'launch_delta' : launch_delta
             }
 
             # print SSH connection string
             if ssh_key is not None and ssh_user is not None:
-                hostname = i.__dict__['public_dns_name']
-                if hostname is not '':
+                hostname = i.public_dns_name
+                if hostname:
                     print "  ssh -i %(ssh_key)s -l %(login)s %(host)s " % {
                         'ssh_key' : ssh_key,
                         'login' : ssh_user,
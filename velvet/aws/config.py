@@ -6,7 +6,10 @@ import os
 import functools
 import csv
 
+from collections import OrderedDict
+
 import velvet.config
+from velvet.pool import parallel_map
 
 from fabric.api import env
 
@@ -15,6 +18,57 @@ from fabric.utils import _AttributeDict
 # The current AWS region
 region = 'eu-west-1'
 
+
+def get_region(name=None):
+    """
+    Region for the AWS API calls, the current region unless given.
+
+    The region is looked up when called, importing the region variable binds
+    it before the AWS configuration has been loaded.
+
+    :type name: str
+    :rtype: str
+    """
+    if name:
+        return name
+    return region
+
+
+def get_regions():
+    """
+    Regions the environment is provisioned in, the current region unless regions are configured
+    :rtype: list
+    """
+    if 'regions' in env and env.regions:
+        return list(env.regions)
+    return [get_region()]
+
+
+def in_regions(func, regions=None):
+    """
+    Call func with each region concurrently
+    :type regions: list
+    :rtype: collections.OrderedDict
+    :return: Results by region
+    """
+    if regions is None:
+        regions = get_regions()
+    return OrderedDict(zip(regions, parallel_map(func, regions)))
+
+
+def region_from_arn(arn):
+    """
+    Region in an ARN, eg. the stack id of a CloudFormation stack
+    :type arn: str
+    :rtype: str
+    """
+    if not isinstance(arn, basestring):
+        return None
+    parts = arn.split(':')
+    if len(parts) > 3 and parts[0] == 'arn' and parts[3]:
+        return parts[3]
+    return None
+
 def with_aws_defaults(func):
     """A decorator that sets all defaults for a task."""
 
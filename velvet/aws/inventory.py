@@ -0,0 +1,492 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import closing
+
+import boto.cloudformation
+import boto.ec2
+import boto.ec2.autoscale
+
+from fabric.api import env
+
+import velvet.config
+import velvet.ec2
+from velvet.aws.config import get_region, get_regions, region_from_arn
+from velvet.ec2 import InstanceRecord
+from velvet.pool import parallel_map
+
+# Inventory database file name in the local state directory
+INVENTORY_FILE = 'inventory.sqlite'
+
+# Services synced into the inventory
+SERVICES = ['cloudformation', 'autoscaling', 'ec2']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync (
+    region TEXT, service TEXT, synced_at REAL,
+    PRIMARY KEY (region, service)
+);
+CREATE TABLE IF NOT EXISTS stacks (
+    region TEXT, stack_name TEXT, stack_id TEXT, stack_status TEXT, updated TEXT, outputs TEXT,
+    PRIMARY KEY (region, stack_name)
+);
+CREATE TABLE IF NOT EXISTS stack_resources (
+    region TEXT, stack_name TEXT, logical_id TEXT, physical_id TEXT, resource_type TEXT, resource_status TEXT,
+    PRIMARY KEY (region, stack_name, logical_id)
+);
+CREATE TABLE IF NOT EXISTS autoscaling_groups (
+    region TEXT, name TEXT, desired_capacity INTEGER, instance_ids TEXT,
+    PRIMARY KEY (region, name)
+);
+CREATE TABLE IF NOT EXISTS instances (
+    region TEXT, id TEXT, state TEXT, instance_type TEXT, launch_time TEXT,
+    public_dns_name TEXT, private_dns_name TEXT, ip_address TEXT, private_ip_address TEXT, name TEXT,
+    PRIMARY KEY (region, id)
+);
+CREATE TABLE IF NOT EXISTS security_groups (
+    region TEXT, id TEXT, name TEXT, description TEXT, owner_id TEXT, vpc_id TEXT, rules TEXT,
+    PRIMARY KEY (region, id)
+);
+"""
+
+INSTANCE_COLUMNS = ['id', 'state', 'instance_type', 'launch_time', 'public_dns_name', 'private_dns_name',
+                    'ip_address', 'private_ip_address', 'name']
+
+
+class StackRecord(object):
+
+    __slots__ = ('stack_id', 'stack_name', 'stack_status', 'outputs')
+
+    def __init__(self, stack_id, stack_name, stack_status, outputs):
+        self.stack_id = stack_id
+        self.stack_name = stack_name
+        self.stack_status = stack_status
+        self.outputs = outputs
+
+
+class SecurityGroupRecord(object):
+    """
+    Read-only copy of a security group, the rules are tuples of the protocol,
+    port range and the granted CIDR or the group id.
+    """
+
+    __slots__ = ('id', 'name', 'description', 'owner_id', 'vpc_id', 'rules')
+
+    def __init__(self, id, name, description, owner_id, vpc_id, rules):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.owner_id = owner_id
+        self.vpc_id = vpc_id
+        self.rules = rules
+
+
+class Inventory(object):
+    """
+    Local SQLite copy of the stacks, autoscaling groups, instances and security groups.
+
+    Every service is synced separately for each region, and lookups can tell
+    whether the copy of a service is fresh enough for the caller.
+    """
+
+    _lock = threading.Lock()
+
+    # database paths with the schema created by this process
+    _created = set()
+
+    def __init__(self, path=None):
+        if path is None:
+            path = velvet.config.get_state_path(INVENTORY_FILE)
+        self.path = path
+        with self._lock:
+            if path not in self._created or not os.path.exists(path):
+                with self._connect() as db:
+                    db.executescript(SCHEMA)
+                self._created.add(path)
+
+    def _connect(self):
+        # sqlite connections can not be shared between threads
+        return closing(sqlite3.connect(self.path, timeout=30))
+
+    def _write(self, statements):
+        """
+        Run the statements in a single transaction
+        :type statements: list of tuple
+        """
+        with self._lock:
+            with self._connect() as db:
+                with db:
+                    for sql, args in statements:
+                        if isinstance(args, list):
+                            db.executemany(sql, args)
+                        else:
+                            db.execute(sql, args)
+
+    def _query(self, sql, args=()):
+        with self._connect() as db:
+            return db.execute(sql, args).fetchall()
+
+    def synced_at(self, region, service):
+        """
+        :rtype: float
+        :return: Time of the last sync or None if never synced
+        """
+        rows = self._query('SELECT synced_at FROM sync WHERE region = ? AND service = ?', (region, service))
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def is_fresh(self, region, service, max_age):
+        """
+        :type max_age: float
+        :param max_age: Maximum age of the copy in seconds
+        :rtype: bool
+        """
+        synced_at = self.synced_at(region, service)
+        return synced_at is not None and time.time() - synced_at <= max_age
+
+    def _synced(self, region, service):
+        return ('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)', (region, service, time.time()))
+
+    # CloudFormation
+
+    def stack_versions(self, region):
+        """
+        :rtype: dict
+        :return: Stack status and last update time by stack name
+        """
+        rows = self._query('SELECT stack_name, stack_status, updated FROM stacks WHERE region = ?', (region,))
+        return dict([(name, (status, updated)) for name, status, updated in rows])
+
+    def store_stacks(self, region, stacks, resources):
+        """
+        Replace the stacks of the region, resources are replaced only for the stacks given in resources
+        :type stacks: list of tuple
+        :param stacks: Stack id, name, status, last update time and outputs
+        :type resources: dict
+        :param resources: Resource tuples by stack name
+        """
+        names = [(region, stack[1]) for stack in stacks]
+        statements = [
+            ('DELETE FROM stacks WHERE region = ?', (region,)),
+            ('INSERT INTO stacks VALUES (?, ?, ?, ?, ?, ?)',
+             [(region, name, stack_id, status, updated, json.dumps(outputs))
+              for stack_id, name, status, updated, outputs in stacks]),
+            ('DELETE FROM stack_resources WHERE region = ? AND stack_name NOT IN (SELECT stack_name FROM stacks '
+             'WHERE region = ?)', (region, region)),
+        ]
+        for name, stack_resources in resources.iteritems():
+            statements.append(('DELETE FROM stack_resources WHERE region = ? AND stack_name = ?', (region, name)))
+            statements.append(('INSERT INTO stack_resources VALUES (?, ?, ?, ?, ?, ?)',
+                               [(region, name) + resource for resource in stack_resources]))
+        statements.append(self._synced(region, 'cloudformation'))
+        self._write(statements)
+
+    def get_stack(self, region, stack_name):
+        """
+        :rtype: StackRecord
+        """
+        rows = self._query('SELECT stack_id, stack_name, stack_status, outputs FROM stacks '
+                           'WHERE region = ? AND stack_name = ?', (region, stack_name))
+        if len(rows) == 0:
+            return None
+        stack_id, name, status, outputs = rows[0]
+        return StackRecord(stack_id, name, status, json.loads(outputs))
+
+    def get_physical_id(self, region, stack_name, logical_id):
+        rows = self._query('SELECT physical_id FROM stack_resources '
+                           'WHERE region = ? AND stack_name = ? AND logical_id = ?', (region, stack_name, logical_id))
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    # Autoscaling groups and instances
+
+    def instance_states(self, region):
+        """
+        :rtype: dict
+        :return: Instance state by instance id
+        """
+        return dict(self._query('SELECT id, state FROM instances WHERE region = ?', (region,)))
+
+    def store_autoscaling(self, region, groups, instances):
+        """
+        Replace the autoscaling groups and their instances in the region
+        :type groups: list of tuple
+        :param groups: Group name, desired capacity and instance ids
+        :type instances: list of InstanceRecord
+        :param instances: Changed instances, instances not in any group are removed
+        """
+        instance_ids = set()
+        for name, desired, ids in groups:
+            instance_ids.update(ids)
+
+        statements = [
+            ('DELETE FROM autoscaling_groups WHERE region = ?', (region,)),
+            ('INSERT INTO autoscaling_groups VALUES (?, ?, ?, ?)',
+             [(region, name, desired, json.dumps(ids)) for name, desired, ids in groups]),
+            ('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+             [tuple([region] + [getattr(instance, column) for column in INSTANCE_COLUMNS])
+              for instance in instances]),
+        ]
+        stored = self.instance_states(region)
+        removed = [(region, instance_id) for instance_id in stored if instance_id not in instance_ids]
+        statements.append(('DELETE FROM instances WHERE region = ? AND id = ?', removed))
+        statements.append(self._synced(region, 'autoscaling'))
+        self._write(statements)
+
+    def get_autoscaling_group_instances(self, region, group_name):
+        """
+        :rtype: list of velvet.ec2.InstanceRecord
+        """
+        rows = self._query('SELECT instance_ids FROM autoscaling_groups WHERE region = ? AND name = ?',
+                           (region, group_name))
+        if len(rows) == 0:
+            return None
+        instance_ids = json.loads(rows[0][0])
+        instances = dict([(row[0], InstanceRecord(*row)) for row in self._query(
+            'SELECT %s FROM instances WHERE region = ?' % ', '.join(INSTANCE_COLUMNS), (region,))])
+        return [instances[instance_id] for instance_id in instance_ids if instance_id in instances]
+
+    # Security groups
+
+    def store_security_groups(self, region, groups):
+        """
+        :type groups: list of SecurityGroupRecord
+        """
+        self._write([
+            ('DELETE FROM security_groups WHERE region = ?', (region,)),
+            ('INSERT INTO security_groups VALUES (?, ?, ?, ?, ?, ?, ?)',
+             [(region, g.id, g.name, g.description, g.owner_id, g.vpc_id, json.dumps(g.rules)) for g in groups]),
+            self._synced(region, 'ec2'),
+        ])
+
+    def get_security_group(self, region, security_group):
+        """
+        Find security group by name or id
+        :rtype: SecurityGroupRecord
+        """
+        rows = self._query('SELECT id, name, description, owner_id, vpc_id, rules FROM security_groups '
+                           'WHERE region = ? AND (id = ? OR name = ?)', (region, security_group, security_group))
+        if len(rows) == 0:
+            return None
+        group_id, name, description, owner_id, vpc_id, rules = rows[0]
+        return SecurityGroupRecord(group_id, name, description, owner_id, vpc_id,
+                                   [tuple(rule) for rule in json.loads(rules)])
+
+
+def sync_cloudformation(inventory, region):
+    """
+    Sync the stacks, resources are described again only for the stacks changed since the last sync
+    :rtype: int
+    :return: Number of stacks with changed resources
+    """
+    connection = boto.cloudformation.connect_to_region(region)
+    versions = inventory.stack_versions(region)
+
+    stacks = []
+    next_token = None
+    while True:
+        page = connection.describe_stacks(None, next_token)
+        stacks.extend(page)
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
+
+    rows = []
+    changed = []
+    for stack in stacks:
+        updated = str(getattr(stack, 'LastUpdatedTime', None) or stack.creation_time)
+        rows.append((stack.stack_id, stack.stack_name, stack.stack_status, updated,
+                     dict([(output.key, output.value) for output in stack.outputs])))
+        if versions.get(stack.stack_name) != (stack.stack_status, updated):
+            changed.append(stack)
+
+    def list_resources(stack):
+        # connections are not shared between the threads
+        connection = boto.cloudformation.connect_to_region(region)
+        resources = []
+        next_token = None
+        while True:
+            page = connection.list_stack_resources(stack.stack_id, next_token)
+            resources.extend([(summary.logical_resource_id, summary.physical_resource_id,
+                               summary.resource_type, summary.resource_status) for summary in page])
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                return resources
+
+    resources = dict(zip([stack.stack_name for stack in changed], parallel_map(list_resources, changed)))
+    inventory.store_stacks(region, rows, resources)
+    return len(changed)
+
+
+def sync_autoscaling(inventory, region):
+    """
+    Sync the autoscaling groups and all their instances, the instances are described in batches.
+    This is a full rescan of the region: the instance states can change without any change to the
+    groups, and the EC2 API has no way to list only the changed instances.
+    :rtype: int
+    :return: Number of instances described
+    """
+    autoscale = boto.ec2.autoscale.connect_to_region(region)
+    groups = []
+    next_token = None
+    while True:
+        page = autoscale.get_all_groups(next_token=next_token)
+        for group in page:
+            groups.append((group.name, group.desired_capacity, [i.instance_id for i in group.instances]))
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            break
+
+    # running instances are described again too, they may have been stopped or be terminating
+    instance_ids = [instance_id for name, desired, ids in groups for instance_id in ids]
+    instances = velvet.ec2.get_instance_records(instance_ids, region=region)
+    inventory.store_autoscaling(region, groups, instances)
+    return len(instances)
+
+
+def sync_security_groups(inventory, region):
+    """
+    Sync all the security groups of the region, a full rescan as the EC2 API can not list only the
+    changed groups
+    :rtype: int
+    :return: Number of security groups
+    """
+    ec2 = boto.ec2.connect_to_region(region)
+    groups = []
+    for sg in ec2.get_all_security_groups():
+        rules = []
+        for rule in sg.rules:
+            for grant in rule.grants:
+                rules.append((rule.ip_protocol, rule.from_port, rule.to_port, grant.cidr_ip or grant.group_id))
+        groups.append(SecurityGroupRecord(sg.id, sg.name, sg.description, sg.owner_id, sg.vpc_id, rules))
+    inventory.store_security_groups(region, groups)
+    return len(groups)
+
+
+_sync_functions = {
+    'cloudformation': sync_cloudformation,
+    'autoscaling': sync_autoscaling,
+    'ec2': sync_security_groups,
+}
+
+
+def sync(regions=None, services=None, max_age=0, inventory=None):
+    """
+    Sync the services in all the regions concurrently, skipping the ones synced within max_age seconds
+    :type regions: list
+    :type services: list
+    :type max_age: float
+    :type inventory: Inventory
+    :rtype: dict
+    :return: Sync result by region and service, None if skipped
+    """
+    if regions is None:
+        regions = get_regions()
+    if services is None:
+        services = SERVICES
+    if inventory is None:
+        inventory = Inventory()
+
+    jobs = [(region, service) for region in regions for service in services]
+
+    def run(job):
+        region, service = job
+        if max_age > 0 and inventory.is_fresh(region, service, max_age):
+            return None
+        return _sync_functions[service](inventory, region)
+
+    return dict(zip(jobs, parallel_map(run, jobs)))
+
+
+def get_max_age(max_age=None):
+    """
+    Maximum age of the inventory used by the listing helpers
+    :type max_age: float
+    :param max_age: Seconds, the inventory_max_age option by default
+    :rtype: float
+    :return: Seconds or None if the inventory is not used
+    """
+    if max_age is None:
+        max_age = env.get('inventory_max_age')
+    if max_age is None or max_age == '':
+        return None
+    return float(max_age)
+
+
+def _stack_region(stack, region):
+    if region is None and not isinstance(stack, basestring):
+        region = region_from_arn(stack.stack_id)
+    return get_region(region)
+
+
+def _fresh_inventory(region, service, max_age):
+    """
+    :rtype: Inventory
+    :return: The inventory if the service has been synced within max_age seconds, otherwise None
+    """
+    inventory = Inventory()
+    if inventory.is_fresh(region, service, max_age):
+        return inventory
+    return None
+
+
+def get_stack(stack, max_age, region=None):
+    """
+    Stack status and outputs from the inventory
+    :type stack: boto.cloudformation.stack.Stack or str
+    :param stack: Stack or stack name
+    :type max_age: float
+    :rtype: StackRecord
+    :return: Stack or None if the inventory is not fresh enough or the stack is not found
+    """
+    stack_name = stack if isinstance(stack, basestring) else stack.stack_name
+    region = _stack_region(stack, region)
+    inventory = _fresh_inventory(region, 'cloudformation', max_age)
+    if inventory is None:
+        return None
+    return inventory.get_stack(region, stack_name)
+
+
+def get_stack_autoscaling_group_instances(stack, resource_name, max_age, region=None):
+    """
+    Instances of the stack autoscaling group from the inventory
+    :type stack: boto.cloudformation.stack.Stack or str
+    :param stack: Stack or stack name
+    :type max_age: float
+    :rtype: list of velvet.ec2.InstanceRecord
+    :return: Instances or None if the inventory is not fresh enough or the group is not found
+    """
+    stack_name = stack if isinstance(stack, basestring) else stack.stack_name
+    region = _stack_region(stack, region)
+
+    if _fresh_inventory(region, 'cloudformation', max_age) is None:
+        return None
+    inventory = _fresh_inventory(region, 'autoscaling', max_age)
+    if inventory is None:
+        return None
+
+    group_name = inventory.get_physical_id(region, stack_name, resource_name)
+    if group_name is None:
+        return None
+    return inventory.get_autoscaling_group_instances(region, group_name)
+
+
+def get_security_group(security_group, max_age, region=None):
+    """
+    Security group from the inventory
+    :type security_group: str
+    :param security_group: Security group name or id
+    :type max_age: float
+    :rtype: SecurityGroupRecord
+    :return: Security group or None if the inventory is not fresh enough or the group is not found
+    """
+    region = get_region(region)
+    inventory = _fresh_inventory(region, 'ec2', max_age)
+    if inventory is None:
+        return None
+    return inventory.get_security_group(region, security_group)
@@ -1,9 +1,15 @@
+import json
+import os
+import threading
+
 import boto.ec2
 
 from boto.ec2.connection import EC2Connection
 from fabric.colors import red, green, yellow
-from velvet.aws.config import region, with_opsworks_defaults
+from velvet.aws.config import get_region, with_opsworks_defaults
+import velvet.config
 import velvet.security
+from velvet.security import IngressPlan, ingress_grant
 
 from fabric.api import env
 
@@ -15,7 +21,6 @@ class OpsWorks(object):
         """
         self.connection = connection
         self.region = region
-        self.src_groups = {}
 
         # create new connection if needed
         if self.connection is None:
@@ -23,33 +28,88 @@ class OpsWorks(object):
             if self.region:
                 self.connection = boto.ec2.connect_to_region(self.region)
 
+        # groups looked up with a given connection are not shared with the other lookups
+        if connection is None:
+            self.security_groups = velvet.security.get_security_group_index(self.region)
+        else:
+            self.security_groups = velvet.security.SecurityGroupIndex(self.region, connection=connection)
+
     def get_default_opsworks_security_groups(self):
         """
         Return default OpsWorks security groups
         :rtype: list of boto.ec2.securitygroup.SecurityGroup
         """
-
-        def filter_opsworks(sg):
-            """
-            :type sg: boto.ec2.securitygroup.SecurityGroup
-            :rtype: bool
-            """
-            return sg.name.startswith('AWS-OpsWorks-')
-
-        ec2 = boto.ec2.connect_to_region(region)
-        return filter(filter_opsworks, ec2.get_all_security_groups())
+        return self.security_groups.find('AWS-OpsWorks-*')
 
     def get_security_group(self, group_id, cached=True):
         """
         :type group_id: str
-        :rtype: list of boto.ec2.securitygroup.SecurityGroup
+        :rtype: boto.ec2.securitygroup.SecurityGroup
         """
-        if cached and group_id in self.src_groups:
-            src_group = self.src_groups[group_id]
-        else:
-            src_group = velvet.security.get_security_group(group_id)
-            self.src_groups[group_id] = src_group
-        return src_group
+        return self.security_groups.get(group_id, cached=cached)
+
+
+# CloudFormation to OpsWorks id mapping file name in the local state directory
+OPSWORKS_IDS_FILE = 'opsworks.json'
+
+
+class OpsWorksIdCache(object):
+    """
+    OpsWorks stack, layer and app ids read from the CloudFormation stack outputs,
+    keyed by the region and the CloudFormation stack name
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        if path is None:
+            path = velvet.config.get_state_path(OPSWORKS_IDS_FILE)
+        self.path = path
+
+    def _key(self, region, stack_name):
+        return '%s/%s' % (region, stack_name)
+
+    def get(self, region, stack_name, output_keys):
+        """
+        :type output_keys: dict
+        :param output_keys: Output keys of the stack, layer and app ids, a changed configuration invalidates the entry
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self._load().get(self._key(region, stack_name))
+        if entry is None or entry.get('output_keys') != output_keys:
+            return None
+        return entry['ids']
+
+    def set(self, region, stack_name, output_keys, ids):
+        """
+        :type ids: dict
+        """
+        with self._lock:
+            data = self._load()
+            data[self._key(region, stack_name)] = {'output_keys': output_keys, 'ids': ids}
+            self._save(data)
+
+    def invalidate(self, region, stack_name):
+        with self._lock:
+            data = self._load()
+            if data.pop(self._key(region, stack_name), None) is not None:
+                self._save(data)
+
+    def _save(self, data):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
 
 
 @with_opsworks_defaults
@@ -74,77 +134,86 @@ class OpsWorksResult(object):
         return self.succeeded and not self.failed
 
 
+def _plan_default_security_group_cleanup(sg, src_groups):
+    """
+    Revoke the group grants and the grants open to everyone, keep the other address ranges
+    :type sg: boto.ec2.securitygroup.SecurityGroup
+    :type src_groups: dict
+    :param src_groups: Source security groups by id
+    :rtype: tuple
+    :return: The plan and the output lines for each grant, with True for revoked grants
+    """
+    revoke = []
+    sources = {}
+    lines = []
+    for rule in sg.rules:
+        for grant in rule.grants:
+            ports = {
+                'ip_protocol' : rule.ip_protocol,
+                'from_port' : rule.from_port,
+                'to_port' : rule.to_port,
+            }
+            if grant.cidr_ip is None:
+                # we have a security group ingress
+                src_group = src_groups.get(grant.group_id)
+                ports['group_id'] = grant.group_id
+                ports['group_name'] = src_group.name if src_group is not None else grant.name
+                sources[grant.group_id] = (ports['group_name'], grant.owner_id)
+                revoke.append(ingress_grant(rule, grant))
+                lines.append(("--> Revoke: %(group_id)s (%(group_name)s) -> %(ip_protocol)s(%(from_port)s-%(to_port)s)" % ports, True))
+            elif grant.cidr_ip == '0.0.0.0/0':
+                # we have ip address range open to everyone
+                ports['cidr_ip'] = grant.cidr_ip
+                revoke.append(ingress_grant(rule, grant))
+                lines.append(("--> Revoke: %(cidr_ip)s -> %(ip_protocol)s(%(from_port)s-%(to_port)s)" % ports, True))
+            else:
+                ports['cidr_ip'] = grant.cidr_ip
+                lines.append(("--> Keep: %(cidr_ip)s -> %(ip_protocol)s(%(from_port)s-%(to_port)s)" % ports, False))
+    return IngressPlan(sg, revoke=revoke, sources=sources), lines
+
+
 def cleanup_default_security_groups(dry_run=False):
     """Cleanup default OpsWorks security groups"""
 
     print "--> Cleanup default OpsWorks security groups" + \
           (" (this is just a dry run...)" if dry_run else "")
 
-    failed = False
+    region = get_region()
     opsworks = OpsWorks(region=region)
-    for sg in opsworks.get_default_opsworks_security_groups():
+    groups = opsworks.get_default_opsworks_security_groups()
 
-        if len(sg.rules) == 0:
+    # all the source groups are looked up together
+    src_group_ids = set([grant.group_id for sg in groups for rule in sg.rules for grant in rule.grants
+                         if grant.cidr_ip is None])
+    src_groups = opsworks.security_groups.get_many(sorted(src_group_ids))
+
+    # the revocations of each group are planned in one pass and applied concurrently with batched calls
+    planned = [_plan_default_security_group_cleanup(sg, src_groups) for sg in groups]
+    applied = velvet.security.apply_ingress([plan for plan, lines in planned], region=region, dry_run=dry_run)
+
+    for plan, lines in planned:
+        sg = plan.sg
+        if len(lines) == 0:
             print "+ Skip security group: " + sg.name
             continue
 
         print ""
         print "+ Cleanup security group: " + sg.name
 
-        while len(sg.rules) > 0:
-
-            # delete the rules until all are removed
-            for rule in sg.rules:
-                for grant in rule.grants:
-                    status = None
-                    if grant.cidr_ip is None:
-                        # we have a security group ingress
-                        src_group = opsworks.get_security_group(grant.group_id)
-                        print ("--> Revoke: %(group_id)s (%(group_name)s) -> %(ip_protocol)s(%(from_port)s-%(to_port)s)" % {
-                            'ip_protocol' : rule.ip_protocol,
-                            'from_port' : rule.from_port,
-                            'to_port' : rule.to_port,
-                            'group_id' : src_group.id,
-                            'group_name' : src_group.name
-                        }),
-                        if not dry_run:
-                            status = sg.revoke(ip_protocol=rule.ip_protocol,
-                                      from_port=rule.from_port, to_port=rule.to_port,
-                                      src_group=src_group,
-                                      dry_run=dry_run)
-                            print (green("[OK]") if status else red("[fail]"))
-                            if status is False:
-                                failed = True
-                        else:
-                            print yellow("[dry-run]")
-
-                    else:
-                        # we have ip address range
-                        if grant.cidr_ip == '0.0.0.0/0':
-                            print ("--> Revoke: %(cidr_ip)s -> %(ip_protocol)s(%(from_port)s-%(to_port)s)" % {
-                                'ip_protocol' : rule.ip_protocol,
-                                'from_port' : rule.from_port,
-                                'to_port' : rule.to_port,
-                                'cidr_ip' : grant.cidr_ip
-                            }),
-                            if not dry_run:
-                                status = sg.revoke(ip_protocol=rule.ip_protocol,
-                                          from_port=rule.from_port, to_port=rule.to_port,
-                                          cidr_ip=grant.cidr_ip)
-                                print (green("[OK]") if status else red("[fail]"))
-                                if status is False:
-                                    failed = True
-                            else:
-                                print yellow("[dry-run]")
-                        else:
-                            print ("--> Keep: %(cidr_ip)s -> %(ip_protocol)s(%(from_port)s-%(to_port)s)" % {
-                                'ip_protocol' : rule.ip_protocol,
-                                'from_port' : rule.from_port,
-                                'to_port' : rule.to_port,
-                                'cidr_ip' : grant.cidr_ip
-                            })
+        for line, revoked in lines:
+            if not revoked:
+                print line
+            elif dry_run:
+                print line,
+                print yellow("[dry-run]")
+            else:
+                print line,
+                print (red("[fail]") if sg.name in applied.errors else green("[OK]"))
+
+        if sg.name in applied.errors:
+            print red("*** " + applied.errors[sg.name])
 
     result = OpsWorksResult()
-    result.failed = failed
+    result.failed = applied.failed
     result.succeeded = not result.failed
-    return result
\ No newline at end of file
+    return result
@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Thread safe in-process cache where entries expire after the given time to live.
+
+    A single entry can be stored under multiple keys, eg. stack name and stack id.
+    Invalidating any one of the keys removes the entry for all of them.
+    """
+
+    def __init__(self, ttl, clock=time.time):
+        """
+        :type ttl: int
+        :param ttl: Time to live in seconds, caching is disabled if less than one
+        :param clock: Function returning the current time in seconds
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires, keys, value = entry
+            if expires <= self.clock():
+                self._remove(keys)
+                return default
+            return value
+
+    def set(self, keys, value):
+        """
+        Store value under all the given keys, None keys are ignored
+        :type keys: list
+        """
+        if self.ttl <= 0:
+            return
+        keys = tuple([key for key in keys if key is not None])
+        with self._lock:
+            # drop aliases pointing to a previous version of the entry
+            for key in keys:
+                if key in self._entries:
+                    self._remove(self._entries[key][1])
+            entry = (self.clock() + self.ttl, keys, value)
+            for key in keys:
+                self._entries[key] = entry
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _remove(self, keys):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
@@ -0,0 +1,273 @@
+import glob
+import itertools
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from datetime import datetime
+
+import velvet.config
+from velvet.cloudformation.lint import references
+
+# Event logs directory in the local state directory
+EVENTS_DIR = 'events'
+
+# Number of event logs kept for each stack
+EVENT_LOG_RUNS = 20
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Sequence numbers of the runs recorded by this process
+_run_ids = itertools.count(1)
+
+
+def event_log_dir(stack_name, region):
+    """
+    :type stack_name: str
+    :type region: str
+    :rtype: str
+    """
+    return os.path.dirname(velvet.config.get_state_path(EVENTS_DIR, region, stack_name, ''))
+
+
+def list_event_logs(stack_name, region, operation=None):
+    """
+    Event log files of the stack, oldest first
+    :type operation: str
+    :param operation: Only the runs of this operation: create, update or delete
+    :rtype: list
+    """
+    paths = sorted(glob.glob(os.path.join(event_log_dir(stack_name, region), '*.jsonl')))
+    if operation is not None:
+        paths = [path for path in paths if event_log_operation(path) == operation]
+    return paths
+
+
+def event_log_operation(path):
+    """
+    Operation of the run from the event log file name
+    :type path: str
+    :rtype: str
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    if '-' not in name:
+        return None
+    return name.split('-', 1)[1]
+
+
+class StackEventRecorder(object):
+    """
+    Appends the events of a provisioning or deletion run to a JSON lines log.
+
+    Each run is written into its own file named after the start time, the
+    process id, a sequence number and the operation, and only the latest runs of each stack are
+    kept.
+    """
+
+    def __init__(self, stack_name, operation, region, path=None, keep=EVENT_LOG_RUNS):
+        """
+        :type stack_name: str
+        :type operation: str
+        :param operation: create, update or delete
+        :type region: str
+        :type path: str
+        :param path: Log file, by default a new file in the event log directory of the stack
+        :type keep: int
+        :param keep: Number of log files to keep for the stack
+        """
+        self.stack_name = stack_name
+        self.operation = operation
+        self.region = region
+        self.started = datetime.utcnow()
+        self._lock = threading.Lock()
+
+        if path is None:
+            # runs started at the same time get their own files
+            name = '%s.%d.%d-%s.jsonl' % (self.started.strftime('%Y%m%dT%H%M%S.%f'), os.getpid(), next(_run_ids),
+                                          operation)
+            path = os.path.join(event_log_dir(stack_name, region), name)
+            self._prune(os.path.dirname(path), keep - 1)
+        self.path = path
+
+    def record(self, events):
+        """
+        :type events: list of boto.cloudformation.stack.StackEvent
+        :param events: Events newest first, as returned by the event stream
+        """
+        if len(events) == 0:
+            return
+        with self._lock:
+            with open(self.path, 'a') as f:
+                for event in reversed(events):
+                    f.write(json.dumps(self._format(event)) + '\n')
+
+    def _format(self, event):
+        return OrderedDict([
+            ('operation', self.operation),
+            ('event_id', event.event_id),
+            ('stack_id', event.stack_id),
+            ('stack_name', event.stack_name),
+            ('logical_resource_id', event.logical_resource_id),
+            ('physical_resource_id', event.physical_resource_id),
+            ('resource_type', event.resource_type),
+            ('resource_status', event.resource_status),
+            ('resource_status_reason', event.resource_status_reason),
+            ('timestamp', event.timestamp.strftime(TIMESTAMP_FORMAT)),
+        ])
+
+    def _prune(self, directory, keep):
+        paths = sorted(glob.glob(os.path.join(directory, '*.jsonl')))
+        for path in paths[:max(0, len(paths) - keep)]:
+            os.remove(path)
+
+
+def read_event_log(path):
+    """
+    :type path: str
+    :rtype: list of dict
+    :return: Events oldest first, timestamps as datetime
+    """
+    events = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            event['timestamp'] = datetime.strptime(event['timestamp'], TIMESTAMP_FORMAT)
+            events.append(event)
+    return events
+
+
+def template_dependencies(template):
+    """
+    Resources each resource in the template waits for, through Ref, Fn::GetAtt and DependsOn
+    :type template: str
+    :rtype: dict
+    """
+    try:
+        resources = json.loads(template).get('Resources', {})
+    except (ValueError, AttributeError):
+        return None
+
+    dependencies = {}
+    for name, resource in resources.iteritems():
+        if not isinstance(resource, dict):
+            continue
+        refs, attrs = references(resource.get('Properties', {}))
+        depends_on = resource.get('DependsOn', [])
+        if isinstance(depends_on, basestring):
+            depends_on = [depends_on]
+        dependencies[name] = set([dependency for dependency in refs | attrs | set(depends_on)
+                                  if dependency in resources and dependency != name])
+    return dependencies
+
+
+class ResourceTiming(object):
+
+    def __init__(self, logical_id, resource_type, started):
+        self.logical_id = logical_id
+        self.resource_type = resource_type
+        self.started = started
+        self.finished = None
+        self.status = None
+
+    @property
+    def duration(self):
+        """
+        :rtype: float
+        :return: Seconds from IN_PROGRESS to COMPLETE or FAILED, None if not finished
+        """
+        if self.finished is None:
+            return None
+        return (self.finished - self.started).total_seconds()
+
+
+class StackRunAnalysis(object):
+    """
+    Provisioning durations of the resources in a recorded run.
+
+    The critical path is traced back from the resource that finished last:
+    each step goes to the dependency that finished last before the resource
+    started. The dependencies are read from the template if it is given,
+    otherwise any resource that finished before may have been waited for.
+    """
+
+    def __init__(self, events, dependencies=None):
+        """
+        :type events: list of dict
+        :param events: Events oldest first, see read_event_log
+        :type dependencies: dict
+        :param dependencies: Dependencies by logical resource id, see template_dependencies
+        """
+        self.dependencies = dependencies
+        self.stack = None
+        self.resources = OrderedDict()
+
+        for event in events:
+            status = event['resource_status']
+            is_stack = event['physical_resource_id'] == event['stack_id']
+            timing = self.stack if is_stack else self.resources.get(event['logical_resource_id'])
+
+            # cleanup and rollback after the first completion are not counted
+            if timing is None:
+                if status.endswith('_IN_PROGRESS'):
+                    timing = ResourceTiming(event['logical_resource_id'], event['resource_type'], event['timestamp'])
+                    if is_stack:
+                        self.stack = timing
+                    else:
+                        self.resources[timing.logical_id] = timing
+            elif timing.finished is None and (status.endswith('_COMPLETE') or status.endswith('_FAILED')):
+                timing.finished = event['timestamp']
+                timing.status = status
+
+        self.critical_path = self._critical_path()
+
+    @property
+    def duration(self):
+        if self.stack is None:
+            return None
+        return self.stack.duration
+
+    def finished_resources(self):
+        """
+        :rtype: list of ResourceTiming
+        :return: Finished resources, the longest first
+        """
+        finished = [timing for timing in self.resources.itervalues() if timing.finished is not None]
+        return sorted(finished, key=lambda timing: timing.duration, reverse=True)
+
+    def _critical_path(self):
+        finished = [timing for timing in self.resources.itervalues() if timing.finished is not None]
+        if len(finished) == 0:
+            return []
+
+        path = []
+        current = max(finished, key=lambda timing: timing.finished)
+        while current is not None:
+            path.insert(0, current.logical_id)
+            candidates = [timing for timing in finished
+                          if timing.finished <= current.started and timing.logical_id not in path]
+            if self.dependencies is not None:
+                waited_for = self.dependencies.get(current.logical_id, set())
+                candidates = [timing for timing in candidates if timing.logical_id in waited_for]
+            current = max(candidates, key=lambda timing: timing.finished) if candidates else None
+        return path
+
+
+def compare_runs(current, previous):
+    """
+    Resource durations of the current run with the average of the previous runs
+    :type current: StackRunAnalysis
+    :type previous: list of StackRunAnalysis
+    :rtype: list of tuple
+    :return: Logical id, resource type, duration and average previous duration or None, the longest first
+    """
+    comparison = []
+    for timing in current.finished_resources():
+        durations = [run.resources[timing.logical_id].duration for run in previous
+                     if timing.logical_id in run.resources and
+                     run.resources[timing.logical_id].duration is not None]
+        average = sum(durations) / len(durations) if durations else None
+        comparison.append((timing.logical_id, timing.resource_type, timing.duration, average))
+    return comparison
@@ -0,0 +1,199 @@
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import subprocess
+import traceback
+
+import yaml
+
+import velvet.config
+
+try:
+    from cfn_pyplates.core import generate_pyplate
+    from cfn_pyplates.options import OptionsMapping
+except ImportError:
+    # render with the cfn_py_generate command instead
+    generate_pyplate = None
+
+# Source hashes of the generated templates file name in the local state directory
+GENERATED_TEMPLATES_FILE = 'templates.json'
+
+
+class TemplateJob(object):
+    """
+    Template generated from a pyplate with the mappings of an environment
+    """
+
+    def __init__(self, cloudformation_path, environment, template):
+        """
+        :type cloudformation_path: str
+        :type environment: str
+        :type template: str
+        """
+        self.environment = environment
+        self.template = template
+        self.pyplate = os.path.join(cloudformation_path, template + '.py')
+        self.outfile = os.path.join(cloudformation_path, environment + '-' + template + '.json')
+        self.options = os.path.join(cloudformation_path, 'mappings', environment + '.yaml')
+
+
+class GenerateResult(object):
+
+    def __init__(self):
+        self.generated = []
+        self.skipped = []
+        self.failed = []
+
+    def __nonzero__(self):
+        return len(self.failed) == 0
+
+
+def list_templates(cloudformation_path):
+    """
+    Names of the pyplate templates in the CloudFormation path
+    :rtype: list
+    """
+    return sorted([os.path.splitext(os.path.basename(path))[0]
+                   for path in glob.glob(os.path.join(cloudformation_path, '*.py'))])
+
+
+def source_digest(paths):
+    """
+    Hash of the contents of the source files, missing files are hashed as empty
+    :type paths: list
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update((path or '') + '\0')
+        if path and os.path.exists(path):
+            with open(path) as f:
+                digest.update(f.read())
+        digest.update('\0')
+    return digest.hexdigest()
+
+
+def _write(outfile, body):
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    tmp_path = outfile + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(body)
+    os.rename(tmp_path, outfile)
+
+
+def render_template(args):
+    """
+    Render a template in a worker process
+    :type args: tuple
+    :param args: Pyplate, output file and options file paths
+    :rtype: str
+    :return: Error message or None if the template was generated
+    """
+    pyplate, outfile, options = args
+    try:
+        if generate_pyplate is None:
+            status = subprocess.call(['cfn_py_generate', pyplate, outfile, '--options', options], env=os.environ)
+            if status > 0:
+                return 'cfn_py_generate exited with status %d' % status
+            return None
+
+        with open(options) as f:
+            mapping = OptionsMapping(yaml.safe_load(f) or {})
+        with open(pyplate) as f:
+            generated = generate_pyplate(f, mapping)
+        if not generated:
+            return 'Failed to render ' + pyplate
+        _write(outfile, generated)
+        return None
+    except Exception as e:
+        traceback.print_exc()
+        return str(e)
+
+
+class TemplateGenerator(object):
+    """
+    Generates templates in a pool of worker processes.
+
+    A template is generated again only if its pyplate source, the environment
+    mappings or the velvet configuration have changed since the last run,
+    or the output file is missing.
+    """
+
+    def __init__(self, config_file=None, force=False, processes=None, state_file=None):
+        """
+        :type config_file: str
+        :param config_file: Velvet configuration file
+        :type force: bool
+        :param force: Generate all templates even if nothing has changed
+        :type processes: int
+        :type state_file: str
+        """
+        if state_file is None:
+            state_file = velvet.config.get_state_path(GENERATED_TEMPLATES_FILE)
+        self.config_file = config_file
+        self.force = force
+        self.processes = processes or multiprocessing.cpu_count()
+        self.state_file = state_file
+
+    def digest(self, job):
+        """
+        :type job: TemplateJob
+        :rtype: str
+        """
+        return source_digest([job.pyplate, job.options, self.config_file])
+
+    def generate(self, jobs):
+        """
+        :type jobs: list of TemplateJob
+        :rtype: GenerateResult
+        """
+        result = GenerateResult()
+        state = self._load()
+
+        pending = []
+        for job in jobs:
+            digest = self.digest(job)
+            if not self.force and state.get(job.outfile) == digest and os.path.exists(job.outfile):
+                result.skipped.append(job)
+            else:
+                pending.append((job, digest))
+
+        args = [(job.pyplate, job.outfile, job.options) for job, digest in pending]
+        if len(args) <= 1:
+            errors = map(render_template, args)
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(args)))
+            try:
+                errors = pool.map(render_template, args)
+            finally:
+                pool.close()
+                pool.join()
+
+        for (job, digest), error in zip(pending, errors):
+            if error is None:
+                state[job.outfile] = digest
+                result.generated.append(job)
+            else:
+                state.pop(job.outfile, None)
+                result.failed.append((job, error))
+
+        self._save(state)
+        return result
+
+    def _load(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _save(self, state):
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.state_file)
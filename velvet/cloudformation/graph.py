@@ -0,0 +1,225 @@
+import json
+import threading
+import traceback
+import Queue
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from fabric.colors import red, yellow
+
+from velvet.pool import MAX_WAIT
+
+# Default number of stacks processed at the same time
+DEFAULT_STACK_CONCURRENCY = 4
+
+
+class StackGraphException(Exception):
+    pass
+
+
+def read_template_parameters(template_file):
+    """
+    Read the parameter names declared in a template file
+    :type template_file: str
+    :rtype: set
+    :return: Parameter names or None if the template could not be read
+    """
+    try:
+        with open(template_file) as f:
+            template = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(template, dict):
+        return None
+    return set(template.get('Parameters', {}).keys())
+
+
+class StackGraph(object):
+    """
+    Dependency graph of the stacks in the stacks configuration.
+
+    A stack depends on the stacks producing the outputs, listed in their
+    outputs option, that its template takes as parameters, and on the stacks
+    listed in its own depends_on option. If the template parameters are not
+    known, the stack depends on every stack before it in the configuration.
+    """
+
+    def __init__(self, stacks, parameters=None):
+        """
+        :type stacks: list of dict
+        :type parameters: dict
+        :param parameters: Template parameter names by stack name
+        """
+        if parameters is None:
+            parameters = {}
+
+        self.stacks = OrderedDict()
+        for stack in stacks:
+            if stack['name'] in self.stacks:
+                raise StackGraphException('Duplicate stack name: ' + stack['name'])
+            self.stacks[stack['name']] = stack
+
+        self.producers = {}
+        for name, stack in self.stacks.iteritems():
+            for key in stack.get('outputs', []):
+                if key in self.producers:
+                    raise StackGraphException('Output %s is passed on by both %s and %s' % (
+                        key, self.producers[key], name))
+                self.producers[key] = name
+
+        self.parameters = {}
+        self.dependencies = OrderedDict()
+        previous = []
+        for name, stack in self.stacks.iteritems():
+            declared = parameters.get(name)
+            self.parameters[name] = declared
+
+            if declared is None:
+                dependencies = set(previous)
+            else:
+                dependencies = set([self.producers[key] for key in declared
+                                    if key in self.producers and self.producers[key] != name])
+
+            depends_on = stack.get('depends_on', [])
+            if isinstance(depends_on, basestring):
+                depends_on = [depends_on]
+            for dependency in depends_on:
+                if dependency not in self.stacks:
+                    raise StackGraphException('Stack %s depends on unknown stack %s' % (name, dependency))
+                dependencies.add(dependency)
+
+            self.dependencies[name] = dependencies
+            previous.append(name)
+
+        self.dependents = OrderedDict([(name, set()) for name in self.stacks])
+        for name, dependencies in self.dependencies.iteritems():
+            for dependency in dependencies:
+                self.dependents[dependency].add(name)
+
+        # fail early on circular dependencies
+        self.order()
+
+    def inputs(self, name):
+        """
+        Output keys from the other stacks that are passed to the given stack as parameters
+        :rtype: list
+        """
+        declared = self.parameters[name]
+        return [key for key, producer in self.producers.iteritems()
+                if producer != name and (declared is None or key in declared)]
+
+    def order(self):
+        """
+        Stack names in a dependency order, following the configuration order where possible
+        :rtype: list
+        """
+        ordered = []
+        remaining = OrderedDict([(name, set(deps)) for name, deps in self.dependencies.iteritems()])
+        while remaining:
+            ready = [name for name, deps in remaining.iteritems() if not deps]
+            if not ready:
+                raise StackGraphException('Circular dependency between stacks: ' + ', '.join(remaining.keys()))
+            for name in ready:
+                ordered.append(name)
+                del remaining[name]
+            for deps in remaining.itervalues():
+                deps.difference_update(ready)
+        return ordered
+
+    def reversed(self):
+        """
+        Graph with the dependencies turned around, eg. for deleting the stacks
+        :rtype: StackGraph
+        """
+        graph = StackGraph.__new__(StackGraph)
+        graph.stacks = OrderedDict(reversed(self.stacks.items()))
+        graph.producers = self.producers
+        graph.parameters = self.parameters
+        graph.dependencies = OrderedDict([(name, set(self.dependents[name])) for name in graph.stacks])
+        graph.dependents = OrderedDict([(name, set(self.dependencies[name])) for name in graph.stacks])
+        return graph
+
+    def transitive_dependents(self, name):
+        found = set()
+        pending = list(self.dependents[name])
+        while pending:
+            dependent = pending.pop()
+            if dependent not in found:
+                found.add(dependent)
+                pending.extend(self.dependents[dependent])
+        return found
+
+
+class StackGraphResult(object):
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.skipped = []
+        self.results = {}
+
+    def __nonzero__(self):
+        return len(self.failed) == 0 and len(self.skipped) == 0
+
+
+def execute(graph, func, max_workers=DEFAULT_STACK_CONCURRENCY):
+    """
+    Call func with each stack name once all of its dependencies have succeeded.
+
+    Independent stacks are processed concurrently, up to max_workers at a time.
+    A stack fails if func raises an exception or returns a false value, and all
+    the stacks depending on it are skipped.
+
+    :type graph: StackGraph
+    :type max_workers: int
+    :rtype: StackGraphResult
+    """
+    result = StackGraphResult()
+    waiting = OrderedDict([(name, set(deps)) for name, deps in graph.dependencies.iteritems()])
+    running = set()
+    done = Queue.Queue()
+    lock = threading.Lock()
+
+    def run(name):
+        try:
+            value = func(name)
+        except Exception as e:
+            with lock:
+                print red("*** Stack %s failed: %s" % (name, e))
+                traceback.print_exc()
+            value = None
+        done.put((name, value))
+
+    pool = ThreadPool(max(1, max_workers))
+    try:
+        while True:
+            for name in [name for name, deps in waiting.iteritems() if not deps]:
+                del waiting[name]
+                running.add(name)
+                pool.apply_async(run, (name,))
+
+            if not running:
+                break
+
+            name, value = done.get(True, MAX_WAIT)
+            running.remove(name)
+            result.results[name] = value
+
+            if value:
+                result.succeeded.append(name)
+                for deps in waiting.itervalues():
+                    deps.discard(name)
+            else:
+                result.failed.append(name)
+                for dependent in graph.transitive_dependents(name):
+                    if dependent in waiting:
+                        del waiting[dependent]
+                        result.skipped.append(dependent)
+                        with lock:
+                            print yellow("*** Skip stack %s, depends on failed stack %s" % (dependent, name))
+    finally:
+        pool.close()
+        pool.join()
+
+    return result
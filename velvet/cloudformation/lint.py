@@ -0,0 +1,323 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import velvet.config
+from velvet.aws.config import get_region
+from velvet.cloudformation.upload import TEMPLATE_BODY_LIMIT
+
+# Maximum size of a template passed as an S3 URL
+TEMPLATE_URL_LIMIT = 460800
+
+# CloudFormation template limits
+MAX_PARAMETERS = 200
+MAX_RESOURCES = 500
+MAX_OUTPUTS = 200
+MAX_MAPPINGS = 200
+
+TEMPLATE_SECTIONS = [
+    'AWSTemplateFormatVersion',
+    'Description',
+    'Metadata',
+    'Transform',
+    'Parameters',
+    'Rules',
+    'Mappings',
+    'Conditions',
+    'Resources',
+    'Outputs',
+]
+
+PARAMETER_TYPES = [
+    'String',
+    'Number',
+    'List<Number>',
+    'CommaDelimitedList',
+]
+
+# AWS specific parameter types, eg. AWS::EC2::KeyPair::KeyName
+AWS_PARAMETER_TYPE_PREFIXES = [
+    'AWS::',
+    'List<AWS::',
+]
+
+PSEUDO_PARAMETERS = [
+    'AWS::AccountId',
+    'AWS::NotificationARNs',
+    'AWS::NoValue',
+    'AWS::Partition',
+    'AWS::Region',
+    'AWS::StackId',
+    'AWS::StackName',
+    'AWS::URLSuffix',
+]
+
+# Prefix of the pseudo parameter names
+PSEUDO_PARAMETER_PREFIX = 'AWS::'
+
+# Validation results file name in the local state directory
+VALIDATION_CACHE_FILE = 'validation.json'
+
+# Number of the latest validation results kept
+VALIDATION_CACHE_SIZE = 200
+
+
+def template_digest(body):
+    """
+    :type body: str
+    :rtype: str
+    """
+    return hashlib.sha256(body).hexdigest()
+
+
+def lint_template(body, required_outputs=None, template_url=False, warnings=None):
+    """
+    Check the template locally without calling the CloudFormation API.
+
+    All the problems found are returned at once: the JSON syntax and structure,
+    Ref and Fn::GetAtt targets, parameter types, outputs other stacks depend
+    on and the template size limits.
+
+    Template sections and pseudo parameters unknown to this list may have been
+    added to CloudFormation since, they are only warnings left for the
+    CloudFormation API to check.
+
+    :type body: str
+    :type required_outputs: list
+    :param required_outputs: Output names the template must define
+    :type template_url: bool
+    :param template_url: True if the template will be passed as S3 URL
+    :type warnings: list
+    :param warnings: Warning messages are appended to this list if given
+    :rtype: list
+    :return: Error messages, empty if the template is valid
+    """
+    errors = []
+    if warnings is None:
+        warnings = []
+
+    limit = TEMPLATE_URL_LIMIT if template_url else TEMPLATE_BODY_LIMIT
+    if len(body) > limit:
+        errors.append('Template size %d bytes exceeds the limit of %d bytes' % (len(body), limit))
+
+    try:
+        template = json.loads(body)
+    except ValueError as e:
+        errors.append('Invalid JSON: ' + str(e))
+        return errors
+
+    if not isinstance(template, dict):
+        errors.append('Template must be a JSON object')
+        return errors
+
+    for section in template:
+        if section not in TEMPLATE_SECTIONS:
+            warnings.append('Unknown template section: ' + section)
+
+    parameters = _section(template, 'Parameters', errors)
+    mappings = _section(template, 'Mappings', errors)
+    resources = _section(template, 'Resources', errors)
+    outputs = _section(template, 'Outputs', errors)
+
+    if len(resources) == 0:
+        errors.append('Template must define at least one resource')
+
+    for name, count, maximum in [('parameters', len(parameters), MAX_PARAMETERS),
+                                 ('mappings', len(mappings), MAX_MAPPINGS),
+                                 ('resources', len(resources), MAX_RESOURCES),
+                                 ('outputs', len(outputs), MAX_OUTPUTS)]:
+        if count > maximum:
+            errors.append('Template has %d %s, the maximum is %d' % (count, name, maximum))
+
+    for name, parameter in parameters.iteritems():
+        if not isinstance(parameter, dict) or 'Type' not in parameter:
+            errors.append('Parameter %s: Type missing' % name)
+            continue
+        if not _valid_parameter_type(parameter['Type']):
+            errors.append('Parameter %s: Unknown type %s' % (name, parameter['Type']))
+        elif parameter['Type'] == 'Number' and 'Default' in parameter and not _is_number(parameter['Default']):
+            errors.append('Parameter %s: Default value %s is not a number' % (name, parameter['Default']))
+
+    ref_targets = set(parameters.keys()) | set(resources.keys()) | set(PSEUDO_PARAMETERS)
+
+    for name, resource in resources.iteritems():
+        if not isinstance(resource, dict) or not isinstance(resource.get('Type'), basestring):
+            errors.append('Resource %s: Type missing' % name)
+            continue
+
+        depends_on = resource.get('DependsOn', [])
+        if isinstance(depends_on, basestring):
+            depends_on = [depends_on]
+        for dependency in depends_on:
+            if dependency not in resources:
+                errors.append('Resource %s: DependsOn undefined resource %s' % (name, dependency))
+
+        errors.extend(_check_references('Resource ' + name, resource, ref_targets, resources, warnings))
+
+    for name, output in outputs.iteritems():
+        if not isinstance(output, dict) or 'Value' not in output:
+            errors.append('Output %s: Value missing' % name)
+            continue
+        errors.extend(_check_references('Output ' + name, output, ref_targets, resources, warnings))
+
+    for name in required_outputs or []:
+        if name not in outputs:
+            errors.append('Output %s required by other stacks is not defined' % name)
+
+    return errors
+
+
+def references(node):
+    """
+    Find all Ref and Fn::GetAtt targets in a template node
+    :rtype: tuple
+    :return: Set of Ref targets and set of Fn::GetAtt resource names
+    """
+    refs = set()
+    attrs = set()
+    pending = [node]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, dict):
+            for key, value in item.iteritems():
+                if key == 'Ref' and isinstance(value, basestring):
+                    refs.add(value)
+                elif key == 'Fn::GetAtt':
+                    if isinstance(value, list) and len(value) > 0 and isinstance(value[0], basestring):
+                        attrs.add(value[0])
+                    elif isinstance(value, basestring):
+                        attrs.add(value.split('.')[0])
+                else:
+                    pending.append(value)
+        elif isinstance(item, list):
+            pending.extend(item)
+    return refs, attrs
+
+
+def _check_references(where, node, ref_targets, resources, warnings):
+    errors = []
+    refs, attrs = references(node)
+    for ref in sorted(refs - ref_targets):
+        if ref.startswith(PSEUDO_PARAMETER_PREFIX):
+            warnings.append('%s: Ref to unknown pseudo parameter %s' % (where, ref))
+            continue
+        errors.append('%s: Ref to undefined parameter or resource %s' % (where, ref))
+    for attr in sorted(attrs - set(resources.keys())):
+        errors.append('%s: Fn::GetAtt on undefined resource %s' % (where, attr))
+    return errors
+
+
+def _section(template, name, errors):
+    section = template.get(name, {})
+    if not isinstance(section, dict):
+        errors.append('Section %s must be a JSON object' % name)
+        return {}
+    return section
+
+
+def _valid_parameter_type(parameter_type):
+    if parameter_type in PARAMETER_TYPES:
+        return True
+    for prefix in AWS_PARAMETER_TYPE_PREFIXES:
+        if isinstance(parameter_type, basestring) and parameter_type.startswith(prefix):
+            return True
+    return False
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+class ValidatedTemplate(object):
+    """
+    Cached result of a successful validate_template API call
+    """
+
+    def __init__(self, description=None, parameters=None, capabilities=None):
+        self.description = description
+        self.parameters = parameters or []
+        self.capabilities = capabilities or []
+
+
+class TemplateValidationCache(object):
+    """
+    Results of the CloudFormation template validation, keyed by the region and
+    the template content hash as the AWS specific parameter types differ by
+    region. The results file is read once and only the latest results are kept.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path=None, size=VALIDATION_CACHE_SIZE, clock=time.time):
+        if path is None:
+            path = velvet.config.get_state_path(VALIDATION_CACHE_FILE)
+        self.path = path
+        self.size = size
+        self.clock = clock
+        self._data = None
+
+    def get(self, digest, region=None):
+        """
+        :type digest: str
+        :type region: str
+        :rtype: ValidatedTemplate
+        """
+        with self._lock:
+            entry = self._load().get(self._key(digest, region))
+        if entry is None:
+            return None
+        return self._validated(entry)
+
+    def set(self, digest, template, region=None):
+        """
+        :type digest: str
+        :type template: boto.cloudformation.template.Template
+        :type region: str
+        :rtype: ValidatedTemplate
+        """
+        entry = {
+            'description': template.description,
+            'parameters': [p.parameter_key for p in getattr(template, 'template_parameters', [])],
+            'capabilities': [c.value for c in getattr(template, 'capabilities', [])],
+            'validated_at': self.clock(),
+        }
+        with self._lock:
+            data = self._load()
+            data[self._key(digest, region)] = entry
+            self._prune(data)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        return self._validated(entry)
+
+    def _key(self, digest, region):
+        return get_region(region) + '/' + digest
+
+    def _validated(self, entry):
+        return ValidatedTemplate(entry.get('description'), entry.get('parameters'), entry.get('capabilities'))
+
+    def _prune(self, data):
+        if len(data) <= self.size:
+            return
+        keys = sorted(data, key=lambda key: data[key].get('validated_at', 0))
+        for key in keys[:len(data) - self.size]:
+            del data[key]
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        self._data = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except ValueError:
+                pass
+        return self._data
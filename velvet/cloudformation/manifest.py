@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import threading
+
+import velvet.config
+
+# Manifest file name in the local state directory
+MANIFEST_FILE = 'stacks.json'
+
+_lock = threading.Lock()
+
+
+def stack_digest(template, parameters=None, tags=None):
+    """
+    SHA-256 digest of everything velvet sends to CloudFormation for a stack
+    :type template: str
+    :type parameters: list of tuple
+    :type tags: dict
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    digest.update(template)
+    digest.update(json.dumps(sorted([list(p) for p in parameters or []])))
+    digest.update(json.dumps(sorted((tags or {}).items())))
+    return digest.hexdigest()
+
+
+def stack_modified_time(stack):
+    """
+    Time of the last update of the stack, or its creation if it has never been updated
+    :type stack: boto.cloudformation.stack.Stack
+    :rtype: str
+    """
+    for attr in ['last_updated_time', 'LastUpdatedTime']:
+        value = getattr(stack, attr, None)
+        if value:
+            return str(value)
+    return str(stack.creation_time)
+
+
+class StackManifest(object):
+    """
+    Local record of the template, parameters and tags digest each stack was
+    last successfully provisioned with.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = velvet.config.get_state_path(MANIFEST_FILE)
+        self.path = path
+
+    def get(self, key):
+        """
+        :type key: str
+        :rtype: dict
+        """
+        with _lock:
+            return self._load().get(key)
+
+    def record(self, key, digest, stack):
+        """
+        :type key: str
+        :type digest: str
+        :type stack: boto.cloudformation.stack.Stack
+        """
+        with _lock:
+            data = self._load()
+            data[key] = {
+                'digest': digest,
+                'stack_id': stack.stack_id,
+                'modified_time': stack_modified_time(stack),
+            }
+            self._save(data)
+
+    def remove(self, key):
+        with _lock:
+            data = self._load()
+            if key in data:
+                del data[key]
+                self._save(data)
+
+    def has_digest(self, key, digest):
+        """
+        :rtype: bool
+        """
+        entry = self.get(key)
+        return entry is not None and entry['digest'] == digest
+
+    def is_unchanged(self, key, digest, stack):
+        """
+        Check if the stack was provisioned with the same digest and has not been changed since
+        :type stack: boto.cloudformation.stack.Stack
+        :rtype: bool
+        """
+        entry = self.get(key)
+        if entry is None or stack is None:
+            return False
+        return entry['digest'] == digest and \
+            entry['stack_id'] == stack.stack_id and \
+            entry['modified_time'] == stack_modified_time(stack)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            # corrupted manifest only means that nothing is skipped
+            return {}
+
+    def _save(self, data):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
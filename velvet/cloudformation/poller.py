@@ -0,0 +1,221 @@
+import copy
+import random
+import time
+
+from collections import OrderedDict
+
+
+class PollTimeoutException(Exception):
+    pass
+
+
+class WaitStrategy(object):
+    """
+    Decides how long to wait between stack status polls
+    """
+
+    def reset(self):
+        """
+        Called when new activity, eg. stack events, has been seen
+        """
+        pass
+
+    def next_interval(self):
+        """
+        :rtype: float
+        :return: Seconds to wait before the next poll
+        """
+        raise NotImplementedError
+
+
+class FixedInterval(WaitStrategy):
+
+    def __init__(self, interval=5):
+        self.interval = interval
+
+    def next_interval(self):
+        return self.interval
+
+
+class ExponentialBackoff(WaitStrategy):
+    """
+    Interval grows exponentially from min_interval up to max_interval, with
+    random jitter added. New activity drops the interval back to the minimum,
+    so the poller follows quickly changing stacks closely and backs off on
+    long running resources.
+    """
+
+    def __init__(self, min_interval=2, max_interval=30, multiplier=1.5, jitter=0.2):
+        """
+        :type min_interval: float
+        :type max_interval: float
+        :type multiplier: float
+        :type jitter: float
+        :param jitter: Maximum random deviation as a fraction of the interval
+        """
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError('Invalid poll intervals: %s - %s' % (min_interval, max_interval))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self._interval = min_interval
+
+    def reset(self):
+        self._interval = self.min_interval
+
+    def next_interval(self):
+        interval = self._interval
+        self._interval = min(self._interval * self.multiplier, self.max_interval)
+        spread = interval * self.jitter
+        return max(0, interval + random.uniform(-spread, spread))
+
+
+class StackPoller(object):
+    """
+    Paces the stack status polling loops and keeps track of the number of
+    polls made and the time spent in each stack status.
+    """
+
+    def __init__(self, strategy=None, timeout=None, clock=time.time, sleep=time.sleep):
+        """
+        :type strategy: WaitStrategy
+        :type timeout: float
+        :param timeout: Maximum time to wait in seconds, no limit if None
+        """
+        if strategy is None:
+            strategy = ExponentialBackoff()
+        self.strategy = strategy
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.polls = 0
+        self.phases = OrderedDict()
+        self.started = clock()
+        self._phase = None
+        self._phase_started = None
+
+    def observe(self, status, activity=False):
+        """
+        Record the result of a poll
+        :type status: str
+        :param status: The current stack status
+        :type activity: bool
+        :param activity: True if the poll returned new events
+        """
+        now = self.clock()
+        self.polls += 1
+        if status != self._phase:
+            self._end_phase(now)
+            self._phase = status
+            self._phase_started = now
+        if activity:
+            self.strategy.reset()
+
+    def wait(self, sleep=None):
+        """
+        Sleep until the next poll
+        :param sleep: Called with the interval instead of the sleep function, eg. to wake up early
+        :raises PollTimeoutException: if the timeout has been reached
+        """
+        interval = self.strategy.next_interval()
+        if self.timeout is not None:
+            remaining = self.timeout - self.elapsed()
+            if remaining <= 0:
+                raise PollTimeoutException('Timed out after %s waiting for the stack (status: %s)' % (
+                    format_duration(self.elapsed()), self._phase))
+            interval = min(interval, remaining)
+        (sleep or self.sleep)(interval)
+
+    def finish(self):
+        """
+        Close the current phase
+        """
+        self._end_phase(self.clock())
+        self._phase = None
+
+    def elapsed(self):
+        return self.clock() - self.started
+
+    def summary(self):
+        """
+        :rtype: str
+        """
+        phases = ", ".join(["%s %s" % (status, format_duration(seconds))
+                            for status, seconds in self.phases.iteritems()])
+        return "%(polls)d polls in %(elapsed)s (%(phases)s)" % {
+            'polls': self.polls,
+            'elapsed': format_duration(self.elapsed()),
+            'phases': phases,
+        }
+
+    def _end_phase(self, now):
+        if self._phase is None:
+            return
+        self.phases.setdefault(self._phase, 0)
+        self.phases[self._phase] += now - self._phase_started
+
+
+def format_duration(seconds):
+    """
+    :type seconds: float
+    :rtype: str
+    :return: Duration as minutes and seconds, eg. 3m 05s, or - if unknown
+    """
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    if minutes:
+        return "%dm %02ds" % (minutes, seconds)
+    return "%ds" % seconds
+
+
+def create_strategy(config=None):
+    """
+    Create the wait strategy of the stack wait configuration, see create_poller
+    :type config: dict or StackPoller
+    :rtype: WaitStrategy
+    """
+    if isinstance(config, StackPoller):
+        # a copy keeps the intervals of the caller's poller unchanged
+        return copy.copy(config.strategy)
+
+    if config is None:
+        config = {}
+
+    strategy = config.get('strategy', 'backoff')
+    if strategy == 'fixed':
+        return FixedInterval(config.get('interval', 5))
+    elif strategy == 'backoff':
+        options = {}
+        for key in ['min_interval', 'max_interval', 'multiplier', 'jitter']:
+            if key in config:
+                options[key] = config[key]
+        return ExponentialBackoff(**options)
+    else:
+        raise ValueError('Unknown wait strategy: ' + str(strategy))
+
+
+def create_poller(config=None):
+    """
+    Create a stack poller from the stack wait configuration, eg.
+
+        wait:
+            strategy: backoff       # or fixed
+            min_interval: 2
+            max_interval: 30
+            multiplier: 1.5
+            jitter: 0.2
+            interval: 5             # fixed strategy only
+            timeout: 3600
+
+    :type config: dict or StackPoller
+    :rtype: StackPoller
+    """
+    if isinstance(config, StackPoller):
+        return config
+
+    if config is None:
+        config = {}
+
+    return StackPoller(create_strategy(config), timeout=config.get('timeout'))
@@ -0,0 +1,89 @@
+import os
+
+from collections import OrderedDict
+
+import boto.exception
+
+from fabric.colors import red, green
+
+import velvet.cloudformation.stack as cf_stack
+from velvet.cloudformation.lint import template_digest, TemplateValidationCache
+from velvet.cloudformation.upload import TemplateUploader, DEFAULT_TEMPLATE_PATH
+from velvet.pool import parallel_map, DEFAULT_WORKERS
+
+
+class PreflightResult(object):
+    """
+    Template problems found before provisioning, by stack name
+    """
+
+    def __init__(self):
+        self.errors = OrderedDict()
+
+    @property
+    def failed(self):
+        return [name for name, errors in self.errors.iteritems() if errors]
+
+    def __nonzero__(self):
+        return len(self.failed) == 0
+
+
+def preflight_stack(stack, template_file, template_bucket=None, template_path=DEFAULT_TEMPLATE_PATH):
+    """
+    Check that the stack template exists, is valid and defines the outputs the stack passes on
+    :type stack: dict
+    :type template_file: str
+    :rtype: list
+    :return: Error messages, empty if the stack can be provisioned
+    """
+    if not os.path.isfile(template_file):
+        return ['Template file %s not found' % template_file]
+
+    template_url = None
+    try:
+        if template_bucket:
+            uploader = TemplateUploader(template_bucket, template_path)
+            template, uploads = uploader.render(template_file)
+        else:
+            with open(template_file) as f:
+                template = f.read()
+
+        # uploading is needed only if the template has not been validated before
+        cache = TemplateValidationCache()
+        if template_bucket and cache.get(template_digest(template)) is None:
+            template_url = uploader.upload_all(uploads)[-1]
+
+        # linted with the template URL size limit also when the upload was skipped
+        cf_stack.validate_template(template, template_url=template_url, template_bucket=template_bucket,
+                                   required_outputs=stack.get('outputs'), cache=cache)
+    except (cf_stack.ValidationErrorException, IOError, boto.exception.BotoServerError) as e:
+        return [str(e)]
+
+    return []
+
+
+def preflight_stacks(stacks, template_files, template_bucket=None, template_path=DEFAULT_TEMPLATE_PATH,
+                     max_workers=DEFAULT_WORKERS):
+    """
+    Check all stack templates in parallel before any of the stacks is provisioned
+    :type stacks: list of dict
+    :type template_files: dict
+    :param template_files: Template file by stack name
+    :rtype: PreflightResult
+    """
+
+    def check(stack):
+        return preflight_stack(stack, template_files[stack['name']],
+                               template_bucket=template_bucket, template_path=template_path)
+
+    result = PreflightResult()
+    for stack, errors in zip(stacks, parallel_map(check, stacks, max_workers)):
+        result.errors[stack['name']] = errors
+        if errors:
+            print red('*** Stack %s: %s' % (stack['name'], template_files[stack['name']]))
+            for error in errors:
+                print red('    ' + error)
+        else:
+            print '*** Stack %s: %s' % (stack['name'], green('template OK'))
+
+    return result
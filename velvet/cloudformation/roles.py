@@ -0,0 +1,157 @@
+from collections import OrderedDict
+
+from fabric.api import env
+
+import velvet.cloudformation.stack as cf_stack
+import velvet.ec2
+from velvet.aws.config import get_region
+from velvet.pool import parallel_map
+
+# Instance attributes used as the host names
+HOST_ADDRESSES = OrderedDict([
+    ('public_dns', 'public_dns_name'),
+    ('private_dns', 'private_dns_name'),
+    ('private_ip', 'private_ip_address'),
+])
+
+DEFAULT_HOST_ADDRESS = 'public_dns'
+
+
+class RoleSpec(object):
+    """
+    Hosts of a role: the instances of a stack autoscaling group resource,
+    or the values of the stack outputs matching a regular expression.
+    """
+
+    def __init__(self, role, stack, resource=None, outputs=None, region=None):
+        """
+        :type role: str
+        :type stack: str
+        :param stack: Stack name
+        :type resource: str
+        :param resource: Logical id of the autoscaling group resource
+        :type outputs: str
+        :param outputs: Regular expression matching the output keys, as in get_stack_static_hostnames
+        :type region: str
+        """
+        if (resource is None) == (outputs is None):
+            raise ValueError('Role %s must define either resource or outputs' % role)
+        self.role = role
+        self.stack = stack
+        self.resource = resource
+        self.outputs = outputs
+        self.region = get_region(region)
+
+    @classmethod
+    def from_config(cls, role, config):
+        """
+        :type role: str
+        :type config: dict
+        :rtype: RoleSpec
+        """
+        if 'stack' not in config:
+            raise ValueError('Stack missing from role ' + role)
+        return cls(role, config['stack'], resource=config.get('resource'), outputs=config.get('outputs'),
+                   region=config.get('region'))
+
+
+def resolve_roles(specs, address=DEFAULT_HOST_ADDRESS):
+    """
+    Hosts of all the roles with batched API calls: the stacks and their
+    resources are described concurrently, then the autoscaling groups and
+    their instances are described together for each region.
+
+    :type specs: list of RoleSpec
+    :type address: str
+    :param address: public_dns, private_dns or private_ip
+    :rtype: collections.OrderedDict
+    :return: Host lists by role
+    """
+    if address not in HOST_ADDRESSES:
+        raise ValueError('Unknown host address: %s, use one of %s' % (address, ', '.join(HOST_ADDRESSES)))
+    attribute = HOST_ADDRESSES[address]
+
+    stack_keys = list(OrderedDict([((spec.region, spec.stack), True) for spec in specs]))
+    resource_keys = set([(spec.region, spec.stack) for spec in specs if spec.resource is not None])
+
+    def describe_stack(key):
+        region, stack_name = key
+        stack = cf_stack.get_stack(stack_name, region=region)
+        if stack is None:
+            raise ValueError('Stack not found: ' + stack_name)
+        cf_stack.validate_stack(stack)
+        view = cf_stack.get_stack_view(stack)
+        if key in resource_keys:
+            # list the resources in the worker thread
+            view.resources
+        return view
+
+    views = dict(zip(stack_keys, parallel_map(describe_stack, stack_keys)))
+
+    group_names = {}
+    for spec in specs:
+        if spec.resource is not None:
+            group_name = views[(spec.region, spec.stack)].get_physical_id(spec.resource)
+            if group_name is not None:
+                group_names.setdefault(spec.region, set()).add(group_name)
+
+    def describe_instances(region):
+        groups = velvet.ec2.get_autoscaling_groups(sorted(group_names[region]), region=region)
+        instance_ids = [instance_id for group in groups.itervalues()
+                        for instance_id in velvet.ec2.get_autoscaling_group_instance_ids(group)]
+        instances = dict([(i.id, i) for i in velvet.ec2.get_instance_records(instance_ids, region=region)])
+        return groups, instances
+
+    regions = sorted(group_names)
+    described = dict(zip(regions, parallel_map(describe_instances, regions)))
+
+    roles = OrderedDict()
+    for spec in specs:
+        hosts = roles.setdefault(spec.role, [])
+        view = views[(spec.region, spec.stack)]
+        if spec.outputs is not None:
+            hosts.extend(view.match_outputs(spec.outputs))
+            continue
+
+        group_name = view.get_physical_id(spec.resource)
+        if group_name is None or spec.region not in described:
+            continue
+        groups, instances = described[spec.region]
+        group = groups.get(group_name)
+        if group is None:
+            continue
+        for instance_id in velvet.ec2.get_autoscaling_group_instance_ids(group):
+            instance = instances.get(instance_id)
+            if instance is not None and instance.state == 'running' and getattr(instance, attribute):
+                hosts.append(getattr(instance, attribute))
+
+    return roles
+
+
+def load_roledefs(config=None, address=None):
+    """
+    Fill env.roledefs with the hosts of the roles in the role_hosts option, eg.
+
+        role_hosts:
+            web:
+                stack: dev-web
+                resource: WebServerGroup
+            db:
+                stack: dev-database
+                outputs: ^DatabaseHost
+
+    :type config: dict
+    :param config: Role specs by role name, the role_hosts option by default
+    :type address: str
+    :param address: public_dns, private_dns or private_ip, the host_address option by default
+    :rtype: collections.OrderedDict
+    """
+    if config is None:
+        config = env.get('role_hosts', {})
+    if address is None:
+        address = env.get('host_address', DEFAULT_HOST_ADDRESS)
+
+    specs = [RoleSpec.from_config(role, config[role]) for role in sorted(config)]
+    roles = resolve_roles(specs, address=address)
+    env.roledefs.update(roles)
+    return roles
@@ -4,9 +4,18 @@ from boto.cloudformation.stack import Stack
 import re
 
 from velvet.decorators import deprecated
+from velvet.cache import TTLCache
+from velvet.cloudformation.poller import create_poller, PollTimeoutException
+from velvet.cloudformation.manifest import StackManifest, stack_digest
+from velvet.cloudformation.view import StackView
+from velvet.cloudformation.upload import TemplateUploader, TEMPLATE_BODY_LIMIT, DEFAULT_TEMPLATE_PATH
+from velvet.cloudformation.lint import lint_template, template_digest, TemplateValidationCache
+from velvet.cloudformation.events import StackEventRecorder
+from velvet.cloudformation.waiter import get_waiter, PROVISION_WAIT_STATUSES, DELETE_WAIT_STATUSES
 
 import velvet.ec2
-from velvet.aws.config import region
+import velvet.aws.inventory
+from velvet.aws.config import get_region, in_regions, region_from_arn
 
 import boto.exception
 
@@ -15,8 +24,8 @@ import boto.exception
 
 from fabric.colors import red, green, yellow
 
-from time import sleep
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import deque
 
 STACK_COMPLETE_STATUSES = [
     # Successful creation of one or more stacks.
@@ -40,46 +49,109 @@ class CloudFormationResult(object):
     def __nonzero__(self):
         return self.succeeded and not self.failed
 
+# Stacks returned by get_stack are cached for this many seconds
+STACK_CACHE_TTL = 30
+
+_stack_cache = TTLCache(STACK_CACHE_TTL)
+_view_cache = TTLCache(STACK_CACHE_TTL)
+
+# Number of the latest event ids remembered by StackEventStream
+STACK_EVENT_WINDOW = 500
+
+# Allowed clock difference when reading events created after a stack operation started
+STACK_EVENT_CLOCK_SKEW = timedelta(minutes=1)
+
 class StackNotReadyException(Exception):
     pass
 
 class ValidationErrorException(Exception):
     pass
 
-def get_stack(stack_id):
+class StackNotFoundException(Exception):
+    pass
+
+def get_stack(stack_id, connection=None, cached=True, region=None):
     """
     Find stack with the given name or id
     :type stack_id: str
+    :type connection: boto.cloudformation.connection.CloudFormationConnection
+    :type cached: bool
+    :type region: str
     :rtype: boto.cloudformation.stack.Stack
     """
-    cf = boto.cloudformation.connect_to_region(region)
 
-    stacks = cf.describe_stacks()
-    for stack in stacks:
-        if stack.stack_name == stack_id:
-            return stack
-        if stack.stack_id == stack_id:
+    region = _connection_region(connection, region or region_from_arn(stack_id))
+
+    if cached:
+        stack = _stack_cache.get((region, stack_id))
+        if stack is not None:
             return stack
 
-    # no stacks found matching the name or id
-    return None
+    stack = _find_stack(stack_id, connection=connection, region=region)
+
+    # describing a stack by its id returns deleted stacks as well
+    if stack is None or stack.stack_status == 'DELETE_COMPLETE':
+        return None
+
+    _stack_cache.set([(region, stack.stack_name), (region, stack.stack_id)], stack)
+    return stack
+
+
+def get_stack_in_regions(stack_id, regions=None):
+    """
+    Find the stack with the given name in each region concurrently
+    :type stack_id: str
+    :type regions: list
+    :rtype: collections.OrderedDict
+    :return: Stack or None by region
+    """
+    return in_regions(lambda region: get_stack(stack_id, region=region), regions)
+
+
+def invalidate_stack(stack_id, region=None):
+    """
+    Remove stack with the given name or id from the stack and stack view caches
+    :type stack_id: str
+    :type region: str
+    """
+    region = get_region(region or region_from_arn(stack_id))
+    _stack_cache.invalidate((region, stack_id))
+    _view_cache.invalidate((region, stack_id))
+
+
+def get_stack_view(stack):
+    """
+    Shared view of the stack outputs and resources, cached like the stacks in get_stack
+    :type stack: boto.cloudformation.stack.Stack or velvet.cloudformation.view.StackView
+    :rtype: velvet.cloudformation.view.StackView
+    """
+    if isinstance(stack, StackView):
+        return stack
+
+    region = get_stack_region(stack)
+    view = _view_cache.get((region, stack.stack_id))
+    if view is None or view.stack.stack_status != stack.stack_status:
+        view = StackView(stack)
+        _view_cache.set([(region, stack.stack_name), (region, stack.stack_id)], view)
+    return view
 
 
 def get_stack_resource(stack, name):
     """
     :type stack: boto.cloudformation.stack.Stack
     :type name: str
+    :rtype: dict
+    :return: Resource details or None if the stack has no such resource
     """
-    resource = stack.describe_resource(name)
-    return resource['DescribeStackResourceResponse']['DescribeStackResourceResult']['StackResourceDetail']
+    return get_stack_view(stack).get_resource(name)
 
 
 def validate_stack(stack):
     """
-    :type stack: boto.cloudformation.stack.Stack
+    :type stack: boto.cloudformation.stack.Stack or velvet.aws.inventory.StackRecord
     """
 
-    if not isinstance(stack, Stack):
+    if not isinstance(stack, (Stack, velvet.aws.inventory.StackRecord)):
         raise ValueError("Stack must be instance of boto.cloudformation.stack.Stack")
 
     if stack.stack_status in STACK_COMPLETE_STATUSES:
@@ -93,30 +165,97 @@ def validate_stack(stack):
 
 def get_stack_autoscaling_group(stack, resource_name):
     resource = get_stack_resource(stack, resource_name)
-    return velvet.ec2.get_autoscaling_group(resource['PhysicalResourceId'])
+    if resource is None:
+        return None
+    return velvet.ec2.get_autoscaling_group(resource['PhysicalResourceId'], region=get_stack_region(stack))
 
 
-def get_stack_autoscaling_group_instances(stack, resource_name):
+def get_stack_autoscaling_groups(stack, resource_names):
+    """
+    Autoscaling groups of the stack resources, looked up with a single API call
+    :type stack: boto.cloudformation.stack.Stack
+    :type resource_names: list
+    :rtype: dict
+    :return: Autoscaling groups by resource name, None if not found
+    """
+    group_names = {}
+    for resource_name in resource_names:
+        resource = get_stack_resource(stack, resource_name)
+        if resource is not None:
+            group_names[resource_name] = resource['PhysicalResourceId']
+
+    groups = velvet.ec2.get_autoscaling_groups(group_names.values(), region=get_stack_region(stack))
+    return dict([(resource_name, groups.get(group_names.get(resource_name))) for resource_name in resource_names])
+
+
+def get_stack_autoscaling_group_instances(stack, resource_name, max_age=None, region=None):
+    """
+    :type stack: boto.cloudformation.stack.Stack or str
+    :param stack: Stack or stack name
+    :type max_age: float
+    :param max_age: Use the local inventory if synced within max_age seconds, the inventory_max_age option by default
+    :type region: str
+    :rtype: list of velvet.ec2.InstanceRecord
+    :raises StackNotFoundException: if the stack does not exist
+    """
 
-    validate_stack(stack)
+    max_age = velvet.aws.inventory.get_max_age(max_age)
+    if max_age is not None:
+        # the stack status and resources are read from the inventory without describing the stack
+        record = velvet.aws.inventory.get_stack(stack, max_age, region=region)
+        if record is not None:
+            validate_stack(record)
+            instances = velvet.aws.inventory.get_stack_autoscaling_group_instances(stack, resource_name, max_age,
+                                                                                   region=region)
+            if instances is not None:
+                return instances
+
+    if isinstance(stack, basestring):
+        stack_name = stack
+        stack = get_stack(stack_name, region=region)
+        if stack is None:
+            raise StackNotFoundException("Stack %(stack_name)s not found" % { 'stack_name': stack_name })
+
+    validate_stack(get_stack_view(stack).stack)
 
     as_group = get_stack_autoscaling_group(stack, resource_name)
+    if as_group is None:
+        return None
 
     instance_ids = velvet.ec2.get_autoscaling_group_instance_ids(as_group)
     if instance_ids is not None and len(instance_ids) > 0:
-        return velvet.ec2.get_instances(instance_ids)
+        return velvet.ec2.get_instance_records(instance_ids, region=get_stack_region(stack))
 
     return None
 
 
-def get_stack_autoscaling_group_hosts(stack, resource_name):
+def get_stack_autoscaling_group_instances_in_regions(stack_name, resource_name, regions=None):
+    """
+    Instances of the stack autoscaling group in each region concurrently
+    :type stack_name: str
+    :type resource_name: str
+    :type regions: list
+    :rtype: collections.OrderedDict
+    :return: Instances by region, None if the stack or the group is not found in the region
+    """
+
+    def get_instances(region):
+        stack = get_stack(stack_name, region=region)
+        if stack is None:
+            return None
+        return get_stack_autoscaling_group_instances(stack, resource_name)
+
+    return in_regions(get_instances, regions)
+
+
+def get_stack_autoscaling_group_hosts(stack, resource_name, max_age=None, region=None):
 
     hosts = []
-    instances = get_stack_autoscaling_group_instances(stack, resource_name)
+    instances = get_stack_autoscaling_group_instances(stack, resource_name, max_age=max_age, region=region)
     if instances is not None and len(instances) > 0:
         for i in instances:
-            hostname = i.__dict__['public_dns_name']
-            if hostname is not '':
+            hostname = i.public_dns_name
+            if hostname:
                 hosts.append(hostname)
 
     return hosts
@@ -124,36 +263,45 @@ def get_stack_autoscaling_group_hosts(stack, resource_name):
 
 def get_stack_static_hostnames(stack, match):
 
-    hosts = []
-
-    validate_stack(stack)
+    view = get_stack_view(stack)
+    validate_stack(view.stack)
 
-    for output in stack.outputs:
-        m = re.match(match, output.key)
-        if m:
-            hosts.append(output.value)
-    return hosts
+    return view.match_outputs(match)
 
 
 def get_stack_outputs(stack):
 
-    validate_stack(stack)
+    view = get_stack_view(stack)
+    validate_stack(view.stack)
 
-    outputs = {}
-    for output in stack.outputs:
-        outputs[output.key] = output.value
-    return outputs
+    return dict(view.outputs)
 
 
 def get_stack_output_value(stack, key):
 
-    validate_stack(stack)
+    view = get_stack_view(stack)
+    validate_stack(view.stack)
 
-    for output in stack.outputs:
-        if key == output.key:
-            return output.value
+    return view.get_output(key)
+
+
+def _connection_region(connection, region=None):
+    """
+    Region of the connection unless the region is given
+    :rtype: str
+    """
+    if region is None and connection is not None:
+        return connection.region.name
+    return get_region(region)
 
-    return None
+
+def get_stack_region(stack):
+    """
+    Region of the stack from its stack id
+    :type stack: boto.cloudformation.stack.Stack or velvet.cloudformation.view.StackView
+    :rtype: str
+    """
+    return get_region(region_from_arn(stack.stack_id))
 
 
 def _find_stack(stack_id, connection=None, region=None):
@@ -164,7 +312,7 @@ def _find_stack(stack_id, connection=None, region=None):
     """
 
     if connection is None:
-        connection = boto.cloudformation.connect_to_region(region)
+        connection = boto.cloudformation.connect_to_region(get_region(region))
 
     stacks = None
     try:
@@ -176,74 +324,112 @@ def _find_stack(stack_id, connection=None, region=None):
     return None
 
 
-def delete_stack(stack_name, delete_failed_stacks=False):
+def start_delete_stack(stack_name, delete_failed_stacks=False, connection=None, region=None):
     """
+    Request deletion of a stack without waiting for it to complete
     :param stack_name: Stack name or id to delete
+    :type delete_failed_stacks: bool
+    :type connection: boto.cloudformation.connection.CloudFormationConnection
+    :type region: str
+    :rtype: boto.cloudformation.stack.Stack
+    :return: The stack as it was before the delete request or None if the request failed
+    :raises StackNotFoundException: if the stack does not exist
+    :raises StackNotReadyException: if the stack is not in a state that can be deleted
     """
 
-    print ""
-    cf = boto.cloudformation.connect_to_region(region)
+    region = _connection_region(connection, region)
+    if connection is None:
+        connection = boto.cloudformation.connect_to_region(region)
 
-    def find_stack(stack_name):
-        """
-        :type stack_name: str
-        :rtype: boto.cloudformation.stack.Stack
-        """
-        return _find_stack(stack_name, connection=cf)
+    stack = _find_stack(stack_name, connection=connection)
+    if not stack or stack.stack_status == 'DELETE_COMPLETE':
+        raise StackNotFoundException("Stack %(stack_name)s not found" % { 'stack_name': stack_name })
 
-    print "Stack Name:        " + stack_name
+    # Allow deletion of failed stacks?
+    if delete_failed_stacks and stack.stack_status in ['CREATE_FAILED', 'DELETE_FAILED']:
+        print '*** Delete failed stack %(stack_name)s' % { 'stack_name': stack_name }
+    else:
+        # Delete only completed stacks
+        validate_stack(stack)
+        print '*** Delete existing stack %(stack_name)s' % { 'stack_name': stack_name }
 
-    stack = find_stack(stack_name)
-    if stack:
+    status = connection.delete_stack(stack_name)
 
-        print ""
+    StackManifest().remove(region + '/' + stack.stack_name)
+    invalidate_stack(stack_name, region=region)
+    invalidate_stack(stack.stack_id)
 
-        status = False
+    if not status:
+        return None
+    return stack
 
-        # Allow deletion of failed stacks?
-        if delete_failed_stacks and stack.stack_status in ['CREATE_FAILED', 'DELETE_FAILED']:
-            print '*** Delete failed stack %(stack_name)s' % { 'stack_name': stack_name }
-            status = cf.delete_stack(stack_name)
 
-        else:
+def delete_stack(stack_name, delete_failed_stacks=False, wait=None, region=None):
+    """
+    :param stack_name: Stack name or id to delete
+    :type wait: dict or velvet.cloudformation.poller.StackPoller
+    :param wait: Stack status polling options, see velvet.cloudformation.poller.create_poller
+    :type region: str
+    """
 
-            # Delete only completed stacks
-            try:
-                validate_stack(stack)
-            except StackNotReadyException as e:
-                print red("*** " + str(e))
-                return False
+    print ""
+    region = get_region(region)
+    cf = boto.cloudformation.connect_to_region(region)
 
-            print '*** Delete existing stack %(stack_name)s' % { 'stack_name': stack_name }
-            status = cf.delete_stack(stack_name)
+    print "Stack Name:        " + stack_name
+    print ""
 
-        events = StackEventStream(stack, cf)
+    started = datetime.utcnow() - STACK_EVENT_CLOCK_SKEW
 
-        stack = find_stack(stack_name)
-        if not status:
-            print '*** Stack deleting failed - stack status: ' + red(stack.stack_status)
-            return False
+    try:
+        stack = start_delete_stack(stack_name, delete_failed_stacks, connection=cf)
+    except StackNotFoundException:
+        print red('*** Stack not found')
+        return False
+    except StackNotReadyException as e:
+        print red("*** " + str(e))
+        return False
 
-        _print_events(events.new_events())
+    if stack is None:
+        print red('*** Stack deleting failed')
+        return False
 
-        # Update stack status while deleting is still in progress
-        while stack.stack_status in ['DELETE_IN_PROGRESS']:
-            sleep(5)
-            stack = find_stack(stack.stack_id)
-            _print_events(events.new_events())
+    recorder = StackEventRecorder(stack.stack_name, 'delete', region)
+    events = StackEventStream(stack, cf, since=started, recorder=recorder)
+    poller = create_poller(wait)
 
-        if stack.stack_status == 'DELETE_COMPLETE':
-            print '*** Stack deleting complete - stack status: ' + green(stack.stack_status)
-            return True
-        else:
-            print '*** Stack deleting failed - stack status: ' + red(stack.stack_status)
-            return False
+    # the stack status is followed by the waiter shared with the other stack operations,
+    # deleted stacks can only be found with the stack id
+    waiter = get_waiter(region)
+    future = waiter.watch(stack.stack_id, DELETE_WAIT_STATUSES, wait=poller)
 
-    else:
+    new_events = events.new_events()
+    _print_events(new_events)
+    poller.observe('DELETE_IN_PROGRESS', activity=len(new_events) > 0)
 
-        print ""
+    # Print stack events while deleting is still in progress
+    try:
+        while not future.done():
+            poller.wait(sleep=future.wait)
+            new_events = events.new_events()
+            _print_events(new_events)
+            poller.observe(_future_status(future, 'DELETE_IN_PROGRESS'), activity=len(new_events) > 0)
+    except PollTimeoutException as e:
+        waiter.cancel(future)
+        print red('*** ' + str(e))
+        return False
+    finally:
+        poller.finish()
+        print '*** ' + stack_name + ': ' + poller.summary()
 
-        print red('*** Stack not found')
+    stack = future.stack
+    invalidate_stack(stack.stack_id)
+
+    if stack.stack_status == 'DELETE_COMPLETE':
+        print '*** Stack deleting complete - stack status: ' + green(stack.stack_status)
+        return True
+    else:
+        print '*** Stack deleting failed - stack status: ' + red(stack.stack_status)
         return False
 
 
@@ -261,26 +447,87 @@ def provision_stack(stack_name, environment, project):
     return provision_stack_with_template(stack_name, template_file, tags=tags)
 
 class StackEventStream(object):
+    """
+    Incremental reader for the stack events.
 
-    def __init__(self, stack, connection=None):
+    Events are paged newest first and paging stops at the first event that has
+    already been seen, so each poll usually costs a single small API page no
+    matter how long the stack event history is. Only a bounded window of
+    the latest event ids is kept in memory.
+    """
+
+    def __init__(self, stack, connection=None, since=None, window=STACK_EVENT_WINDOW, recorder=None):
         """
         :type stack: boto.cloudformation.stack.Stack
         :type connection: boto.cloudformation.connection.CloudFormationConnection
+        :type since: datetime.datetime
+        :param since: Ignore events older than this UTC timestamp
+        :type window: int
+        :param window: Number of event ids to remember
+        :type recorder: velvet.cloudformation.events.StackEventRecorder
+        :param recorder: Log the new events of the run
         """
         self.connection = connection
         self.stack = stack
-        self.events = []
-        self.cursor = 0
-        self.start_time = datetime.now()
+        self.since = since
+        self.recorder = recorder
+        self.start_time = datetime.utcnow()
+        self._seen = deque(maxlen=window)
+        self._seen_ids = set()
 
     def new_events(self):
-        def filter_old_events(event):
-            return True
-            # return event.timestamp > self.start_time
-        self.events = self.stack.describe_events()
-        new = filter(filter_old_events, self.events[:len(self.events) - self.cursor])
-        self.cursor = len(self.events)
-        return new
+        """
+        Return events created after the previous call, newest first
+        :rtype: list of boto.cloudformation.stack.StackEvent
+        """
+        first_poll = len(self._seen_ids) == 0
+
+        new = []
+        next_token = None
+        while True:
+            page = self._describe_events(next_token)
+            for event in page:
+                if event.event_id in self._seen_ids:
+                    return self._remember(new)
+                if self.since is not None and event.timestamp < self.since:
+                    return self._remember(new)
+                new.append(event)
+
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                break
+
+            # without a watermark only the latest page is read on the first poll
+            if first_poll and self.since is None:
+                break
+
+        return self._remember(new)
+
+    def _describe_events(self, next_token=None):
+        if self.connection is not None:
+            return self.connection.describe_stack_events(self.stack.stack_id, next_token)
+        return self.stack.describe_events(next_token=next_token)
+
+    def _remember(self, events):
+        for event in reversed(events):
+            if len(self._seen) == self._seen.maxlen:
+                self._seen_ids.discard(self._seen[0])
+            self._seen.append(event.event_id)
+            self._seen_ids.add(event.event_id)
+        if self.recorder is not None:
+            self.recorder.record(events)
+        return events
+
+
+def _future_status(future, default):
+    """
+    Latest stack status seen by the waiter
+    :type future: velvet.cloudformation.waiter.StackFuture
+    :rtype: str
+    """
+    if future.stack is None:
+        return default
+    return future.stack.stack_status
 
 
 def _print_events(events):
@@ -304,17 +551,59 @@ def _print_events(events):
             if e.resource_status_reason is not None:
                 status += " (" + e.resource_status_reason + ")"
 
-            print timestamp + " - " + resource + " " + status
+            # stacks can be provisioned concurrently, show which stack the event belongs to
+            print timestamp + " - " + e.stack_name + " - " + resource + " " + status
 
 
 
-def validate_template(template, connection=None):
+def _template_args(template, template_url=None):
+    """
+    Pass the template to CloudFormation by URL if it has been uploaded to S3
+    :rtype: dict
+    """
+    if template_url:
+        return { 'template_url': template_url }
+    return { 'template_body': template }
+
+
+def validate_template(template, connection=None, template_url=None, required_outputs=None, cache=None, region=None,
+                      template_bucket=None):
+    """
+    Validate the template locally first and then with CloudFormation.
+
+    Templates that have been validated by CloudFormation before are not sent
+    again, the previous result is looked up by the template content hash.
+
+    :type template: str
+    :type template_bucket: str
+    :param template_bucket: The template is passed to CloudFormation by URL from this bucket, even if not uploaded
+    :type required_outputs: list
+    :param required_outputs: Output names the template must define
+    :type cache: velvet.cloudformation.lint.TemplateValidationCache
+    :rtype: velvet.cloudformation.lint.ValidatedTemplate
+    """
+
+    warnings = []
+    errors = lint_template(template, required_outputs, template_url=bool(template_url or template_bucket),
+                           warnings=warnings)
+    for warning in warnings:
+        print yellow('*** Template warning: ' + warning)
+    if errors:
+        raise ValidationErrorException('; '.join(errors))
+
+    region = _connection_region(connection, region)
+    if cache is None:
+        cache = TemplateValidationCache()
+    digest = template_digest(template)
+    valid = cache.get(digest, region)
+    if valid is not None:
+        return valid
 
     if connection is None:
         connection = boto.cloudformation.connect_to_region(region)
 
     try:
-        return connection.validate_template(template)
+        valid = connection.validate_template(**_template_args(template, template_url))
     except boto.exception.BotoServerError as e:
 
         if not e.error_code == 'ValidationError':
@@ -323,17 +612,30 @@ def validate_template(template, connection=None):
 
         raise ValidationErrorException(e.message)
 
+    return cache.set(digest, valid, region)
+
 
-def provision_stack_with_template(stack_name, template_file, tags=None, disable_rollback=False, parameters=None, return_stack=False):
+def provision_stack_with_template(stack_name, template_file, tags=None, disable_rollback=False, parameters=None, return_stack=False, wait=None, force=False, template_bucket=None, template_path=DEFAULT_TEMPLATE_PATH, region=None):
     """
     Provision a new CloudFormation stack with the given name and template file.
     :type stack_name: str
     :type template_file: str
     :type tags: dict
     :type disable_rollback: bool
+    :type wait: dict or velvet.cloudformation.poller.StackPoller
+    :param wait: Stack status polling options, see velvet.cloudformation.poller.create_poller
+    :type force: bool
+    :param force: Update the stack even if nothing has changed since it was last provisioned
+    :type template_bucket: str
+    :param template_bucket: Upload the template into this S3 bucket and pass it to CloudFormation as URL
+    :type template_path: str
+    :param template_path: Key prefix for the uploaded templates
+    :type region: str
+    :param region: Region to provision the stack in, the current region by default
     """
 
     print ""
+    region = get_region(region)
     cf = boto.cloudformation.connect_to_region(region)
 
     def find_stack(stack_name):
@@ -345,11 +647,41 @@ def provision_stack_with_template(stack_name, template_file, tags=None, disable_
 
     # read the template from the file
     template = None
-    with open(template_file) as f:
-        template = f.read()
+    template_url = None
+    if template_bucket:
+        uploader = TemplateUploader(template_bucket, template_path)
+        template, uploads = uploader.render(template_file)
+    else:
+        with open(template_file) as f:
+            template = f.read()
+        if len(template) > TEMPLATE_BODY_LIMIT:
+            print yellow("*** Template is larger than %d bytes, configure a template bucket to upload it to S3" % TEMPLATE_BODY_LIMIT)
+
+    # skip stacks provisioned with the same template, parameters and tags
+    manifest = StackManifest()
+    manifest_key = region + '/' + stack_name
+    digest = stack_digest(template, parameters, tags)
+    if not force and manifest.has_digest(manifest_key, digest):
+        stack = get_stack(stack_name, region=region)
+        if stack and stack.stack_status in STACK_COMPLETE_STATUSES and \
+                manifest.is_unchanged(manifest_key, digest, stack):
+            print "Stack Name:        " + stack_name
+            print yellow("*** Stack unchanged since it was last provisioned, skip update")
+
+            if return_stack:
+                return stack
+
+            result = CloudFormationResult()
+            result.failed = False
+            result.succeeded = not result.failed
+            result.stack = stack
+            return result
+
+    if template_bucket:
+        template_url = uploader.upload_all(uploads)[-1]
 
     try:
-        valid = validate_template(template, connection=cf)
+        valid = validate_template(template, connection=cf, template_url=template_url)
     except ValidationErrorException as e:
         print red("*** Template validation failed: " + str(e))
         result = CloudFormationResult()
@@ -359,7 +691,7 @@ def provision_stack_with_template(stack_name, template_file, tags=None, disable_
         return result
 
     print "Stack Name:        " + stack_name
-    print "Stack Description: " + valid.description
+    print "Stack Description: " + (valid.description or '')
     print ""
 
     stack = find_stack(stack_name)
@@ -378,12 +710,17 @@ def provision_stack_with_template(stack_name, template_file, tags=None, disable_
         print "Stack Status: " + stack.stack_status
 
         print '*** Updating existing stack %(stack_name)s' % { 'stack_name': stack_name }
+        operation = 'update'
+        started = datetime.utcnow() - STACK_EVENT_CLOCK_SKEW
         try:
-            stack_id = cf.update_stack(stack_name, template_body=template, tags=tags, disable_rollback=disable_rollback, parameters=parameters)
+            stack_id = cf.update_stack(stack_name, tags=tags, disable_rollback=disable_rollback, parameters=parameters,
+                                       **_template_args(template, template_url))
         except boto.exception.BotoServerError as e:
             if e.message == "No updates are to be performed.":
                 print yellow("*** Update failed: " + e.message)
 
+                manifest.record(manifest_key, digest, stack)
+
                 if return_stack:
                     return stack
 
@@ -404,7 +741,13 @@ def provision_stack_with_template(stack_name, template_file, tags=None, disable_
 
     else:
         print '*** Creating new stack %(stack_name)s' % { 'stack_name': stack_name }
-        stack_id = cf.create_stack(stack_name, template_body=template, tags=tags, disable_rollback=disable_rollback, parameters=parameters)
+        operation = 'create'
+        started = datetime.utcnow() - STACK_EVENT_CLOCK_SKEW
+        stack_id = cf.create_stack(stack_name, tags=tags, disable_rollback=disable_rollback, parameters=parameters,
+                                   **_template_args(template, template_url))
+
+    # drop cached copies of the stack being changed
+    invalidate_stack(stack_name, region=region)
 
     # These are the statuses for successful builds
     desired_stack_statuses = ["CREATE_COMPLETE",
@@ -420,19 +763,46 @@ def provision_stack_with_template(stack_name, template_file, tags=None, disable_
         return result
 
     stack = find_stack(stack_id)
-    events = StackEventStream(stack, cf)
+    events = StackEventStream(stack, cf, since=started,
+                              recorder=StackEventRecorder(stack_name, operation, region))
+    poller = create_poller(wait)
 
-    _print_events(events.new_events())
+    # the stack status is followed by the waiter shared with the other stack operations
+    waiter = get_waiter(region)
+    future = waiter.watch(stack_id, PROVISION_WAIT_STATUSES, stack, wait=poller)
 
-    # Update stack status while create or update is still in progress
-    while stack.stack_status in ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS']:
-        sleep(5)
-        stack = find_stack(stack_id)
-        _print_events(events.new_events())
+    new_events = events.new_events()
+    _print_events(new_events)
+    poller.observe(stack.stack_status, activity=len(new_events) > 0)
+
+    # Print stack events while create or update is still in progress
+    try:
+        while not future.done():
+            poller.wait(sleep=future.wait)
+            new_events = events.new_events()
+            _print_events(new_events)
+            poller.observe(_future_status(future, stack.stack_status), activity=len(new_events) > 0)
+    except PollTimeoutException as e:
+        waiter.cancel(future)
+        print red('*** ' + str(e))
+        invalidate_stack(stack.stack_id)
+        result = CloudFormationResult()
+        result.failed = True
+        result.succeeded = not result.failed
+        result.error = str(e)
+        return result
+    finally:
+        poller.finish()
+        print '*** ' + stack_name + ': ' + poller.summary()
+
+    stack = future.stack
+    invalidate_stack(stack.stack_id)
 
     if stack.stack_status in desired_stack_statuses:
         print green('*** Stack provisioning complete - stack status: ' + stack.stack_status)
 
+        manifest.record(manifest_key, digest, stack)
+
         if return_stack:
             return stack
 
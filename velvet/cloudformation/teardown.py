@@ -0,0 +1,166 @@
+import boto.cloudformation
+import threading
+
+from datetime import datetime
+from collections import OrderedDict
+
+from fabric.colors import red, green, yellow
+
+import velvet.cloudformation.stack as cf_stack
+from velvet.cloudformation.graph import StackGraphResult, DEFAULT_STACK_CONCURRENCY
+from velvet.cloudformation.poller import create_poller, PollTimeoutException
+from velvet.cloudformation.events import StackEventRecorder
+from velvet.cloudformation.waiter import get_waiter, DELETE_WAIT_STATUSES
+from velvet.aws.config import get_region
+
+
+class StackTeardown(object):
+    """
+    Deletes a graph of stacks, the stacks depending on a stack are deleted before it.
+
+    Deletion of a stack is requested as soon as all the stacks depending on it
+    are gone, so independent stacks are deleted concurrently. The status of
+    all deletions in progress is followed by the shared stack waiter of the
+    region. When a deletion fails, the stacks it depends on are left in place.
+    """
+
+    def __init__(self, graph, delete_failed_stacks=False, wait=None,
+                 max_concurrent=DEFAULT_STACK_CONCURRENCY, connection=None, region=None):
+        """
+        :type graph: velvet.cloudformation.graph.StackGraph
+        :param graph: Provisioning dependency graph of the stacks
+        :type delete_failed_stacks: bool
+        :type wait: dict or velvet.cloudformation.poller.StackPoller
+        :type max_concurrent: int
+        :type connection: boto.cloudformation.connection.CloudFormationConnection
+        :type region: str
+        """
+        self.graph = graph.reversed()
+        self.delete_failed_stacks = delete_failed_stacks
+        self.poller = create_poller(wait)
+        self.max_concurrent = max(1, max_concurrent)
+        self.connection = connection
+        if self.connection is None:
+            self.connection = boto.cloudformation.connect_to_region(get_region(region))
+        self.waiter = get_waiter(cf_stack._connection_region(connection, region))
+
+        self.result = StackGraphResult()
+        self._waiting = OrderedDict([(name, set(deps)) for name, deps in self.graph.dependencies.iteritems()])
+        self._in_progress = OrderedDict()
+        self._changed = threading.Event()
+
+    def run(self):
+        """
+        :rtype: velvet.cloudformation.graph.StackGraphResult
+        """
+        try:
+            self._start_ready()
+            while self._in_progress:
+                self.poller.wait(sleep=self._wait_for_change)
+                self._poll()
+                self._start_ready()
+        except PollTimeoutException as e:
+            print red('*** ' + str(e))
+            for name, (future, events) in self._in_progress.items():
+                self.waiter.cancel(future)
+                self._failed(name)
+        finally:
+            self.poller.finish()
+            print '*** Delete stacks: ' + self.poller.summary()
+
+        return self.result
+
+    def _start_ready(self):
+        while len(self._in_progress) < self.max_concurrent:
+            ready = [name for name, deps in self._waiting.iteritems() if not deps]
+            if not ready:
+                return
+            name = ready[0]
+            del self._waiting[name]
+            self._start(name)
+
+    def _start(self, name):
+        print "--> Delete stack %s" % name
+        started = datetime.utcnow() - cf_stack.STACK_EVENT_CLOCK_SKEW
+
+        try:
+            stack = cf_stack.start_delete_stack(name, self.delete_failed_stacks, connection=self.connection)
+        except cf_stack.StackNotFoundException:
+            print yellow('*** Stack %s not found, nothing to delete' % name)
+            self._succeeded(name)
+            return
+        except cf_stack.StackNotReadyException as e:
+            print red("*** " + str(e))
+            self._failed(name)
+            return
+
+        if stack is None:
+            print red('*** Stack %s deleting failed' % name)
+            self._failed(name)
+            return
+
+        recorder = StackEventRecorder(stack.stack_name, 'delete', cf_stack.get_stack_region(stack))
+        events = cf_stack.StackEventStream(stack, self.connection, since=started, recorder=recorder)
+
+        # deleted stacks are still found by the stack id
+        future = self.waiter.watch(stack.stack_id, DELETE_WAIT_STATUSES, wait=self.poller)
+        future.add_done_callback(lambda future: self._changed.set())
+        self._in_progress[name] = (future, events)
+
+    def _wait_for_change(self, interval):
+        """
+        Sleep for the interval or until one of the deletions has finished
+        """
+        self._changed.wait(interval)
+        self._changed.clear()
+
+    def _poll(self):
+        activity = False
+        for name, (future, events) in self._in_progress.items():
+            new_events = events.new_events()
+            cf_stack._print_events(new_events)
+            if len(new_events) > 0:
+                activity = True
+
+            if not future.done():
+                continue
+
+            stack = future.stack
+            del self._in_progress[name]
+            cf_stack.invalidate_stack(stack.stack_id)
+
+            if stack.stack_status == 'DELETE_COMPLETE':
+                print '*** Stack %s deleting complete - stack status: %s' % (name, green('DELETE_COMPLETE'))
+                self._succeeded(name)
+            else:
+                print '*** Stack %s deleting failed - stack status: %s' % (name, red(stack.stack_status))
+                self._failed(name)
+
+        self.poller.observe('DELETE_IN_PROGRESS', activity=activity)
+
+    def _succeeded(self, name):
+        self.result.succeeded.append(name)
+        self.result.results[name] = True
+        for deps in self._waiting.itervalues():
+            deps.discard(name)
+
+    def _failed(self, name):
+        self.result.failed.append(name)
+        self.result.results[name] = False
+        for dependent in self.graph.transitive_dependents(name):
+            if dependent in self._waiting:
+                del self._waiting[dependent]
+                self.result.skipped.append(dependent)
+                print yellow("*** Keep stack %s, stack %s depending on it was not deleted" % (dependent, name))
+
+
+def delete_stacks(graph, delete_failed_stacks=False, wait=None, max_concurrent=DEFAULT_STACK_CONCURRENCY,
+                  region=None):
+    """
+    Delete all stacks in the graph in a reverse dependency order
+    :type graph: velvet.cloudformation.graph.StackGraph
+    :rtype: velvet.cloudformation.graph.StackGraphResult
+    """
+    teardown = StackTeardown(graph, delete_failed_stacks=delete_failed_stacks, wait=wait,
+                             max_concurrent=max_concurrent, region=region)
+    return teardown.run()
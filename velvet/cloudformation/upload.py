@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+
+from collections import OrderedDict
+
+from boto.s3.connection import S3Connection
+from boto.s3.key import Key
+
+from velvet.pool import parallel_map
+
+# Maximum size of a template passed in the request body instead of an S3 URL
+TEMPLATE_BODY_LIMIT = 51200
+
+# Default key prefix for the uploaded templates in the bucket
+DEFAULT_TEMPLATE_PATH = 'cloudformation'
+
+
+def _is_url(value):
+    return value.startswith('https://') or value.startswith('http://')
+
+
+class TemplateUploader(object):
+    """
+    Uploads templates to S3 under a key named after the content hash.
+
+    Templates already in the bucket are not uploaded again. Nested stack
+    templates referenced with a local file path in the TemplateURL property
+    are uploaded in parallel the same way, and the parent template is
+    rewritten to point to their S3 URLs.
+    """
+
+    def __init__(self, bucket_name, path=DEFAULT_TEMPLATE_PATH):
+        """
+        :type bucket_name: str
+        :type path: str
+        :param path: Key prefix for the templates
+        """
+        self.bucket_name = bucket_name
+        self.path = path.strip('/')
+
+    def key_name(self, body):
+        """
+        :type body: str
+        :rtype: str
+        """
+        name = hashlib.sha256(body).hexdigest() + '.json'
+        if self.path:
+            return self.path + '/' + name
+        return name
+
+    def url(self, key_name):
+        return "https://%(bucket)s.s3.amazonaws.com/%(key)s" % {
+            'bucket': self.bucket_name,
+            'key': key_name,
+        }
+
+    def upload(self, body):
+        """
+        Upload template body unless it already exists in the bucket
+        :type body: str
+        :rtype: str
+        :return: Template URL
+        """
+        # connections are not shared between the upload threads
+        conn = S3Connection()
+        bucket = conn.get_bucket(self.bucket_name, validate=False)
+
+        key_name = self.key_name(body)
+        if bucket.get_key(key_name) is None:
+            key = Key(bucket)
+            key.key = key_name
+            key.set_contents_from_string(body, headers={'Content-Type': 'application/json'})
+
+        return self.url(key_name)
+
+    def upload_all(self, bodies):
+        """
+        Upload templates in parallel
+        :type bodies: list of str
+        :rtype: list of str
+        :return: Template URLs
+        """
+        return parallel_map(self.upload, bodies)
+
+    def render(self, template_file):
+        """
+        Read the template and point the nested stacks with a local TemplateURL
+        to the URLs they will be uploaded to. Nothing is uploaded yet.
+
+        :type template_file: str
+        :rtype: tuple
+        :return: Template body and the list of template bodies to upload,
+                 including the template itself
+        """
+        uploads = []
+        body = self._render(template_file, uploads)
+        uploads.append(body)
+        return body, uploads
+
+    def _render(self, template_file, uploads):
+        with open(template_file) as f:
+            body = f.read()
+
+        try:
+            template = json.loads(body, object_pairs_hook=OrderedDict)
+        except ValueError:
+            # leave invalid templates for CloudFormation to report
+            return body
+
+        if not isinstance(template, dict) or not isinstance(template.get('Resources'), dict):
+            return body
+
+        rewritten = False
+        base_dir = os.path.dirname(template_file)
+        for resource in template['Resources'].itervalues():
+            if not isinstance(resource, dict) or resource.get('Type') != 'AWS::CloudFormation::Stack':
+                continue
+            properties = resource.get('Properties', {})
+            url = properties.get('TemplateURL')
+            if isinstance(url, basestring) and not _is_url(url):
+                nested_body = self._render(os.path.join(base_dir, url), uploads)
+                uploads.append(nested_body)
+                properties['TemplateURL'] = self.url(self.key_name(nested_body))
+                rewritten = True
+
+        if not rewritten:
+            return body
+
+        return json.dumps(template, indent=2)
@@ -0,0 +1,85 @@
+import re
+import threading
+
+from collections import OrderedDict
+
+
+class StackView(object):
+    """
+    Stack with its outputs indexed by key and resources indexed by logical id.
+
+    The resources are listed once, the first time they are needed, instead of
+    calling describe_resource for each logical resource.
+    """
+
+    def __init__(self, stack):
+        """
+        :type stack: boto.cloudformation.stack.Stack
+        """
+        self.stack = stack
+        self.outputs = OrderedDict([(output.key, output.value) for output in stack.outputs])
+        self._resources = None
+        self._lock = threading.Lock()
+
+    @property
+    def stack_id(self):
+        return self.stack.stack_id
+
+    @property
+    def stack_name(self):
+        return self.stack.stack_name
+
+    @property
+    def resources(self):
+        """
+        Stack resources by logical id, in the format of describe_resource details
+        :rtype: dict
+        """
+        with self._lock:
+            if self._resources is None:
+                self._resources = self._list_resources()
+            return self._resources
+
+    def get_output(self, key):
+        return self.outputs.get(key)
+
+    def match_outputs(self, match):
+        """
+        Values of the outputs with a key matching the regular expression
+        :type match: str
+        :rtype: list
+        """
+        return [value for key, value in self.outputs.iteritems() if re.match(match, key)]
+
+    def get_resource(self, logical_id):
+        """
+        :type logical_id: str
+        :rtype: dict
+        """
+        return self.resources.get(logical_id)
+
+    def get_physical_id(self, logical_id):
+        resource = self.get_resource(logical_id)
+        if resource is None:
+            return None
+        return resource['PhysicalResourceId']
+
+    def _list_resources(self):
+        resources = OrderedDict()
+        next_token = None
+        while True:
+            # list_stack_resources pages through stacks with more than 100 resources
+            page = self.stack.connection.list_stack_resources(self.stack.stack_id, next_token)
+            for summary in page:
+                resources[summary.logical_resource_id] = {
+                    'StackId': self.stack.stack_id,
+                    'StackName': self.stack.stack_name,
+                    'LogicalResourceId': summary.logical_resource_id,
+                    'PhysicalResourceId': summary.physical_resource_id,
+                    'ResourceType': summary.resource_type,
+                    'ResourceStatus': summary.resource_status,
+                }
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                break
+        return resources
@@ -0,0 +1,274 @@
+import threading
+
+import boto.cloudformation
+import boto.exception
+
+from velvet.aws.config import get_region
+from velvet.cloudformation.poller import create_strategy
+
+# Stack statuses the stack create and update wait for to change
+PROVISION_WAIT_STATUSES = ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS']
+
+# Stack statuses the stack deletion waits for to change
+DELETE_WAIT_STATUSES = ['DELETE_IN_PROGRESS']
+
+# With this many stacks followed, the stacks in progress are listed instead of describing each one,
+# None always describes each stack
+LIST_STACKS_THRESHOLD = 2
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+class StackFuture(object):
+    """
+    Latest known state of a stack followed by a StackWaiter, done once the
+    stack status is no longer one of the statuses waited for.
+    """
+
+    def __init__(self, stack_id, statuses, stack=None, strategy=None):
+        """
+        :type stack_id: str
+        :type statuses: list
+        :param statuses: Stack statuses to wait for to change
+        :type stack: boto.cloudformation.stack.Stack
+        :param stack: The stack as last seen by the caller
+        :type strategy: velvet.cloudformation.poller.WaitStrategy
+        :param strategy: Paces the status refreshes of the stack
+        """
+        self.stack_id = stack_id
+        self.statuses = statuses
+        self.stack = stack
+        self.strategy = strategy or create_strategy()
+        self.cancelled = False
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the stack leaves the statuses waited for or the timeout expires
+        :type timeout: float
+        :rtype: bool
+        :return: True if done
+        """
+        self._done.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        :type timeout: float
+        :rtype: boto.cloudformation.stack.Stack
+        :return: The stack in its final status, None if not done before the timeout
+        """
+        if not self.wait(timeout):
+            return None
+        return self.stack
+
+    def add_done_callback(self, callback):
+        """
+        Call callback with the future when done, immediately if already done
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _update(self, stack):
+        """
+        :type stack: boto.cloudformation.stack.Stack
+        :rtype: bool
+        :return: True if the future is done
+        """
+        if self.stack is not None and self.stack.stack_status != stack.stack_status:
+            # follow the stack closely again after a status change
+            self.strategy.reset()
+        self.stack = stack
+        if stack.stack_status in self.statuses:
+            return False
+        self._resolve()
+        return True
+
+    def _resolve(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class StackWaiter(object):
+    """
+    Follows the status of many stacks with a single polling loop.
+
+    The refreshes are paced by the wait strategies of the callers, the loop
+    waits for the shortest interval of the followed stacks. Once at least
+    list_threshold stacks are followed, each refresh lists the stacks of the
+    region in the statuses waited for with the paged list_stacks call, which
+    returns only the stacks still in progress. The stacks missing from the
+    list have changed status and only they are described one by one, to
+    return them in full. Below the threshold each stack is described.
+    """
+
+    def __init__(self, region=None, connection=None, list_threshold=LIST_STACKS_THRESHOLD, autostart=True):
+        """
+        :type region: str
+        :type connection: boto.cloudformation.connection.CloudFormationConnection
+        :param connection: Connection used by the polling thread, a new one by default
+        :type list_threshold: int
+        :type autostart: bool
+        :param autostart: Start the polling thread when a stack is followed
+        """
+        self.region = get_region(region)
+        self.connection = connection
+        self.list_threshold = list_threshold
+        self.autostart = autostart
+        self.polls = 0
+        self._futures = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def watch(self, stack_id, statuses, stack=None, wait=None):
+        """
+        Follow the stack until its status is not one of the given statuses
+        :type stack_id: str
+        :type statuses: list
+        :type stack: boto.cloudformation.stack.Stack
+        :type wait: dict or velvet.cloudformation.poller.StackPoller
+        :param wait: Stack wait configuration of the caller pacing the status refreshes
+        :rtype: StackFuture
+        """
+        future = StackFuture(stack_id, statuses, stack, create_strategy(wait))
+        if stack is not None and future._update(stack):
+            return future
+
+        with self._lock:
+            self._futures.append(future)
+            # the new stack may need a shorter interval than the one being waited
+            self._wake.set()
+            if self.autostart and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-waiter-' + self.region)
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def cancel(self, future):
+        """
+        Stop following the stack, eg. when the caller has timed out
+        :type future: StackFuture
+        """
+        with self._lock:
+            if future in self._futures:
+                self._futures.remove(future)
+        future.cancelled = True
+
+    def poll(self):
+        """
+        Refresh the status of all followed stacks once
+        """
+        with self._lock:
+            futures = list(self._futures)
+        if len(futures) == 0:
+            return
+
+        stacks = self._describe(futures)
+        self.polls += 1
+
+        for future in futures:
+            stack = stacks.get(future.stack_id)
+            # stacks that could not be described are tried again on the next poll
+            if stack is not None and future._update(stack):
+                with self._lock:
+                    if future in self._futures:
+                        self._futures.remove(future)
+
+    def next_interval(self):
+        """
+        :rtype: float
+        :return: Seconds to wait before the next refresh, the shortest interval of the followed stacks
+        """
+        with self._lock:
+            futures = list(self._futures)
+        intervals = [future.strategy.next_interval() for future in futures]
+        if len(intervals) == 0:
+            return 0
+        return min(intervals)
+
+    def _connection(self):
+        if self.connection is None:
+            self.connection = boto.cloudformation.connect_to_region(self.region)
+        return self.connection
+
+    def _describe(self, futures):
+        """
+        :type futures: list of StackFuture
+        :rtype: dict
+        :return: Stacks, or summaries of the stacks still in progress, by stack id
+        """
+        connection = self._connection()
+        stack_ids = set([future.stack_id for future in futures])
+        stacks = {}
+
+        if self.list_threshold is not None and len(stack_ids) >= self.list_threshold:
+            waiting = {}
+            for future in futures:
+                waiting.setdefault(future.stack_id, set()).update(future.statuses)
+            statuses = sorted(set([status for future in futures for status in future.statuses]))
+            try:
+                next_token = None
+                while True:
+                    page = connection.list_stacks(statuses, next_token)
+                    for summary in page:
+                        if summary.stack_id in stack_ids and summary.stack_status in waiting[summary.stack_id]:
+                            stacks[summary.stack_id] = summary
+                    next_token = getattr(page, 'next_token', None)
+                    if not next_token:
+                        break
+            except boto.exception.BotoServerError:
+                pass
+
+        # stacks no longer in progress are described in full
+        for stack_id in stack_ids:
+            if stack_id in stacks:
+                continue
+            try:
+                described = connection.describe_stacks(stack_id)
+                if len(described) == 1:
+                    stacks[stack_id] = described[0]
+            except boto.exception.BotoServerError:
+                pass
+
+        return stacks
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._futures) == 0:
+                    self._thread = None
+                    return
+            # stacks followed during the poll wake up the next wait
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                # keep following the stacks through unexpected errors, eg. network failures
+                pass
+            self._wake.wait(self.next_interval())
+
+
+def get_waiter(region=None):
+    """
+    Stack waiter shared by all the stack operations in the region
+    :type region: str
+    :rtype: StackWaiter
+    """
+    region = get_region(region)
+    with _waiters_lock:
+        if region not in _waiters:
+            _waiters[region] = StackWaiter(region)
+        return _waiters[region]
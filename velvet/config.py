@@ -14,6 +14,9 @@ _config = None
 environment_config = {}
 VELVET_VERSION = semantic_version.Version(__version__)
 
+# Directory for the local state files, eg. caches and logs, relative to the project root
+DEFAULT_STATE_DIR = '.velvet-state'
+
 def save():
     global _config
     if _config is None:
@@ -56,6 +59,24 @@ def _write_config_file(config):
     return config
 
 
+def get_state_path(*paths):
+    """
+    Path to a file in the local state directory, the directory is created if needed
+    :rtype: str
+    """
+    state_dir = env.get('state_dir', DEFAULT_STATE_DIR)
+    path = os.path.join(state_dir, *paths)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another thread or process
+            if not os.path.isdir(directory):
+                raise
+    return path
+
+
 @deprecated
 def init():
     """Initialize default configuration from the environment variables"""
@@ -152,13 +173,27 @@ def environment(name):
         'cookbooks_publish_path',   # path to copy deployment package to on the S3 bucket
 
         'opsworks',                 # OpsWorks configuration
+        'deploy_batch',             # OpsWorks instances deployed at a time, a number or a percentage, eg. 50%
+        'deploy_wait',              # OpsWorks rolling deployment status polling options: interval and timeout
 
         'cloudformation_path',      # path to cloudformation template files
         'disable_rollback',         # disable cloudformation rollback on failure
+        'stack_wait',               # cloudformation stack status polling options
+        'template_bucket',          # S3 bucket for cloudformation templates, true for the deployment bucket
+        'template_publish_path',    # path to upload cloudformation templates to on the S3 bucket
 
         'security',                 # additional options passed for the provisioning scripts
         'roles',                    # non aws/static webserver roles
+        'role_hosts',               # stack autoscaling groups or outputs resolved into env.roledefs
+        'host_address',             # host names used for the roles: public_dns, private_dns or private_ip
         'stacks',                   # CloudFormation stacks configuration
+        'stack_concurrency',        # maximum number of CloudFormation stacks provisioned at the same time
+        'regions',                  # AWS regions the stacks are provisioned in, the AWS config region by default
+        'recycle_batch',            # autoscaling instances recycled at a time, a number or a percentage, eg. 25%
+        'capacity_surge',           # autoscaling instances added for deploys and recycles, a number or a percentage
+
+        'state_dir',                # directory for the local state files, eg. caches and logs
+        'inventory_max_age',        # seconds the local inventory is used for instance listings after a sync
     ]
 
     for key in config_options:
@@ -189,8 +224,7 @@ def set_config(config_file):
 class UnsupportedVersion(Exception):
     pass
 
-@with_config_defaults
-def get_environment_config(environment):
+def _load_environments_config():
 
     if 'config' not in env:
         raise Exception('Config file path not defined')
@@ -218,6 +252,24 @@ def get_environment_config(environment):
     if version < semantic_version.Version('0.3.0'):
         cfg = _format_ruby_yaml_config(cfg)
 
+    return cfg
+
+
+@with_config_defaults
+def get_environments():
+    """
+    Names of the environments in the config file
+    :rtype: list
+    """
+    cfg = _load_environments_config()
+    return sorted(cfg['environments'].keys())
+
+
+@with_config_defaults
+def get_environment_config(environment):
+
+    cfg = _load_environments_config()
+
     if cfg['environments'][environment] is None:
         raise Exception('Configuration not found for environment "' + environment + '" in ' + env.config)
 
@@ -2,24 +2,156 @@ import boto.ec2
 import boto.ec2.autoscale
 import boto.ec2.elb
 
-from velvet.aws.config import region
+from velvet.aws.config import get_region
+from velvet.cache import TTLCache
+from velvet.pool import parallel_map
+
+# Seconds to cache the autoscaling groups
+AUTOSCALING_GROUP_CACHE_TTL = 30
+
+# Maximum number of autoscaling group names in one API call
+AUTOSCALING_GROUP_BATCH = 50
+
+_group_cache = TTLCache(AUTOSCALING_GROUP_CACHE_TTL)
+
+
+def get_autoscaling_groups(group_names, region=None, cached=True):
+    """
+    Find autoscaling groups by name with as few API calls as possible
+    :type group_names: list
+    :type region: str
+    :type cached: bool
+    :rtype: dict
+    :return: Autoscaling groups by name, groups not found are left out
+    """
+    region = get_region(region)
+
+    groups = {}
+    missing = []
+    for name in group_names:
+        if name in groups or name in missing:
+            continue
+        group = _group_cache.get((region, name)) if cached else None
+        if group is not None:
+            groups[name] = group
+        else:
+            missing.append(name)
+
+    if len(missing) == 0:
+        return groups
 
-def get_autoscaling_group(group_id):
     autoscale = boto.ec2.autoscale.connect_to_region(region)
-    groups = autoscale.get_all_groups()
-    for group in groups:
-        if group.name == group_id:
-            return group
-    return None
+    for i in range(0, len(missing), AUTOSCALING_GROUP_BATCH):
+        names = missing[i:i + AUTOSCALING_GROUP_BATCH]
+        next_token = None
+        while True:
+            page = autoscale.get_all_groups(names=names, next_token=next_token)
+            for group in page:
+                groups[group.name] = group
+                _group_cache.set([(region, group.name)], group)
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                break
+
+    return groups
+
+
+def get_autoscaling_group(group_id, region=None, cached=True):
+    """
+    :type group_id: str
+    :param group_id: Autoscaling group name
+    :rtype: boto.ec2.autoscale.group.AutoScalingGroup
+    """
+    return get_autoscaling_groups([group_id], region=region, cached=cached).get(group_id)
+
+
+def invalidate_autoscaling_group(group_id, region=None):
+    """
+    Remove the autoscaling group from the cache, eg. after changing its capacity
+    :type group_id: str
+    """
+    _group_cache.invalidate((get_region(region), group_id))
 
 
 def get_autoscaling_group_instance_ids(group):
     return [i.instance_id for i in group.instances]
 
 
-def get_instances(instance_ids):
-    ec2 = boto.ec2.connect_to_region(region)
-    return ec2.get_only_instances(instance_ids)
+# Maximum number of instance ids in one API call
+INSTANCE_BATCH = 100
+
+
+class InstanceRecord(object):
+    """
+    Instance details used by velvet, without the rest of the boto instance
+    """
+
+    __slots__ = ('id', 'state', 'instance_type', 'launch_time', 'public_dns_name', 'private_dns_name',
+                 'ip_address', 'private_ip_address', 'name')
+
+    def __init__(self, id, state=None, instance_type=None, launch_time=None, public_dns_name=None,
+                 private_dns_name=None, ip_address=None, private_ip_address=None, name=None):
+        self.id = id
+        self.state = state
+        self.instance_type = instance_type
+        self.launch_time = launch_time
+        self.public_dns_name = public_dns_name
+        self.private_dns_name = private_dns_name
+        self.ip_address = ip_address
+        self.private_ip_address = private_ip_address
+        self.name = name
+
+    @classmethod
+    def from_instance(cls, instance):
+        """
+        :type instance: boto.ec2.instance.Instance
+        :rtype: InstanceRecord
+        """
+        return cls(instance.id,
+                   state=instance.state,
+                   instance_type=instance.instance_type,
+                   launch_time=instance.launch_time,
+                   public_dns_name=instance.public_dns_name,
+                   private_dns_name=instance.private_dns_name,
+                   ip_address=instance.ip_address,
+                   private_ip_address=instance.private_ip_address,
+                   name=instance.tags.get('Name'))
+
+    def __repr__(self):
+        return 'InstanceRecord:%s' % self.id
+
+
+def get_instances(instance_ids, region=None):
+    """
+    Fetch instances in batches of instance ids, the batches are fetched concurrently
+    :type instance_ids: list
+    :type region: str
+    :rtype: list of boto.ec2.instance.Instance
+    """
+    region = get_region(region)
+    instance_ids = list(instance_ids)
+    if len(instance_ids) == 0:
+        return []
+
+    def fetch(batch):
+        # connections are not shared between the threads
+        ec2 = boto.ec2.connect_to_region(region)
+        return ec2.get_only_instances(batch)
+
+    batches = [instance_ids[i:i + INSTANCE_BATCH] for i in range(0, len(instance_ids), INSTANCE_BATCH)]
+    instances = []
+    for fetched in parallel_map(fetch, batches):
+        instances.extend(fetched)
+    return instances
+
+
+def get_instance_records(instance_ids, region=None):
+    """
+    :type instance_ids: list
+    :type region: str
+    :rtype: list of InstanceRecord
+    """
+    return [InstanceRecord.from_instance(instance) for instance in get_instances(instance_ids, region=region)]
 
 # Deprecated methods for backwards compatibility
 
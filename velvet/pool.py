@@ -0,0 +1,34 @@
+from multiprocessing.pool import ThreadPool
+
+# Default number of worker threads for concurrent AWS API calls
+DEFAULT_WORKERS = 8
+
+# Waiting for results with a timeout keeps the main thread responsive to Ctrl+C
+MAX_WAIT = 60 * 60 * 24
+
+
+def parallel_map(func, items, max_workers=DEFAULT_WORKERS):
+    """
+    Call func for each item in a thread pool.
+
+    Results are returned in the order of the items and the first exception
+    raised by func is raised again in the calling thread.
+
+    :type items: list
+    :type max_workers: int
+    :rtype: list
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+
+    workers = max(1, min(max_workers, len(items)))
+    if workers == 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map_async(func, items).get(MAX_WAIT)
+    finally:
+        pool.close()
+        pool.join()
@@ -1,12 +1,12 @@
 import boto
-import velvet.cloudformation as cf
+import velvet.cloudformation.stack as cf_stack
 from boto.route53.record import ResourceRecordSets
 import logging
 
 def update_elb_dns(stack, elb_attr, hosted_zone_id, dns_name):
 
     ttl = 60
-    elb_dns = cf.get_stack_output_value(stack, elb_attr)
+    elb_dns = cf_stack.get_stack_output_value(stack, elb_attr)
     dns_record_name = dns_name + "."
 
     conn = boto.connect_route53()
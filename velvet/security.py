@@ -1,20 +1,43 @@
 from fabric.api import env
 
+import threading
+import time
+
+from collections import namedtuple, OrderedDict
+
 import boto.ec2
+import boto.exception
 from fabric.colors import red, green, yellow
 
 import velvet.config
-import velvet.cloudformation
+import velvet.aws.inventory
+import velvet.cloudformation.stack as cf_stack
 
-from velvet.aws.config import region
+from velvet.aws.config import get_region
+from velvet.cache import TTLCache
 from velvet.decorators import deprecated
+from velvet.pool import parallel_map
+
+# MySQL port opened for the authorized database resources
+DATABASE_PORT = 3306
+
+# Maximum number of grants sent in one authorize or revoke call
+INGRESS_BATCH = 50
+
+# Seconds to keep the security groups in the index
+SECURITY_GROUP_CACHE_TTL = 300
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+IngressGrant = namedtuple('IngressGrant', ['ip_protocol', 'from_port', 'to_port', 'source'])
 
 
 class StackOutputValueError(Exception):
     pass
 
 def get_security_group_from_resource(stack, resource_name):
-    security_group_id = velvet.cloudformation.get_stack_output_value(stack, resource_name)
+    security_group_id = cf_stack.get_stack_output_value(stack, resource_name)
     if security_group_id is None:
         raise StackOutputValueError('Security group resource not found')
     return get_security_group(security_group_id)
@@ -75,31 +98,439 @@ def has_database_access_from_group(target_sg, source_sg):
     :type source_sg: boto.ec2.securitygroup.SecurityGroup
     :rtype: bool
     """
-    existing = []
-    for rule in target_sg.rules:
-        for grant in rule.grants:
-            if not grant.cidr_ip:
-                existing.append(str(grant))
+    return source_sg.id in set([grant.source for grant in ingress_grants(target_sg)])
 
-    source_group = source_sg.id + "-" + source_sg.owner_id
-    if source_sg.id + "-" + source_sg.owner_id in existing:
-        return True
 
-    return False
+def _port(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _is_cidr(source):
+    return '/' in source
+
+
+def ingress_grants(sg):
+    """
+    Set of the ingress grants of the security group, the source is the granted group id or CIDR
+    :type sg: boto.ec2.securitygroup.SecurityGroup
+    :rtype: set of IngressGrant
+    """
+    return set([ingress_grant(rule, grant) for rule in sg.rules for grant in rule.grants])
+
+
+def ingress_grant(rule, grant):
+    """
+    :type rule: boto.ec2.securitygroup.IPPermissions
+    :type grant: boto.ec2.securitygroup.GroupOrCIDR
+    :rtype: IngressGrant
+    """
+    return IngressGrant(rule.ip_protocol, _port(rule.from_port), _port(rule.to_port), grant.group_id or grant.cidr_ip)
+
+
+class IngressPlan(object):
+    """
+    Grants to authorize and revoke in a security group
+    """
+
+    def __init__(self, sg, authorize=None, revoke=None, sources=None, missing=None):
+        """
+        :type sg: boto.ec2.securitygroup.SecurityGroup
+        :type authorize: list of IngressGrant
+        :type revoke: list of IngressGrant
+        :type sources: dict
+        :param sources: Source group name and owner id by group id
+        :type missing: list of IngressGrant
+        :param missing: Grants to revoke that do not exist
+        """
+        self.sg = sg
+        self.authorize = sorted(authorize or [])
+        self.revoke = sorted(revoke or [])
+        self.sources = sources or {}
+        self.missing = sorted(missing or [])
+
+    def __nonzero__(self):
+        return len(self.authorize) > 0 or len(self.revoke) > 0
+
+    def source_name(self, grant):
+        """
+        :type grant: IngressGrant
+        :rtype: str
+        :return: Source group name if known, otherwise the group id or CIDR
+        """
+        if grant.source in self.sources:
+            return self.sources[grant.source][0]
+        return grant.source
+
+    def describe(self):
+        """
+        :rtype: list
+        :return: Plan lines
+        """
+        lines = []
+        for action, grants in [('+', self.authorize), ('-', self.revoke)]:
+            for grant in grants:
+                source = grant.source
+                if source in self.sources:
+                    source = '%s (%s)' % (source, self.sources[source][0])
+                lines.append('%(action)s %(source)s -> %(group)s %(ip_protocol)s(%(from_port)s-%(to_port)s)' % {
+                    'action': action,
+                    'source': source,
+                    'group': self.sg.name,
+                    'ip_protocol': grant.ip_protocol,
+                    'from_port': grant.from_port,
+                    'to_port': grant.to_port,
+                })
+        return lines
+
+
+class IngressResult(object):
+
+    def __init__(self):
+        self.plans = []
+        self.errors = OrderedDict()
+
+    @property
+    def failed(self):
+        return len(self.errors) > 0
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    def __nonzero__(self):
+        return self.succeeded
+
+
+def plan_ingress(desired, revoke=False, region=None):
+    """
+    Diff the desired grants against the existing grants of the target groups
+    :type desired: dict
+    :param desired: Target group name or id to the grants, with the source security groups, eg.
+                    {'rds': [('tcp', 3306, 3306, source_sg)]}
+    :type revoke: bool
+    :param revoke: Plan revoking the desired grants that exist instead of authorizing the missing ones
+    :rtype: list of IngressPlan
+    :raises ValueError: if a target group is not found
+    """
+    targets = get_security_groups(list(desired), region=region)
+
+    plans = []
+    for target, grants in desired.iteritems():
+        sg = targets[target]
+        if sg is None:
+            raise ValueError('Security group not found: ' + target)
+
+        sources = {}
+        wanted = set()
+        for ip_protocol, from_port, to_port, source in grants:
+            if isinstance(source, basestring):
+                wanted.add(IngressGrant(ip_protocol, from_port, to_port, source))
+            else:
+                sources[source.id] = (source.name, source.owner_id)
+                wanted.add(IngressGrant(ip_protocol, from_port, to_port, source.id))
+
+        existing = ingress_grants(sg)
+        if revoke:
+            plans.append(IngressPlan(sg, revoke=wanted & existing, sources=sources, missing=wanted - existing))
+        else:
+            plans.append(IngressPlan(sg, authorize=wanted - existing, sources=sources))
+    return plans
+
+
+def _ingress_params(sg, grants, sources):
+    """
+    Request parameters with one IpPermissions entry for each protocol and port range
+    :rtype: dict
+    """
+    params = {}
+    if sg.vpc_id:
+        params['GroupId'] = sg.id
+    else:
+        params['GroupName'] = sg.name
+
+    ranges = OrderedDict()
+    for grant in grants:
+        ranges.setdefault((grant.ip_protocol, grant.from_port, grant.to_port), []).append(grant.source)
+
+    for i, ((ip_protocol, from_port, to_port), granted) in enumerate(ranges.iteritems(), 1):
+        prefix = 'IpPermissions.%d.' % i
+        params[prefix + 'IpProtocol'] = ip_protocol
+        # all protocols (-1) are granted without a port range
+        if from_port is not None:
+            params[prefix + 'FromPort'] = str(from_port)
+        if to_port is not None:
+            params[prefix + 'ToPort'] = str(to_port)
+        groups = [source for source in granted if not _is_cidr(source)]
+        for j, source in enumerate(groups, 1):
+            group_prefix = prefix + 'Groups.%d.' % j
+            name, owner_id = sources.get(source, (None, None))
+            if sg.vpc_id or name is None:
+                params[group_prefix + 'GroupId'] = source
+            else:
+                params[group_prefix + 'GroupName'] = name
+            if owner_id:
+                params[group_prefix + 'UserId'] = owner_id
+        cidrs = [source for source in granted if _is_cidr(source)]
+        for j, source in enumerate(cidrs, 1):
+            params[prefix + 'IpRanges.%d.CidrIp' % j] = source
+    return params
 
 
-def get_security_group(security_group):
+def _update_rules(sg, authorized, revoked, sources):
+    """
+    Apply the changes to the rules of the security group object in the index
+    """
+    for grant in authorized:
+        name, owner_id = sources.get(grant.source, (None, None))
+        # all protocols (-1) have no port range
+        from_port = None if grant.from_port is None else str(grant.from_port)
+        to_port = None if grant.to_port is None else str(grant.to_port)
+        if _is_cidr(grant.source):
+            sg.add_rule(grant.ip_protocol, from_port, to_port, None, None, grant.source, None)
+        else:
+            sg.add_rule(grant.ip_protocol, from_port, to_port, name, owner_id, None, grant.source)
+
+    revoked = set(revoked)
+    for rule in list(sg.rules):
+        rule.grants = [grant for grant in rule.grants if ingress_grant(rule, grant) not in revoked]
+        if len(rule.grants) == 0:
+            sg.rules.remove(rule)
+
+
+def apply_ingress(plans, region=None, dry_run=False):
+    """
+    Apply the plans concurrently, each security group with batched
+    AuthorizeSecurityGroupIngress and RevokeSecurityGroupIngress calls
+    carrying several IP permissions each
+    :type plans: list of IngressPlan
+    :type dry_run: bool
+    :rtype: IngressResult
+    """
+    region = get_region(region)
+    result = IngressResult()
+    result.plans = plans
+
+    def apply(plan):
+        if dry_run or not plan:
+            return None
+        # connections are not shared between the threads
+        connection = boto.ec2.connect_to_region(region)
+        try:
+            for action, grants in [('AuthorizeSecurityGroupIngress', plan.authorize),
+                                   ('RevokeSecurityGroupIngress', plan.revoke)]:
+                for start in range(0, len(grants), INGRESS_BATCH):
+                    batch = grants[start:start + INGRESS_BATCH]
+                    if not connection.get_status(action, _ingress_params(plan.sg, batch, plan.sources), verb='POST'):
+                        return '%s failed for %s' % (action, plan.sg.name)
+                    if action.startswith('Authorize'):
+                        _update_rules(plan.sg, batch, [], plan.sources)
+                    else:
+                        _update_rules(plan.sg, [], batch, plan.sources)
+        except boto.exception.EC2ResponseError as e:
+            return e.error_message or str(e)
+        return None
+
+    for plan, error in zip(plans, parallel_map(apply, plans)):
+        if error is not None:
+            result.errors[plan.sg.name] = error
+    return result
+
+
+def database_access_grants(stack, resource_names):
+    """
+    Database port grants from the security groups of the stack resources
+    :type stack: boto.cloudformation.stack.Stack
+    :type resource_names: list
+    :rtype: tuple
+    :return: Grants and the resources without a security group
+    """
+    group_ids = OrderedDict()
+    missing = []
+    for resource_name in resource_names:
+        security_group_id = cf_stack.get_stack_output_value(stack, resource_name)
+        if security_group_id is None:
+            missing.append(resource_name)
+        else:
+            group_ids[resource_name] = security_group_id
+
+    sources = get_security_groups(group_ids.values())
+    grants = []
+    for resource_name, security_group_id in group_ids.iteritems():
+        if sources[security_group_id] is None:
+            missing.append(resource_name)
+        else:
+            grants.append(('tcp', DATABASE_PORT, DATABASE_PORT, sources[security_group_id]))
+    return grants, missing
+
+
+def get_security_group(security_group, region=None, max_age=None, cached=True):
     """
     Find security group by name or id
     :type security_group: str
+    :type region: str
+    :type max_age: float
+    :param max_age: Use the local inventory if synced within max_age seconds, the group is then a read-only
+                    velvet.aws.inventory.SecurityGroupRecord
+    :type cached: bool
     :rtype: boto.ec2.securitygroup.SecurityGroup
     """
-    ec2 = boto.ec2.connect_to_region(region)
-    rs = ec2.get_all_security_groups()
-    for sg in rs:
-        if sg.name == security_group:
-            return sg
-        if sg.id == security_group:
+    if max_age is not None:
+        sg = velvet.aws.inventory.get_security_group(security_group, max_age, region=region)
+        if sg is not None:
             return sg
-    return None
 
+    return get_security_group_index(region).get(security_group, cached=cached)
+
+
+def get_security_groups(security_groups, region=None):
+    """
+    Find security groups by name or id with at most two API calls
+    :type security_groups: list
+    :rtype: dict
+    :return: Security groups by the given name or id, None if not found
+    """
+    return get_security_group_index(region).get_many(security_groups)
+
+
+def prefetch_database_access_groups(stack, resource_names, target_security_group):
+    """
+    Look up the security groups of the stack resources and the target group together,
+    so that the following authorize and revoke calls find them in the index
+    :type stack: boto.cloudformation.stack.Stack
+    :type resource_names: list
+    :type target_security_group: str
+    :rtype: dict
+    """
+    groups = [target_security_group]
+    for resource_name in resource_names:
+        security_group_id = cf_stack.get_stack_output_value(stack, resource_name)
+        if security_group_id is not None:
+            groups.append(security_group_id)
+    return get_security_groups(groups)
+
+
+class SecurityGroupIndex(object):
+    """
+    Security groups of a region indexed by id and name.
+
+    Groups are looked up with server-side group-id and group-name filters,
+    or all at once with load(), and kept until the TTL expires. The index
+    holds the boto objects themselves, whose rules are updated in place by
+    SecurityGroup.authorize and SecurityGroup.revoke, so the groups do not
+    need to be described again after changing their rules.
+    """
+
+    def __init__(self, region=None, ttl=SECURITY_GROUP_CACHE_TTL, connection=None, clock=time.time):
+        """
+        :type region: str
+        :type ttl: int
+        :type connection: boto.ec2.connection.EC2Connection
+        """
+        self.region = get_region(region)
+        self.connection = connection
+        self.clock = clock
+        self._cache = TTLCache(ttl, clock=clock)
+        self._loaded_until = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self.connection is None:
+            self.connection = boto.ec2.connect_to_region(self.region)
+        return self.connection
+
+    def _is_loaded(self):
+        return self._loaded_until is not None and self._loaded_until > self.clock()
+
+    def add(self, groups):
+        """
+        :type groups: list of boto.ec2.securitygroup.SecurityGroup
+        """
+        for sg in groups:
+            self._cache.set([sg.id, sg.name], sg)
+
+    def invalidate(self, security_group):
+        self._cache.invalidate(security_group)
+        self._loaded_until = None
+
+    def clear(self):
+        self._cache.clear()
+        self._loaded_until = None
+
+    def load(self):
+        """
+        Describe all the security groups in the region with a single call
+        :rtype: list of boto.ec2.securitygroup.SecurityGroup
+        """
+        with self._lock:
+            groups = self._connection().get_all_security_groups()
+            self.add(groups)
+            self._loaded_until = self.clock() + self._cache.ttl
+            return groups
+
+    def get(self, security_group, cached=True):
+        """
+        :type security_group: str
+        :param security_group: Security group name or id
+        :type cached: bool
+        :rtype: boto.ec2.securitygroup.SecurityGroup
+        """
+        if cached:
+            sg = self._cache.get(security_group)
+            if sg is not None or self._is_loaded():
+                return sg
+        return self.get_many([security_group], cached=False).get(security_group)
+
+    def get_many(self, security_groups, cached=True):
+        """
+        Find the groups missing from the index with one call for the ids and one for the names
+        :type security_groups: list
+        :rtype: dict
+        :return: Security groups by the given name or id, None if not found
+        """
+        found = {}
+        missing = []
+        for security_group in security_groups:
+            sg = self._cache.get(security_group) if cached else None
+            if sg is not None:
+                found[security_group] = sg
+            elif not (cached and self._is_loaded()):
+                missing.append(security_group)
+
+        group_ids = sorted(set([group for group in missing if group.startswith('sg-')]))
+        group_names = sorted(set([group for group in missing if not group.startswith('sg-')]))
+        for key, values in [('group-id', group_ids), ('group-name', group_names)]:
+            if len(values) == 0:
+                continue
+            groups = self._connection().get_all_security_groups(filters={key: values})
+            self.add(groups)
+            for sg in groups:
+                found.setdefault(sg.id, sg)
+                found.setdefault(sg.name, sg)
+
+        return dict([(security_group, found.get(security_group)) for security_group in security_groups])
+
+    def find(self, name_pattern):
+        """
+        Find the security groups with a name matching the pattern, eg. AWS-OpsWorks-*
+        :type name_pattern: str
+        :rtype: list of boto.ec2.securitygroup.SecurityGroup
+        """
+        groups = self._connection().get_all_security_groups(filters={'group-name': name_pattern})
+        self.add(groups)
+        return groups
+
+
+def get_security_group_index(region=None):
+    """
+    Security group index shared by all the lookups in the region
+    :type region: str
+    :rtype: SecurityGroupIndex
+    """
+    region = get_region(region)
+    with _indexes_lock:
+        if region not in _indexes:
+            _indexes[region] = SecurityGroupIndex(region)
+        return _indexes[region]
@@ -1,4 +1,4 @@
-from fabric.api import env, sudo, put, run, settings
+from fabric.api import env, sudo, put, run, settings, execute
 import fabric.contrib.files
 
 from velvet.decorators import deprecated
@@ -10,6 +10,7 @@ import json
 
 from velvet.helpers import with_defaults, with_releases, dir_exists, list_files, find_executable, file_exists
 import velvet.tasks.servers
+import velvet.autoscale
 
 
 def get_build():
@@ -23,6 +24,11 @@ def restart():
     velvet.tasks.servers.reload_phpfpm()
 
 
+def restart_with_capacity_guard(stack, resource_name):
+    """ Restart web servers on all hosts with surge capacity in the autoscaling group """
+    return velvet.autoscale.run_with_capacity_guard(stack, resource_name, execute, restart)
+
+
 @deprecated
 def nginx_restart():
     velvet.tasks.servers.restart_nginx()
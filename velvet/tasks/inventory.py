@@ -0,0 +1,20 @@
+from fabric.colors import green
+
+import velvet.aws.inventory
+
+
+def sync_inventory(max_age=0, services=None):
+    """Sync the local inventory of stacks, autoscaling groups, instances and security groups"""
+
+    if services is not None and isinstance(services, basestring):
+        services = services.split(';')
+
+    synced = velvet.aws.inventory.sync(services=services, max_age=float(max_age))
+
+    for (region, service), count in sorted(synced.items()):
+        if count is None:
+            print "*** %s %s: up to date" % (region, service)
+        else:
+            print green("*** %s %s: %d synced" % (region, service, count))
+
+    return synced
@@ -1,3 +1,6 @@
+import threading
+import time
+
 from time import sleep
 from fabric.api import env
 from fabric.colors import red, yellow, green
@@ -8,11 +11,15 @@ import velvet.tasks.stack
 import velvet.cloudformation
 import velvet.tasks.security
 
-from velvet.aws.config import region
-
 from velvet.tasks.security import authorize_rds_security_groups as _authorize_rds_security_groups
 from velvet.tasks.security import revoke_rds_security_groups as _revoke_rds_security_groups
 
+from velvet.autoscale import get_batch_size
+from velvet.aws.config import get_region
+from velvet.aws.opsworks import OpsWorksIdCache
+from velvet.pool import parallel_map
+
+import boto.exception
 import boto.opsworks
 import boto.opsworks.layer1
 
@@ -25,18 +32,55 @@ class OpsWorksResult(object):
     def __nonzero__(self):
         return self.succeeded and not self.failed
 
+# Seconds between the deployment status checks of a rolling deployment
+DEPLOYMENT_INTERVAL = 10
+
+# Seconds to wait for the deployment of each batch
+DEPLOYMENT_TIMEOUT = 1800
+
+
 class OpsWorksDeployment(object):
 
     def __init__(self, connection=None):
         """
         :type connection: boto.opsworks.layer1.OpsWorksConnection
+        :param connection: Connection shared by all the threads, by default each thread creates its own
         """
-        self.connection = connection
-
-        # create new connection if needed
-        if self.connection is None:
-            self.connection = boto.opsworks.layer1.OpsWorksConnection()
-
+        self._connection = connection
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        if self._connection is not None:
+            return self._connection
+        # connections are not shared between the threads
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = boto.opsworks.layer1.OpsWorksConnection()
+        return self._local.connection
+
+    def resolve(self, config):
+        """
+        Describe the OpsWorks stack, layer, app and layer instances concurrently
+        :type config: dict
+        :param config: OpsWorks ids, see _find_opsworks_stack
+        :rtype: dict
+        :return: Stack, layer, app and instances, None if the stack, layer or app is not found
+        """
+        calls = [
+            (self.get_stack, config['stack_id']),
+            (self.get_layer, config['layer_id']),
+            (self.get_app, config['app_id']),
+            (self.get_layer_instances, config['layer_id']),
+        ]
+        stack, layer, app, instances = parallel_map(lambda call: call[0](call[1]), calls)
+        if stack is None or layer is None or app is None:
+            return None
+        return {
+            'stack' : stack,
+            'layer' : layer,
+            'app' : app,
+            'instances' : instances,
+        }
 
     def get_stack(self, stack_id):
         stacks = self.connection.describe_stacks(stack_ids=[stack_id])
@@ -66,6 +110,58 @@ class OpsWorksDeployment(object):
         }, app_id=app_id, comment=comment, instance_ids=instance_ids)
         return deployment
 
+    def wait_for_deployment(self, deployment_id, interval=DEPLOYMENT_INTERVAL, timeout=DEPLOYMENT_TIMEOUT,
+                            clock=time.time, sleep=sleep):
+        """
+        Wait until the deployment has completed
+        :type deployment_id: str
+        :rtype: str
+        :return: Deployment status, successful or failed, None if timed out
+        """
+        started = clock()
+        while True:
+            response = self.connection.describe_deployments(deployment_ids=[deployment_id])
+            status = response['Deployments'][0]['Status']
+            if status in ['successful', 'failed']:
+                return status
+            if clock() - started >= timeout:
+                return None
+            sleep(interval)
+
+    def rolling_deploy_app(self, stack_id, app_id, instance_ids, batch_size, comment=None, **wait):
+        """
+        Deploy the app to the instances in batches, the next batch starts once the deployment
+        of the previous batch has succeeded and nothing is deployed after a failed batch
+        :type instance_ids: list
+        :type batch_size: int or str
+        :param batch_size: Number of instances or a percentage of the instances, eg. 25%
+        :param wait: Options passed to wait_for_deployment
+        :rtype: OpsWorksResult
+        """
+        size = get_batch_size(batch_size, len(instance_ids))
+
+        result = OpsWorksResult()
+        result.failed = False
+        result.deployments = []
+
+        for start in range(0, len(instance_ids), size):
+            batch = instance_ids[start:start + size]
+            deployment = self.deploy_app(stack_id, app_id, instance_ids=batch, comment=comment)
+            result.deployments.append(deployment)
+            print "--> Deployment: %s (%d of %d instances)" % (deployment['DeploymentId'],
+                                                             start + len(batch), len(instance_ids))
+
+            status = self.wait_for_deployment(deployment['DeploymentId'], **wait)
+            if status != 'successful':
+                print red("--> Deployment %s %s, skip the remaining instances" % (
+                    deployment['DeploymentId'], status or 'timed out'))
+                result.failed = True
+                break
+
+        result.succeeded = not result.failed
+        result.deployment = result.deployments[-1] if result.deployments else None
+        return result
+
     def get_app_deployments(self, app_id):
         """Get all deployments for this application"""
 
@@ -183,7 +279,18 @@ def cleanup_security_groups():
     return result
 
 
-def _find_opsworks_stack():
+def _find_opsworks_stack(cached=True):
+    """
+    OpsWorks ids from the outputs of the OpsWorks CloudFormation stack, cached in the local state directory.
+
+    The CloudFormation stack status is checked only when the ids are read from the stack outputs, the
+    cached ids are used without describing the stack.
+
+    :type cached: bool
+    :param cached: Use the cached ids, otherwise describe the stack again
+    :rtype: dict
+    :return: The ids or None if the stack is not found
+    """
 
     if not 'stacks' in env:
         raise Exception("OpsWorks deployment requires stack configuration option to be defined")
@@ -204,107 +311,159 @@ def _find_opsworks_stack():
     if 'app' not in opsworks:
         raise Exception("OpsWorks app output key missing")
 
+    output_keys = {
+        'stack' : opsworks['stack'],
+        'layer' : opsworks['layer'],
+        'app' : opsworks['app'],
+    }
+    region = get_region()
+    ids = OpsWorksIdCache()
+
     for item in env['stacks']:
         if 'role' in item and item['role'] == 'opsworks':
-            cf_stack = velvet.cloudformation.stack.get_stack(item['name'])
+            if cached:
+                config = ids.get(region, item['name'], output_keys)
+                if config is not None:
+                    return config
+            cf_stack = velvet.cloudformation.stack.get_stack(item['name'], cached=cached)
             if cf_stack:
                 outputs = velvet.cloudformation.stack.get_stack_outputs(cf_stack)
-                return {
+                config = {
+                    'cloudformation_name' : item['name'],
                     'cloudformation_id' : cf_stack.stack_id,
                     'stack_id' : outputs[opsworks['stack']],
                     'layer_id' : outputs[opsworks['layer']],
                     'app_id' : outputs[opsworks['app']],
                 }
+                ids.set(region, item['name'], output_keys, config)
+                return config
 
     return None
 
 
-def app_deploy(comment=None):
-
-    config = _find_opsworks_stack()
+def _opsworks_stack_names():
+    """
+    :rtype: str
+    :return: Names of the stacks with the opsworks role
+    """
+    names = [item['name'] for item in env['stacks'] if item.get('role') == 'opsworks']
+    return ', '.join(names) or 'no stack with the opsworks role'
 
-    print "--> Deploy OpsWorks application"
 
-    print "CloudFormation Stack: %(cloudformation_id)s" % config
+def _resolve_opsworks_deployment(title):
+    """
+    Find the OpsWorks stack, layer, app and the online instances for a deployment
+    :type title: str
+    :rtype: tuple
+    :return: Deployment, resolved OpsWorks stack, layer and app, and the online instance ids
+    """
 
-    deploy = OpsWorksDeployment()
+    config = _find_opsworks_stack()
+    if config is None:
+        raise Exception('OpsWorks CloudFormation stack not found: ' + _opsworks_stack_names())
 
-    # find stack matching the requested environment
-    stack = deploy.get_stack(config['stack_id'])
-    print "OpsWorks Stack: %(Name)s" % stack
+    print title
 
-    # find application server layer
-    layer = deploy.get_layer(config['layer_id'])
-    print "OpsWorks Layer: %(Name)s" % layer
+    deploy = OpsWorksDeployment()
+    try:
+        resolved = deploy.resolve(config)
+    except boto.exception.JSONResponseError:
+        resolved = None
+
+    # the cached ids are stale if the stacks have been created again, the stack status
+    # is checked when the ids are read from the stack outputs again
+    if resolved is None:
+        stack_name = config['cloudformation_name']
+        OpsWorksIdCache().invalidate(get_region(), stack_name)
+        config = _find_opsworks_stack(cached=False)
+        if config is None:
+            raise Exception('OpsWorks CloudFormation stack %s not found, it may have been deleted or renamed' %
+                            stack_name)
+        resolved = deploy.resolve(config)
+        if resolved is None:
+            raise Exception('OpsWorks stack, layer or app not found')
 
-    # find the application
-    app = deploy.get_app(config['app_id'])
-    print "OpsWorks Application: %(Name)s" % app
+    print "CloudFormation Stack: %(cloudformation_id)s" % config
+    print "OpsWorks Stack: %(Name)s" % resolved['stack']
+    print "OpsWorks Layer: %(Name)s" % resolved['layer']
+    print "OpsWorks Application: %(Name)s" % resolved['app']
 
     instance_ids = []
-    instances = deploy.get_layer_instances(layer['LayerId'])
-    for instance in instances['Instances']:
+    for instance in resolved['instances']['Instances']:
         if instance['Status'] != "online":
             continue
         instance_ids.append(instance['InstanceId'])
         if 'ElasticIp' in instance:
-            print "Instance: %(Hostname)s | %(InstanceType)s | %(ElasticIp)s | %(Status)s" % instance    
+            print "Instance: %(Hostname)s | %(InstanceType)s | %(ElasticIp)s | %(Status)s" % instance
         else:
             print "Instance: %(Hostname)s | %(InstanceType)s | %(PublicIp)s | %(Status)s" % instance
 
-
     if len(instance_ids) == 0:
         raise Exception('No instances online')
 
-    deployment = deploy.deploy_app(stack['StackId'], app['AppId'],
-                                   instance_ids=instance_ids, comment=comment)
-    print "--> Deployment: %(DeploymentId)s" % deployment
+    return deploy, resolved, instance_ids
 
-    result = OpsWorksResult()
-    result.failed = False
-    result.succeeded = not result.failed
-    result.deployment = deployment
-    return result
 
+def get_deploy_batch(batch_size=None):
+    """
+    Rolling deployment batch size, None for a single deployment to all the instances
+    :type batch_size: int or str
+    :param batch_size: Number of instances or a percentage, the deploy_batch option by default
+    :rtype: int or str
+    """
+    if batch_size is None:
+        batch_size = env.get('deploy_batch')
+    if batch_size in [None, '', 0, '0', False]:
+        return None
+    return batch_size
 
-def cookbooks_deploy(comment=None):
 
-    config = _find_opsworks_stack()
+def get_deploy_wait():
+    """
+    Options of waiting for each batch of a rolling deployment from the deploy_wait option, eg.
 
-    print "--> Deploy OpsWorks cookbooks"
+        deploy_wait:
+            interval: 10
+            timeout: 1800
 
-    print "CloudFormation Stack: %(cloudformation_id)s" % config
+    :rtype: dict
+    """
+    config = env.get('deploy_wait') or {}
+    wait = {}
+    for key in ['interval', 'timeout']:
+        if key in config:
+            wait[key] = float(config[key])
+    return wait
 
-    deploy = OpsWorksDeployment()
 
-    # find stack matching the requested environment
-    stack = deploy.get_stack(config['stack_id'])
-    print "OpsWorks Stack: %(Name)s" % stack
+def app_deploy(comment=None, batch_size=None):
+    """
+    Deploy the app to the online instances, in rolling batches if batch_size or the deploy_batch option is set
+    """
 
-    # find application server layer
-    layer = deploy.get_layer(config['layer_id'])
-    print "OpsWorks Layer: %(Name)s" % layer
+    deploy, resolved, instance_ids = _resolve_opsworks_deployment("--> Deploy OpsWorks application")
 
-    # find the application
-    app = deploy.get_app(config['app_id'])
-    print "OpsWorks Application: %(Name)s" % app
+    batch_size = get_deploy_batch(batch_size)
+    if batch_size is not None:
+        return deploy.rolling_deploy_app(resolved['stack']['StackId'], resolved['app']['AppId'],
+                                         instance_ids, batch_size, comment=comment, **get_deploy_wait())
 
-    instance_ids = []
-    instances = deploy.get_layer_instances(layer['LayerId'])
-    for instance in instances['Instances']:
-        if instance['Status'] != "online":
-            continue
-        instance_ids.append(instance['InstanceId'])
-        if 'ElasticIp' in instance:
-            print "Instance: %(Hostname)s | %(InstanceType)s | %(ElasticIp)s | %(Status)s" % instance    
-        else:
-            print "Instance: %(Hostname)s | %(InstanceType)s | %(PublicIp)s | %(Status)s" % instance
+    deployment = deploy.deploy_app(resolved['stack']['StackId'], resolved['app']['AppId'],
+                                   instance_ids=instance_ids, comment=comment)
+    print "--> Deployment: %(DeploymentId)s" % deployment
 
+    result = OpsWorksResult()
+    result.failed = False
+    result.succeeded = not result.failed
+    result.deployment = deployment
+    return result
 
-    if len(instance_ids) == 0:
-        raise Exception('No instances online')
 
-    deployment = deploy.update_cookbooks(stack['StackId'], app['AppId'],
+def cookbooks_deploy(comment=None):
+
+    deploy, resolved, instance_ids = _resolve_opsworks_deployment("--> Deploy OpsWorks cookbooks")
+
+    deployment = deploy.update_cookbooks(resolved['stack']['StackId'], resolved['app']['AppId'],
                                          instance_ids=instance_ids, comment=comment)
     print "--> Deployment: %(DeploymentId)s" % deployment
 
@@ -10,41 +10,7 @@ def authorize_rds_security_groups(stack, config):
     :type config: dict
     :rtype: bool
     """
-
-    if 'security_groups' not in config:
-        print red('*** Section "security" missing in the config file')
-        return False
-
-    if 'rds_security_group' not in config['security_groups']:
-        print red('*** RDS security group missing')
-        return False
-
-    rds_security_group = config['security_groups']['rds_security_group']
-
-    if 'authorized_db_resources' not in config['security_groups']:
-        print yellow('*** No CloudFormation resources (security groups) configured for RDS access')
-        return False
-
-    errors = False
-
-    for group_name in config['security_groups']['authorized_db_resources']:
-        msg = '*** Authorize ' + group_name + ' -> ' + rds_security_group
-        status = velvet.security.authorize_database_access_from_resource(
-            stack,
-            group_name,
-            rds_security_group
-        )
-        if status:
-            print msg + ' [' + green('OK') + ']'
-        else:
-            print msg + ' [' + red('failed') + ']'
-            errors = True
-
-    if errors:
-        print red('*** Failed to authorize one or more rules')
-        return False
-
-    return True
+    return _reconcile_rds_security_groups(stack, config, revoke=False)
 
 
 def revoke_rds_security_groups(stack, config):
@@ -53,6 +19,15 @@ def revoke_rds_security_groups(stack, config):
     :type config: dict
     :rtype: bool
     """
+    return _reconcile_rds_security_groups(stack, config, revoke=True)
+
+
+def _reconcile_rds_security_groups(stack, config, revoke=False):
+    """
+    Plan the database access of all the configured resources, print the plan and apply it
+    with batched calls
+    :rtype: bool
+    """
 
     if 'security_groups' not in config:
         print red('*** Section "security" missing in the config file')
@@ -68,23 +43,46 @@ def revoke_rds_security_groups(stack, config):
         print yellow('*** No CloudFormation resources (security groups) configured for RDS access')
         return False
 
+    action = 'revoke' if revoke else 'authorize'
     errors = False
 
-    for group_name in config['security_groups']['authorized_db_resources']:
-        msg = '*** Revoke ' + group_name + ' -> ' + rds_security_group
-        status = velvet.security.revoke_database_access_from_resource(
-            stack,
-            group_name,
-            rds_security_group
-        )
-        if status:
-            print msg + ' [' + green('OK') + ']'
-        else:
-            print msg + ' [' + red('failed') + ']'
+    grants, missing = velvet.security.database_access_grants(
+        stack,
+        config['security_groups']['authorized_db_resources']
+    )
+    for resource_name in missing:
+        print '*** ' + action.capitalize() + ' ' + resource_name + ' -> ' + rds_security_group + \
+              ' [' + red('failed') + ']'
+        print red('*** Security group resource not found: ' + resource_name)
+        errors = True
+
+    try:
+        plans = velvet.security.plan_ingress({rds_security_group: grants}, revoke=revoke)
+    except ValueError as e:
+        print red('*** ' + str(e))
+        return False
+
+    # revoking a rule that does not exist fails as before
+    for plan in plans:
+        for grant in plan.missing:
+            print '*** Revoke ' + plan.source_name(grant) + ' -> ' + rds_security_group + ' [' + red('failed') + ']'
+            print red('*** Database access rule does not exist')
             errors = True
 
-    if errors:
-        print red('*** Failed to revoke one or more rules')
+    changes = [line for plan in plans for line in plan.describe()]
+    if len(changes) == 0:
+        print yellow('*** No rules to ' + action)
+    for line in changes:
+        print '*** ' + line
+
+    result = velvet.security.apply_ingress(plans)
+    for group_name, error in result.errors.iteritems():
+        print red('*** ' + group_name + ': ' + error)
+
+    if errors or result.failed:
+        print red('*** Failed to ' + action + ' one or more rules')
         return False
 
-    return True
\ No newline at end of file
+    if len(changes) > 0:
+        print '*** ' + action.capitalize() + ' [' + green('OK') + ']'
+    return True
@@ -1,6 +1,18 @@
 from fabric.api import env
+from fabric.colors import red, yellow
+
+import os
+import threading
 
 import velvet.cloudformation.stack as cf_stack
+from velvet.cloudformation.graph import StackGraph, execute, read_template_parameters, \
+    DEFAULT_STACK_CONCURRENCY
+from velvet.cloudformation.teardown import delete_stacks as delete_stack_graph
+from velvet.cloudformation.preflight import preflight_stacks
+from velvet.cloudformation.poller import format_duration
+from velvet.cloudformation.events import StackRunAnalysis, list_event_logs, event_log_operation, read_event_log, \
+    template_dependencies, compare_runs
+from velvet.aws.config import in_regions, get_region
 
 class CloudFormationResult(object):
 
@@ -11,6 +23,46 @@ class CloudFormationResult(object):
     def __nonzero__(self):
         return self.succeeded and not self.failed
 
+def _get_wait_config(stack=None):
+    """
+    Stack status polling options from the environment defaults and the stack configuration
+    :type stack: dict
+    :rtype: dict
+    """
+    config = {}
+    if 'stack_wait' in env:
+        config.update(env.stack_wait)
+    if stack is not None and 'wait' in stack:
+        config.update(stack['wait'])
+    return config
+
+
+def _get_force_provision():
+    """
+    Unchanged stacks are skipped unless forced, eg. fab --set force_provision=1
+    :rtype: bool
+    """
+    return env.get('force_provision', False) not in [False, None, '', '0', 'false']
+
+
+def _get_template_upload_config():
+    """
+    Templates are uploaded to S3 if template_bucket is configured, true uses the deployment bucket
+    :rtype: dict
+    """
+    bucket = env.get('template_bucket')
+    if not bucket:
+        return {}
+    if bucket is True:
+        if 'deploy_bucket' not in env:
+            raise Exception('Deployment S3 bucket not defined')
+        bucket = env.deploy_bucket
+    config = { 'template_bucket': bucket }
+    if 'template_publish_path' in env:
+        config['template_path'] = env.template_publish_path
+    return config
+
+
 def provision_stack():
     """Task to provision a new CloudFormation stack"""
 
@@ -45,7 +97,43 @@ def provision_stack():
         disable_rollback = env.disable_rollback
 
     return cf_stack.provision_stack_with_template(stack_name, template_file, tags=tags,
-                                        disable_rollback=disable_rollback)
+                                        disable_rollback=disable_rollback,
+                                        wait=_get_wait_config(),
+                                        force=_get_force_provision(),
+                                        **_get_template_upload_config())
+
+
+def _get_template_file(stack):
+    """
+    Template file path for a stack in the stacks configuration
+    :type stack: dict
+    :rtype: str
+    """
+    return "%(path)s/%(environment)s-%(template)s.json" % {
+        'path': env.cloudformation_path,
+        'environment': env.environment,
+        'template': stack['template'],
+    }
+
+
+def _get_stack_graph(stacks):
+    """
+    Stacks depend on the stacks producing the outputs their templates take as parameters
+    :type stacks: list of dict
+    :rtype: velvet.cloudformation.graph.StackGraph
+    """
+    template_parameters = {}
+    if 'cloudformation_path' in env and 'environment' in env:
+        for stack in stacks:
+            if 'template' in stack:
+                template_parameters[stack['name']] = read_template_parameters(_get_template_file(stack))
+    return StackGraph(stacks, template_parameters)
+
+
+def _get_stack_concurrency():
+    if 'stack_concurrency' in env:
+        return int(env.stack_concurrency)
+    return DEFAULT_STACK_CONCURRENCY
 
 
 def provision_stacks():
@@ -78,79 +166,107 @@ def provision_stacks():
     if len(stacks) == 0:
         return False
 
-    stack_parameters = {}
-
-    # cloudformation stack name
+    graph = _get_stack_graph(stacks)
+
+    # check all templates before any of the stacks is provisioned
+    print "--> Validate stack templates"
+    template_files = dict([(stack['name'], _get_template_file(stack)) for stack in stacks])
+    preflight = preflight_stacks(stacks, template_files, **_get_template_upload_config())
+    if not preflight:
+        result = CloudFormationResult()
+        result.failed = True
+        result.succeeded = False
+        result.error = 'Invalid stack templates: ' + ', '.join(preflight.failed)
+        return result
+
+    # collect all prompted values before anything is provisioned
+    prompted_parameters = {}
     for stack in stacks:
+        prompted_parameters[stack['name']] = []
+        if 'prompt' in stack:
+            for key in stack['prompt']:
+                value = raw_input('{0}: '.format(key))
+                if value:
+                    prompted_parameters[stack['name']].append((key, value))
+
+    # pass project metadata into the stack as tags
+    tags = {}
+    tags['Environment'] = env.environment
+    tags['Project'] = env.app_name
+
+    disable_rollback = False
+    if 'disable_rollback' in env:
+        disable_rollback = env.disable_rollback
 
-        print "--> Create stack %(name)s" % stack
+    desired_stack_statuses = [
+           "CREATE_COMPLETE",
+           "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
+           "UPDATE_COMPLETE"
+    ]
 
-        template_file = "%(path)s/%(environment)s-%(template)s.json" % {
-           'path': env.cloudformation_path,
-           'environment': env.environment,
-           'template': stack['template'],
-        }
+    def provision_region(region):
+        """
+        Provision the stacks in one region, each region gets its own stack outputs
+        :rtype: velvet.cloudformation.graph.StackGraphResult
+        """
 
-        # pass project metadata into the stack as tags
-        tags = {}
-        tags['Environment'] = env.environment
-        tags['Project'] = env.app_name
+        # output values from the provisioned stacks to pass on to the dependent stacks
+        stack_parameters = {}
+        lock = threading.Lock()
 
-        disable_rollback = False
-        if 'disable_rollback' in env:
-            disable_rollback = env.disable_rollback
+        def provision(name):
+            stack = graph.stacks[name]
 
-        parameters = []
-        for key, value in stack_parameters.iteritems():
-            parameters.append((key, value))
+            print "--> Create stack %s in %s" % (name, region)
 
-        if 'parameters' in stack:
-            for key, value in stack['parameters'].iteritems():
-                parameters.append((key, value))
+            parameters = []
+            with lock:
+                for key in graph.inputs(name):
+                    if key in stack_parameters:
+                        parameters.append((key, stack_parameters[key]))
 
-        if 'prompt' in stack:
-            for key in stack['prompt']:
-                value = raw_input('{0}: '.format(key))
-                if value:
+            if 'parameters' in stack:
+                for key, value in stack['parameters'].iteritems():
                     parameters.append((key, value))
 
-        # print "Parameters:"
-        # for item in parameters:
-        #     print item[0] + ': ' + item[1]
+            parameters.extend(prompted_parameters[name])
 
-        result = cf_stack.provision_stack_with_template(stack['name'], template_file, tags=tags,
-                                           disable_rollback=disable_rollback,
-                                           parameters=parameters)
+            result = cf_stack.provision_stack_with_template(name, _get_template_file(stack), tags=tags,
+                                               disable_rollback=disable_rollback,
+                                               parameters=parameters,
+                                               wait=_get_wait_config(stack),
+                                               force=_get_force_provision(),
+                                               region=region,
+                                               **_get_template_upload_config())
 
-        if result.failed:
-            result = CloudFormationResult()
-            result.failed = True
-            result.succeeded = not result.failed
-            return result
+            if result.failed:
+                return False
 
-        desired_stack_statuses = [
-               "CREATE_COMPLETE",
-               "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS",
-               "UPDATE_COMPLETE"
-        ]
+            if result.stack.stack_status not in desired_stack_statuses:
+                print red('*** Unexpected stack final status: ' + result.stack.stack_status)
+                return False
 
-        if result.stack.stack_status in desired_stack_statuses:
-            # append output values from the stack to pass on to the next stack
+            # append output values from the stack to pass on to the next stacks
             if 'outputs' in stack:
                 stack_outputs = cf_stack.get_stack_outputs(result.stack)
-                for key in stack['outputs']:
-                    stack_parameters[key] = stack_outputs[key]
+                with lock:
+                    for key in stack['outputs']:
+                        stack_parameters[key] = stack_outputs[key]
+
+            return True
+
+        return execute(graph, provision, max_workers=_get_stack_concurrency())
 
-        else:
-            result = CloudFormationResult()
-            result.failed = True
-            result.succeeded = not result.failed
-            result.error = 'Unexpected stack final status'
-            return result
+    # the same stacks are provisioned in all the regions concurrently
+    provisioned = in_regions(provision_region)
 
     result = CloudFormationResult()
-    result.failed = False
+    result.regions = provisioned
+    result.failed = not all(provisioned.values())
     result.succeeded = not result.failed
+    if result.failed:
+        result.error = '; '.join(['Failed to provision stacks in %s: %s' % (region, ', '.join(graph_result.failed + graph_result.skipped))
+                                  for region, graph_result in provisioned.iteritems() if not graph_result])
     return result
 
 
@@ -167,7 +283,8 @@ def delete_stack(stack_id=None):
         delete_failed_stacks = env.delete_failed_stacks
 
     return cf_stack.delete_stack(stack_id,
-                       delete_failed_stacks=delete_failed_stacks)
+                       delete_failed_stacks=delete_failed_stacks,
+                       wait=_get_wait_config())
 
 
 def delete_stacks():
@@ -181,17 +298,77 @@ def delete_stacks():
     if len(stacks) == 0:
         return False
 
-    # delete stacks in reversed order
-    for stack in reversed(stacks):
-        success = delete_stack(stack.stack_id)
-        if not success:
-            result = CloudFormationResult()
-            result.failed = True
-            result.succeeded = not result.failed
-            result.error = 'Failed to delete stack ' + stack.stack_id
-            return result
+    delete_failed_stacks = False
+    if 'delete_failed_stacks' in env:
+        delete_failed_stacks = env.delete_failed_stacks
+
+    # stacks are deleted after all the stacks depending on them
+    deleted = delete_stack_graph(_get_stack_graph(stacks),
+                                 delete_failed_stacks=delete_failed_stacks,
+                                 wait=_get_wait_config(),
+                                 max_concurrent=_get_stack_concurrency())
 
     result = CloudFormationResult()
-    result.failed = False
+    result.failed = not deleted
     result.succeeded = not result.failed
+    if result.failed:
+        result.error = 'Failed to delete stacks: ' + ', '.join(deleted.failed + deleted.skipped)
     return result
+
+
+def analyze_stack_events(stack_name=None, runs=5, operation=None):
+    """Show how long each resource took to provision in the latest recorded run of a stack"""
+
+    if stack_name is None:
+        if 'stack_id' not in env:
+            raise Exception('Stack name not defined')
+        stack_name = env.stack_id
+
+    paths = list_event_logs(stack_name, get_region())
+    if len(paths) == 0:
+        print yellow('*** No recorded events for stack ' + stack_name)
+        return False
+
+    # compare only with the runs of the same operation, by default the operation of the latest run
+    if operation is None:
+        operation = event_log_operation(paths[-1])
+    paths = list_event_logs(stack_name, get_region(), operation)
+    if len(paths) == 0:
+        print yellow('*** No recorded %s events for stack %s' % (operation, stack_name))
+        return False
+
+    # resource dependencies from the stack template make the critical path exact
+    dependencies = None
+    if 'cloudformation_path' in env and 'environment' in env:
+        template_files = [_get_template_file(stack) for stack in env.get('stacks', [])
+                          if stack.get('name') == stack_name and 'template' in stack]
+        template_files = [template_file for template_file in template_files if os.path.exists(template_file)]
+        if template_files:
+            with open(template_files[0]) as f:
+                dependencies = template_dependencies(f.read())
+
+    analyses = [StackRunAnalysis(read_event_log(path), dependencies) for path in paths[-(int(runs) + 1):]]
+    current = analyses[-1]
+    previous = analyses[:-1]
+
+    print "Stack Name: " + stack_name
+    print "Event log:  " + paths[-1]
+    print "Operation:  " + str(operation)
+    print "Duration:   " + format_duration(current.duration)
+    print ""
+
+    print "%-40s %-40s %8s %8s" % ('Resource', 'Type', 'Duration', 'Previous')
+    for logical_id, resource_type, duration, average in compare_runs(current, previous):
+        line = "%-40s %-40s %8s %8s" % (logical_id, resource_type, format_duration(duration),
+                                         format_duration(average))
+        # highlight resources that took notably longer than before
+        if average is not None and duration > average * 1.2 and duration - average > 30:
+            line = red(line)
+        print line
+
+    print ""
+    print "Critical path:"
+    for logical_id in current.critical_path:
+        print "  %-40s %8s" % (logical_id, format_duration(current.resources[logical_id].duration))
+
+    return True